@@ -0,0 +1,199 @@
+"""
+Cold-storage tier for old expenses.
+
+`archive_expenses` moves each user's expenses older than the archive horizon
+into a zstd-compressed Arrow IPC file per user and replaces them in the
+database with monthly per-category rollups. Readers merge hot database rows
+with cold rows read through a memory map, so queries on recent data no longer
+scale with the length of a user's history. Archived expenses are read-only.
+
+Archiving moves rows between tiers; it doesn't change what the user sees, so:
+their `expense_tags` and `receipts` rows stay (tag filters and receipt
+downloads keep working on archived expenses), no change-log tombstones are
+written (sync snapshots include archived rows), and budget trackers and
+category statistics keep counting their amounts. Each run rewrites the
+user's whole archive file, since Arrow IPC files can't be appended to; run
+it at most daily.
+"""
+from sqlalchemy import delete, select
+from datetime import datetime, timedelta
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from models import Category, Expense, ExpenseRollup, User
+from tags import id_filter
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "365"))
+ARCHIVE_BATCH_ROWS = int(os.getenv("ARCHIVE_BATCH_ROWS", "10000"))
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("description", pa.string()),
+    ("amount", pa.float64()),
+    ("category", pa.string()),
+    ("date", pa.timestamp("us")),
+    ("owner_id", pa.int64()),
+    ("updated_at", pa.timestamp("us")),
+    ("version", pa.int64()),
+])
+
+# Files are stored in the order readers return rows
+ARCHIVE_ORDER = [("date", "descending"), ("id", "descending")]
+BATCH_DATES_KEY = b"batch_dates"
+
+def archive_path(user_id: int):
+    return os.path.join(ARCHIVE_DIR, f"user_{user_id}.arrow")
+
+def _batch_dates(table):
+    """[newest, oldest] date of each record batch the table will be written as"""
+    return [
+        [batch["date"][0].as_py().isoformat(), batch["date"][-1].as_py().isoformat()]
+        for batch in table.to_batches(max_chunksize=ARCHIVE_BATCH_ROWS) if batch.num_rows
+    ]
+
+def read_archive(user_id: int):
+    """Return the user's archived expenses as an Arrow table, or None"""
+    try:
+        with pa.memory_map(archive_path(user_id)) as source:
+            return pa.ipc.open_file(source).read_all()
+    except FileNotFoundError:
+        return None
+
+def _batches(user_id: int, start=None, end=None):
+    """Yield the archive's record batches newest first, skipping those entirely outside [start, end)"""
+    try:
+        source = pa.memory_map(archive_path(user_id))
+    except FileNotFoundError:
+        return
+    with source:
+        reader = pa.ipc.open_file(source)
+        dates = (reader.schema.metadata or {}).get(BATCH_DATES_KEY)
+        if dates is None:
+            # Written before archives were kept sorted: fall back to sorting it in memory
+            yield from reader.read_all().sort_by(ARCHIVE_ORDER).to_batches(max_chunksize=ARCHIVE_BATCH_ROWS)
+            return
+        for index, (newest, oldest) in enumerate(json.loads(dates)):
+            if start is not None and datetime.fromisoformat(newest) < start:
+                # Every later batch is older still
+                return
+            if end is not None and datetime.fromisoformat(oldest) >= end:
+                continue
+            yield reader.get_batch(index)
+
+def _filter(batch, category=None, start=None, end=None, ids=None):
+    mask = None
+    def combine(condition):
+        return condition if mask is None else pc.and_(mask, condition)
+    if category:
+        mask = combine(pc.equal(batch["category"], category))
+    if start is not None:
+        mask = combine(pc.greater_equal(batch["date"], pa.scalar(start, pa.timestamp("us"))))
+    if end is not None:
+        mask = combine(pc.less(batch["date"], pa.scalar(end, pa.timestamp("us"))))
+    if ids is not None:
+        mask = combine(pc.is_in(batch["id"], value_set=ids))
+    return batch if mask is None else batch.filter(mask)
+
+def cold_rows(user_id: int, category=None, start=None, end=None, ids=None, limit=None):
+    """Archived expenses matching the filters, newest first, as dicts.
+
+    Batches are decompressed one at a time from the memory map, so a date
+    range or a limit only touches the batches it needs. `ids` restricts
+    the result to those expense ids.
+    """
+    if ids is not None:
+        ids = pa.array(list(ids), pa.int64())
+    rows = []
+    for batch in _batches(user_id, start, end):
+        rows.extend(_filter(batch, category, start, end, ids).to_pylist())
+        if limit is not None and len(rows) >= limit:
+            return rows[:limit]
+    return rows
+
+def cold_batches(user_id: int, batch_size: int = 1000, columns=("id", "description", "amount", "category", "date")):
+    """Yield archived rows as tuples of `columns`, newest first, holding one record batch at a time"""
+    for batch in _batches(user_id):
+        for offset in range(0, batch.num_rows, batch_size):
+            part = batch.slice(offset, batch_size)
+            yield list(zip(*(part.column(column).to_pylist() for column in columns)))
+
+def _write_archive(user_id: int, table):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = archive_path(user_id)
+    tmp_path = f"{path}.tmp"
+    # Sorted the way readers return rows, with each batch's date range in the
+    # footer, so reads can stop early and skip batches without decompressing them
+    table = table.sort_by(ARCHIVE_ORDER)
+    schema = ARCHIVE_SCHEMA.with_metadata({BATCH_DATES_KEY: json.dumps(_batch_dates(table))})
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema, options=options) as writer:
+            writer.write_table(table.replace_schema_metadata(schema.metadata), max_chunksize=ARCHIVE_BATCH_ROWS)
+    os.replace(tmp_path, path)
+
+def archive_user(db, user_id: int, cutoff: datetime):
+    """Move one user's expenses dated before `cutoff` into their archive file"""
+    # The archive stores category names so the file stays readable on its own
+    columns = [
+        Category.name.label("category") if field.name == "category" else Expense.__table__.c[field.name]
+        for field in ARCHIVE_SCHEMA
+    ]
+    expenses = db.execute(
+        select(*columns)
+        .outerjoin(Category, Category.id == Expense.category_id)
+        .where(Expense.owner_id == user_id, Expense.date < cutoff)
+    ).all()
+    if not expenses:
+        return 0
+
+    ids = [row.id for row in expenses]
+    table = pa.Table.from_pylist([row._asdict() for row in expenses], schema=ARCHIVE_SCHEMA)
+    existing = read_archive(user_id)
+    if existing is not None:
+        # Copies of these rows left by an interrupted run may be stale, so the current ones replace them
+        existing = existing.filter(pc.invert(pc.is_in(existing["id"], value_set=pa.array(ids, pa.int64()))))
+        table = pa.concat_tables([existing.replace_schema_metadata(None), table])
+    _write_archive(user_id, table)
+
+    # Every deleted row gets rolled up, including leftovers already in the file
+    rollups = {}
+    for row in expenses:
+        key = (row.date.year, row.date.month, row.category)
+        total, count = rollups.get(key, (0.0, 0))
+        rollups[key] = (total + row.amount, count + 1)
+    for (year, month, category), (total, count) in rollups.items():
+        rollup = db.get(ExpenseRollup, (user_id, year, month, category))
+        if rollup is None:
+            db.add(ExpenseRollup(owner_id=user_id, year=year, month=month, category=category, total=total, count=count))
+        else:
+            rollup.total += total
+            rollup.count += count
+
+    # Exactly the rows written above; a backdated expense added meanwhile waits for the next run
+    db.execute(delete(Expense).where(Expense.owner_id == user_id, id_filter(Expense.id, ids)))
+    db.commit()
+    return len(expenses)
+
+def archive_expenses(db, horizon_days: int = ARCHIVE_HORIZON_DAYS, route=None):
+    """Archive every user's expenses older than the horizon"""
+    cutoff = datetime.utcnow() - timedelta(days=horizon_days)
+    archived = 0
+    for user in db.query(User).all():
+        if route:
+            route(db, user)
+        archived += archive_user(db, user.id, cutoff)
+    return archived
+
+if __name__ == "__main__":
+    from database import SessionLocal
+    from sharding import route_session
+
+    db = SessionLocal()
+    try:
+        print(f"Archived {archive_expenses(db, route=route_session)} expenses")
+    finally:
+        db.close()
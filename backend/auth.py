@@ -2,18 +2,24 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
+import secrets
+import time
 import os
 
-from database import get_db
+from database import get_db, get_read_db
 from models import User
 from crud import get_user_by_email
+from sharding import route_session
+from revocation import revocations
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+# Operations endpoints (/admin/...) are disabled unless this is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 pwd_context = CryptContext(
     schemes=["bcrypt"],
@@ -40,28 +46,60 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # jti lets a single token be revoked; a float iat orders it against credential changes
+    to_encode.update({"exp": expire, "iat": time.time(), "jti": secrets.token_hex(16)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str, credentials_exception):
+def decode_token(token: str, credentials_exception):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        return email
     except JWTError:
         raise credentials_exception
+    if payload.get("sub") is None:
+        raise credentials_exception
+    return payload
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def verify_token(token: str, credentials_exception):
+    return decode_token(token, credentials_exception)["sub"]
+
+def revoke_user_tokens(db: Session, email: str):
+    """Invalidate every token issued to the user so far"""
+    # Covers both the default 15 minute lifetime and ACCESS_TOKEN_EXPIRE_MINUTES
+    revocations.revoke_user(db, email, max(ACCESS_TOKEN_EXPIRE_MINUTES, 15))
+
+def _get_user_for_token(token: str, db: Session, read_db: Session = None):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    email = verify_token(token, credentials_exception)
-    user = get_user_by_email(db, email=email)
+    payload = decode_token(token, credentials_exception)
+    # Always the primary: a replica may not have the revocation yet
+    if revocations.is_revoked(db, payload, token):
+        raise credentials_exception
+    user = get_user_by_email(read_db, email=payload["sub"]) if read_db is not None else None
+    if user is None:
+        # Not on the replica yet (just registered), or no replica at all
+        user = get_user_by_email(db, email=payload["sub"])
     if user is None:
         raise credentials_exception
     return user
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    user = _get_user_for_token(token, db)
+    # Point the request's session at the shard holding this user's data
+    route_session(db, user)
+    return user
+
+def get_current_reader(
+    token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db), primary_db: Session = Depends(get_db)
+):
+    """Same as get_current_user, but looks the user up on the read session, then the primary"""
+    user = _get_user_for_token(token, primary_db, db if db is not primary_db else None)
+    route_session(db, user, writable=False)
+    return user
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
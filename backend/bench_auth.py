@@ -0,0 +1,73 @@
+"""
+Token authentication overhead benchmark
+
+Measures the per-request cost of validating an access token three ways:
+JWT decode only (no revocation), decode plus a denylist query on every
+request, and decode plus the bloom-filter revocation check used by
+auth._get_user_for_token. The denylist is seeded with BENCH_REVOKED rows.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench_auth.py
+    BENCH_ITERATIONS=20000 BENCH_REVOKED=100000 python bench_auth.py
+"""
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from database import SessionLocal, engine
+from models import Base, RevokedToken
+from auth import create_access_token, decode_token
+from revocation import RevocationList, token_key, user_key
+
+ITERATIONS = int(os.getenv("BENCH_ITERATIONS", "5000"))
+REVOKED = int(os.getenv("BENCH_REVOKED", "10000"))
+
+def seed(db):
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    db.query(RevokedToken).filter(RevokedToken.key.like("jti:bench-%")).delete(synchronize_session=False)
+    db.bulk_insert_mappings(RevokedToken, [
+        {"key": f"jti:bench-{uuid.uuid4().hex}", "expires_at": expires_at} for _ in range(REVOKED)
+    ])
+    db.commit()
+
+def run(label, check):
+    token = create_access_token(data={"sub": "bench@example.com"})
+    error = Exception("invalid token")
+    timings = []
+    for _ in range(ITERATIONS):
+        started = time.perf_counter()
+        check(decode_token(token, error), token)
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    print(
+        f"{label:<24} mean {statistics.mean(timings):7.1f} us  "
+        f"p50 {timings[len(timings) // 2]:7.1f} us  p99 {timings[int(len(timings) * 0.99)]:7.1f} us"
+    )
+
+def main():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    seed(db)
+
+    def db_lookup(payload, token):
+        keys = [token_key(payload, token), user_key(payload["sub"])]
+        return db.scalars(select(RevokedToken.key).where(RevokedToken.key.in_(keys))).first()
+
+    revocations = RevocationList(SessionLocal, sync_seconds=3600)
+    revocations.sync()
+
+    def bloom_check(payload, token):
+        return revocations.is_revoked(db, payload, token)
+
+    print(f"{ITERATIONS} validations, {REVOKED} revoked tokens, {engine.dialect.name}")
+    run("decode only", lambda payload, token: None)
+    run("decode + denylist query", db_lookup)
+    run("decode + bloom filter", bloom_check)
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Group-commit benchmark
+
+Simulates a burst of concurrent expense creations (e.g. mobile clients
+flushing offline queues) and compares one-commit-per-insert against the
+write coalescer. Prints inserts/second and p50/p99 latency per mode.
+
+Usage:
+    DATABASE_URL=postgresql://... python bench_coalescing.py
+    BENCH_CLIENTS=64 BENCH_REQUESTS=5000 BENCH_WINDOW_MS=5 python bench_coalescing.py
+"""
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import SessionLocal, engine
+from models import Base, User
+from schemas import ExpenseCreate
+from crud import create_expense
+from coalescer import WriteCoalescer
+
+CLIENTS = int(os.getenv("BENCH_CLIENTS", "32"))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "2000"))
+WINDOW_MS = float(os.getenv("BENCH_WINDOW_MS", "5"))
+MAX_BATCH = int(os.getenv("BENCH_MAX_BATCH", "100"))
+
+def make_user():
+    db = SessionLocal()
+    user = User(email=f"bench_{time.time()}@example.com", hashed_password="x", full_name="Bench")
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    db.close()
+    return user_id
+
+def run(label, insert_one):
+    latencies = []
+
+    def timed(i):
+        started = time.perf_counter()
+        insert_one(i)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CLIENTS) as pool:
+        list(pool.map(timed, range(REQUESTS)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{label:<22} {REQUESTS / elapsed:>10.0f} inserts/s   "
+          f"p50 {statistics.median(latencies) * 1000:>7.2f} ms   "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:>7.2f} ms")
+
+def main():
+    Base.metadata.create_all(bind=engine)
+    user_id = make_user()
+    expense = ExpenseCreate(description="Burst", amount=1.0, category="Other")
+
+    def direct(i):
+        db = SessionLocal()
+        try:
+            create_expense(db, expense, user_id)
+        finally:
+            db.close()
+
+    coalescer = WriteCoalescer(window_ms=WINDOW_MS, max_batch=MAX_BATCH)
+
+    def coalesced(i):
+        db = SessionLocal()
+        try:
+            coalescer.submit(db, expense, user_id).result()
+        finally:
+            db.close()
+
+    print(f"\n{CLIENTS} concurrent clients, {REQUESTS} inserts, window {WINDOW_MS} ms, batch {MAX_BATCH}\n")
+    run("commit per insert", direct)
+    run("group commit", coalesced)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Partition pruning benchmark (PostgreSQL only)
+
+Seeds a monthly-partitioned expenses table with several years of data and
+prints EXPLAIN output for the month-filtered queries used by
+crud.get_expenses and crud.get_expense_summary, showing that only one
+partition is scanned.
+
+Usage:
+    EXPENSE_PARTITIONING=month DATABASE_URL=postgresql://... python bench_partitioning.py
+"""
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import partitioning
+from database import SessionLocal, engine
+from models import Base, User, Expense
+from crud import expense_query, get_expense_summary
+from categories import category_cache
+
+YEARS = int(os.getenv("BENCH_YEARS", "3"))
+ROWS_PER_MONTH = int(os.getenv("BENCH_ROWS_PER_MONTH", "20000"))
+
+def seed(db):
+    user = User(email=f"bench_{time.time()}@example.com", hashed_password="x", full_name="Bench")
+    db.add(user)
+    db.commit()
+
+    start = datetime(datetime.now().year - YEARS + 1, 1, 1)
+    partitioning.create_future_partitions(engine, today=start.date(), ahead=YEARS * 12 + 3)
+
+    category_ids = [
+        category_cache.get_or_create(db, user.id, name)
+        for name in ["Food", "Transport", "Bills", "Other"]
+    ]
+    rows = []
+    for month_offset in range(YEARS * 12):
+        month_start = datetime(start.year + month_offset // 12, month_offset % 12 + 1, 1)
+        for _ in range(ROWS_PER_MONTH):
+            rows.append({
+                "description": "bench",
+                "amount": round(random.uniform(1, 200), 2),
+                "category_id": random.choice(category_ids),
+                "date": month_start + timedelta(days=random.randint(0, 27)),
+                "owner_id": user.id,
+            })
+        if len(rows) >= 50000:
+            db.execute(Expense.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.execute(Expense.__table__.insert(), rows)
+    db.commit()
+    db.execute(text("ANALYZE expenses"))
+    return user
+
+def explain(db, query):
+    compiled = query.statement.compile(engine)
+    result = db.connection().exec_driver_sql(f"EXPLAIN ANALYZE {compiled}", compiled.params)
+    return [row[0] for row in result]
+
+def main():
+    if not partitioning.is_enabled(engine):
+        print("Set EXPENSE_PARTITIONING=month and point DATABASE_URL at PostgreSQL")
+        return
+
+    partitioning.maintain(engine)
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user = seed(db)
+        month = datetime.now().month
+
+        print(f"\n{'='*60}\nEXPLAIN get_expenses(month={month})\n{'='*60}")
+        plan = explain(db, expense_query(db, user.id, month=month))
+        print("\n".join(plan))
+        scanned = sorted({line.split(" on ")[1].split()[0] for line in plan if " on expenses_" in line})
+        print(f"\nPartitions scanned: {scanned}")
+
+        for label, kwargs in [("all history", {}), (f"month={month}", {"month": month})]:
+            started = time.perf_counter()
+            get_expense_summary(db, user.id, **kwargs)
+            print(f"get_expense_summary {label}: {(time.perf_counter() - started) * 1000:.1f} ms")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
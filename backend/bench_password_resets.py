@@ -0,0 +1,122 @@
+"""
+Password reset lookup benchmark
+
+Fills password_resets with BENCH_ROWS historical (used or expired) keys,
+then times the two queries on the reset path: issuing a key, which
+retires the email's outstanding keys, and verifying one. Both are timed
+with the old single-column indexes only, with the partial
+(email, reset_key) WHERE NOT is_used index, and after purging the history.
+
+Usage:
+    python bench_password_resets.py                  # temporary SQLite file
+    DATABASE_URL=postgresql://... BENCH_ROWS=5000000 python bench_password_resets.py
+"""
+import os
+import random
+import statistics
+import string
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.orm import Session
+
+ROWS = int(os.getenv("BENCH_ROWS", "2000000"))
+USERS = int(os.getenv("BENCH_USERS", "100000"))
+LOOKUPS = int(os.getenv("BENCH_LOOKUPS", "2000"))
+
+def random_key():
+    return "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
+
+def seed(engine, PasswordReset):
+    now = datetime.utcnow()
+    batch = []
+    with engine.begin() as conn:
+        for i in range(ROWS):
+            batch.append({
+                "email": f"user{random.randrange(USERS)}@example.com",
+                "reset_key": random_key(),
+                "is_used": i % 2 == 0,
+                "expires_at": now - timedelta(minutes=random.randrange(1, 525600)),
+                "created_at": now,
+            })
+            if len(batch) == 50000:
+                conn.execute(PasswordReset.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(PasswordReset.__table__.insert(), batch)
+
+def outstanding(engine, PasswordReset, count):
+    """Issue `count` live keys, one per email, the way /password-reset/request does"""
+    keys = []
+    with Session(engine) as db:
+        for i in range(count):
+            email = f"user{random.randrange(USERS)}@example.com"
+            reset = PasswordReset(email=email, reset_key=random_key(), is_used=False,
+                                  expires_at=datetime.utcnow() + timedelta(hours=1))
+            db.add(reset)
+            keys.append((email, reset.reset_key))
+        db.commit()
+    return keys
+
+def timed(label, engine, keys, work):
+    timings = []
+    with Session(engine) as db:
+        for email, key in keys:
+            started = time.perf_counter()
+            work(db, email, key)
+            timings.append((time.perf_counter() - started) * 1e6)
+        db.rollback()
+    timings.sort()
+    print(f"  {label:<26} p50 {statistics.median(timings):8.1f} us   p99 {timings[int(len(timings) * 0.99)]:8.1f} us")
+
+def run(label, engine, PasswordReset, keys):
+    from password_resets import invalidate_outstanding
+    rows = Session(engine).scalar(select(func.count()).select_from(PasswordReset))
+    print(f"{label} ({rows} rows)")
+
+    def verify(db, email, key):
+        db.query(PasswordReset).filter(
+            PasswordReset.email == email,
+            PasswordReset.reset_key == key,
+            PasswordReset.is_used == False
+        ).first()
+
+    def issue(db, email, key):
+        invalidate_outstanding(db, email)
+
+    timed("verify", engine, keys, verify)
+    timed("issue (retire older keys)", engine, keys, issue)
+
+def main():
+    from models import Base, PasswordReset
+    from password_resets import purge_expired
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(os.getenv("DATABASE_URL") or f"sqlite:///{directory}/bench.db")
+        Base.metadata.create_all(bind=engine)
+        outstanding_index = next(i for i in PasswordReset.__table__.indexes if i.name == "ix_password_resets_outstanding")
+        outstanding_index.drop(engine)
+        # The index the email column used to have
+        with engine.begin() as conn:
+            conn.execute(text("CREATE INDEX ix_password_resets_email ON password_resets (email)"))
+
+        started = time.perf_counter()
+        seed(engine, PasswordReset)
+        keys = outstanding(engine, PasswordReset, LOOKUPS)
+        print(f"Seeded {ROWS} historical keys in {time.perf_counter() - started:.1f}s, {engine.dialect.name}\n")
+
+        run("Single-column indexes", engine, PasswordReset, keys)
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_password_resets_email"))
+        outstanding_index.create(engine)
+        run("Partial (email, reset_key) index", engine, PasswordReset, keys)
+
+        started = time.perf_counter()
+        deleted = purge_expired(engine)
+        print(f"\nPurged {deleted} rows in {time.perf_counter() - started:.1f}s\n")
+        run("After purge", engine, PasswordReset, keys)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Login rate limiting load test
+
+Starts the API under uvicorn (with --proxy-headers, so each simulated
+client gets its own X-Forwarded-For address) and measures honest login
+latency three ways: with no attack, during a password-guessing attack with
+rate limiting off, and during the same attack with it on. Attackers
+hammer BENCH_VICTIMS accounts with wrong passwords from a handful of
+addresses; honest clients log into BENCH_ACCOUNTS other accounts at a
+steady pace, each login from a fresh address.
+
+Usage:
+    python bench_ratelimit.py
+    BENCH_ATTACKERS=64 BENCH_SECONDS=20 python bench_ratelimit.py
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+ATTACKERS = int(os.getenv("BENCH_ATTACKERS", "32"))
+ATTACKER_IPS = int(os.getenv("BENCH_ATTACKER_IPS", "4"))
+HONEST = int(os.getenv("BENCH_HONEST", "2"))
+HONEST_INTERVAL = float(os.getenv("BENCH_HONEST_INTERVAL", "1"))
+ACCOUNTS = int(os.getenv("BENCH_ACCOUNTS", "30"))
+VICTIMS = int(os.getenv("BENCH_VICTIMS", "8"))
+SECONDS = float(os.getenv("BENCH_SECONDS", "30"))
+PORT = int(os.getenv("BENCH_PORT", "8765"))
+PASSWORD = "benchpassword123"
+
+def start_server(database_url, rate_limiting):
+    env = dict(os.environ, DATABASE_URL=database_url, RATE_LIMIT_ENABLED="1" if rate_limiting else "0")
+    # Default limits unless overridden; each allowed guess still costs a bcrypt check
+    env.setdefault("RATE_LIMIT_LOGIN_IP", "5/60")
+    env.setdefault("RATE_LIMIT_LOGIN_EMAIL", "3/300")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT),
+         "--proxy-headers", "--forwarded-allow-ips", "*", "--log-level", "warning"],
+        env=env,
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{PORT}/docs")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+def register(emails):
+    with httpx.Client(base_url=f"http://127.0.0.1:{PORT}") as client:
+        for email in emails:
+            client.post("/register", json={"email": email, "password": PASSWORD, "full_name": "Bench"})
+
+def login(client, email, password, ip):
+    return client.post(
+        "/login", data={"username": email, "password": password}, headers={"X-Forwarded-For": ip}
+    ).status_code
+
+def run(label, attack):
+    stop = time.monotonic() + SECONDS
+    latencies, rejected, failures, errors = [], [0], [0], [0]
+
+    def honest(i):
+        with httpx.Client(base_url=f"http://127.0.0.1:{PORT}", timeout=60) as client:
+            n = i
+            while time.monotonic() < stop:
+                started = time.perf_counter()
+                status = login(client, f"honest{n % ACCOUNTS}@example.com", PASSWORD, f"10.1.{n // 250}.{n % 250}")
+                n += HONEST
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    failures[0] += 1
+                time.sleep(HONEST_INTERVAL)
+
+    def attacker(i):
+        with httpx.Client(base_url=f"http://127.0.0.1:{PORT}", timeout=60) as client:
+            n = 0
+            while time.monotonic() < stop:
+                try:
+                    status = login(client, f"victim{n % VICTIMS}@example.com", "guess", f"10.0.2.{i % ATTACKER_IPS}")
+                except httpx.TransportError:
+                    errors[0] += 1
+                    continue
+                if status == 429:
+                    rejected[0] += 1
+                n += 1
+
+    threads = [threading.Thread(target=honest, args=(i,)) for i in range(HONEST)]
+    if attack:
+        threads += [threading.Thread(target=attacker, args=(i,)) for i in range(ATTACKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    print(f"{label:<28} honest p50 {statistics.median(latencies) * 1000:>7.1f} ms   "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:>7.1f} ms   "
+          f"failed {failures[0]:>3}   attack 429s {rejected[0]:>6}   attack errors {errors[0]}")
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{directory}/bench.db"
+        for label, rate_limiting, attack in [
+            ("no attack", True, False),
+            ("attack, no rate limiting", False, True),
+            ("attack, rate limiting", True, True),
+        ]:
+            server = start_server(database_url, rate_limiting)
+            try:
+                register([f"honest{i}@example.com" for i in range(ACCOUNTS)] +
+                         [f"victim{i}@example.com" for i in range(VICTIMS)])
+                run(label, attack)
+            finally:
+                server.terminate()
+                server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Receipt upload memory benchmark
+
+Feeds a large upload through receipts.save_upload in 64 KiB chunks, as the
+ASGI server delivers it, and compares peak Python memory and throughput
+with buffering the whole body before storing it. The upload is generated
+on the fly, so the numbers only count what the handler itself holds.
+
+Usage:
+    python bench_receipts.py
+    BENCH_UPLOAD_MB=200 python bench_receipts.py
+"""
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+
+from blobstore import CHUNK_SIZE, LocalBlobStore
+from receipts import save_upload
+
+UPLOAD_MB = int(os.getenv("BENCH_UPLOAD_MB", "50"))
+
+async def body(seed: int):
+    chunk = bytes([seed]) * CHUNK_SIZE
+    for _ in range(UPLOAD_MB * 1024 * 1024 // CHUNK_SIZE):
+        yield chunk
+
+async def buffered(chunks, store, max_bytes):
+    data = b"".join([chunk async for chunk in chunks])
+    key = f"buffered-{len(data)}"
+    await asyncio.to_thread(store.put_object, key, data)
+    return key, len(data)
+
+def run(label, handler, store, seed):
+    tracemalloc.start()
+    started = time.perf_counter()
+    _, size = asyncio.run(handler(body(seed), store, None))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} {size / elapsed / 1e6:>8.0f} MB/s   peak {peak / 1e6:>8.1f} MB")
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        store = LocalBlobStore(root)
+        print(f"{UPLOAD_MB} MB upload")
+        run("buffered", buffered, store, 1)
+        run("streamed", save_upload, store, 2)
+
+if __name__ == "__main__":
+    main()
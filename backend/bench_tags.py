@@ -0,0 +1,112 @@
+"""
+Tag filter benchmark
+
+Seeds one user with BENCH_EXPENSES expenses (default 100k) spread over
+BENCH_TAGS tags (default 50), each expense carrying up to four, then
+times resolving AND and OR tag filters to expense ids with the in-memory
+bitmap index (tags.tag_index) against the equivalent EXISTS subqueries
+over expense_tags, and the full filtered listing (crud.get_expenses)
+both ways. Also prints the index build time and its estimated size.
+
+Usage:
+    python bench_tags.py
+    BENCH_EXPENSES=1000000 DATABASE_URL=postgresql://... python bench_tags.py
+"""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+EXPENSES = int(os.getenv("BENCH_EXPENSES", "100000"))
+TAGS = int(os.getenv("BENCH_TAGS", "50"))
+REPEAT = int(os.getenv("BENCH_REPEAT", "20"))
+
+_directory = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_directory.name}/bench.db")
+
+from sqlalchemy import and_, exists, or_, select
+
+from database import SessionLocal, engine
+from models import Base, User, Expense, ExpenseTag, Tag
+from categories import category_cache
+from crud import expense_query, get_expenses
+import tags
+
+def seed(db):
+    user = User(email=f"bench_{time.time()}@example.com", hashed_password="x", full_name="Bench")
+    db.add(user)
+    db.commit()
+    category_id = category_cache.get_or_create(db, user.id, "Other")
+    db.execute(Expense.__table__.insert(), [
+        {"description": f"Expense {i}", "amount": round(random.uniform(1, 200), 2), "category_id": category_id,
+         "date": datetime(2024, 1, 1) + timedelta(minutes=i), "owner_id": user.id}
+        for i in range(EXPENSES)
+    ])
+    tag_ids = tags.resolve(db, user.id, [f"tag{i}" for i in range(TAGS)])
+    # Skewed like real tags: a few are on many expenses, most on few
+    weights = [1 / (rank + 1) for rank in range(TAGS)]
+    rows = []
+    for expense_id in db.scalars(select(Expense.id).where(Expense.owner_id == user.id)):
+        for tag_id in set(random.choices(tag_ids, weights, k=random.randint(0, 4))):
+            rows.append({"owner_id": user.id, "expense_id": expense_id, "tag_id": tag_id})
+    db.execute(ExpenseTag.__table__.insert(), rows)
+    db.commit()
+    return user.id, len(rows)
+
+def has_tag(user_id, name):
+    return exists().where(
+        ExpenseTag.owner_id == user_id, ExpenseTag.expense_id == Expense.id,
+        ExpenseTag.tag_id == select(Tag.id).where(Tag.owner_id == user_id, Tag.name == name).scalar_subquery()
+    )
+
+def sql_ids(db, user_id, all_of, any_of):
+    conditions = [has_tag(user_id, name) for name in all_of]
+    if any_of:
+        conditions.append(or_(*(has_tag(user_id, name) for name in any_of)))
+    return db.scalars(select(Expense.id).where(Expense.owner_id == user_id, and_(*conditions))).all()
+
+def timed(function):
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        result = function()
+    return (time.perf_counter() - started) / REPEAT * 1000, result
+
+def main():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    user_id, assignments = seed(db)
+    print(f"{EXPENSES} expenses, {TAGS} tags, {assignments} tag assignments\n")
+
+    started = time.perf_counter()
+    tags.tag_index.match(db, user_id, ["tag0"])
+    index = tags.tag_index._indexes[user_id]
+    print(f"index build  {(time.perf_counter() - started) * 1000:8.1f} ms   ~{index.size / 1e6:.1f} MB\n")
+
+    filters = [
+        ("tag0 AND tag1", ["tag0", "tag1"], []),
+        ("tag0 AND tag1 AND tag2", ["tag0", "tag1", "tag2"], []),
+        ("tag10 OR tag20 OR tag30", [], ["tag10", "tag20", "tag30"]),
+        ("tag0 AND (tag5 OR tag6)", ["tag0"], ["tag5", "tag6"]),
+    ]
+    print(f"{'filter':<26}{'matches':>8}{'SQL ids':>11}{'bitmap ids':>12}{'SQL list':>11}{'bitmap list':>13}")
+    for label, all_of, any_of in filters:
+        sql_time, expected = timed(lambda: sql_ids(db, user_id, all_of, any_of))
+        bitmap_time, ids = timed(lambda: tags.tag_index.match(db, user_id, all_of, any_of))
+        assert sorted(ids) == sorted(expected)
+
+        def sql_listing():
+            query = expense_query(db, user_id)
+            for name in all_of:
+                query = query.filter(has_tag(user_id, name))
+            if any_of:
+                query = query.filter(or_(*(has_tag(user_id, name) for name in any_of)))
+            return query.all()
+        sql_list_time, _ = timed(sql_listing)
+        bitmap_list_time, _ = timed(lambda: get_expenses(db, user_id, all_tags=all_of, any_tags=any_of))
+        print(f"{label:<26}{len(ids):>8}{sql_time:>9.1f}ms{bitmap_time:>10.1f}ms"
+              f"{sql_list_time:>9.1f}ms{bitmap_list_time:>11.1f}ms")
+    db.close()
+
+if __name__ == "__main__":
+    main()
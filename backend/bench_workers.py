@@ -0,0 +1,93 @@
+"""
+Multi-worker throughput benchmark
+
+Starts `server.py` with 1, 2, 4, ... up to BENCH_MAX_WORKERS workers
+(default: the CPUs available) and drives authenticated GET /expenses
+(BENCH_EXPENSES rows each) from BENCH_CLIENTS client processes for
+BENCH_SECONDS, printing requests/second and the speedup over one worker.
+Run the clients on another machine, or leave cores free for them, or the
+load generator competes with the workers it is measuring.
+
+Usage:
+    python bench_workers.py
+    BENCH_MAX_WORKERS=8 BENCH_CLIENTS=16 DATABASE_URL=postgresql://... python bench_workers.py
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from server import cpu_count
+
+MAX_WORKERS = int(os.getenv("BENCH_MAX_WORKERS", "0")) or cpu_count()
+CLIENTS = int(os.getenv("BENCH_CLIENTS", str(max(4, 2 * MAX_WORKERS))))
+SECONDS = float(os.getenv("BENCH_SECONDS", "15"))
+EXPENSES = int(os.getenv("BENCH_EXPENSES", "50"))
+PORT = int(os.getenv("BENCH_PORT", "8766"))
+BASE_URL = f"http://127.0.0.1:{PORT}"
+
+def start_server(database_url, workers):
+    env = dict(os.environ, DATABASE_URL=database_url, WEB_CONCURRENCY=str(workers),
+               BIND=f"127.0.0.1:{PORT}", RATE_LIMIT_ENABLED="0")
+    server = subprocess.Popen([sys.executable, "server.py"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(300):
+        try:
+            httpx.get(f"{BASE_URL}/docs")
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+def seed():
+    with httpx.Client(base_url=BASE_URL) as client:
+        client.post("/register", json={"email": "bench@example.com", "password": "benchpassword", "full_name": "Bench"})
+        token = client.post("/login", data={"username": "bench@example.com", "password": "benchpassword"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        for i in range(EXPENSES):
+            client.post("/expenses", json={"description": f"Expense {i}", "amount": i + 0.5, "category": "Food"}, headers=headers)
+    return token
+
+def drive(args):
+    token, stop = args
+    completed = 0
+    with httpx.Client(base_url=BASE_URL, headers={"Authorization": f"Bearer {token}"}, timeout=60) as client:
+        while time.time() < stop:
+            if client.get("/expenses").status_code == 200:
+                completed += 1
+    return completed
+
+def main():
+    counts = []
+    n = 1
+    while n < MAX_WORKERS:
+        counts.append(n)
+        n *= 2
+    counts.append(MAX_WORKERS)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = os.getenv("DATABASE_URL") or f"sqlite:///{directory}/bench.db"
+        print(f"{CLIENTS} client processes, {SECONDS:.0f}s per run, {cpu_count()} CPUs\n")
+        baseline = None
+        token = None
+        with multiprocessing.Pool(CLIENTS) as pool:
+            for workers in counts:
+                server = start_server(database_url, workers)
+                try:
+                    token = token or seed()
+                    pool.map(drive, [(token, time.time() + 1)] * CLIENTS)  # warm up every worker
+                    completed = sum(pool.map(drive, [(token, time.time() + SECONDS)] * CLIENTS))
+                finally:
+                    server.terminate()
+                    server.wait()
+                rate = completed / SECONDS
+                baseline = baseline or rate
+                print(f"{workers:>3} workers   {rate:8.1f} req/s   {rate / baseline:5.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Content-addressed blob storage for receipt attachments.
+
+Objects are keyed by the SHA-256 of their content, so the same photo
+uploaded twice is stored once. Stores share a small S3-style interface
+(head_object, put_file, touch_object, iter_object, delete_object, list_objects):
+LocalBlobStore keeps objects under BLOB_DIR, and S3BlobStore talks to any
+S3-compatible service (AWS S3, MinIO, or a local stand-in) through boto3
+when BLOB_S3_BUCKET is set.
+
+Uploads are written through a BlobWriter, which hashes and spools chunks
+to a temporary file as they arrive, so an upload is never held in memory.
+"""
+from datetime import datetime
+import hashlib
+import os
+import tempfile
+import uuid
+
+BLOB_DIR = os.getenv("BLOB_DIR", "./blobs")
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET", "")
+BLOB_S3_ENDPOINT = os.getenv("BLOB_S3_ENDPOINT", "")
+
+CHUNK_SIZE = 64 * 1024
+
+class BlobTooLarge(Exception):
+    pass
+
+class LocalBlobStore:
+    def __init__(self, root=BLOB_DIR):
+        self.root = os.path.abspath(root)
+        self.spool_dir = os.path.join(self.root, "tmp")
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def local_path(self, key: str):
+        """Filesystem path of an object, for sendfile-style serving"""
+        return os.path.join(self.root, self.relative_path(key))
+
+    def relative_path(self, key: str):
+        return os.path.join("objects", key[:2], key[2:4], key)
+
+    def head_object(self, key: str):
+        try:
+            stat = os.stat(self.local_path(key))
+        except FileNotFoundError:
+            return None
+        return {"ContentLength": stat.st_size, "LastModified": datetime.utcfromtimestamp(stat.st_mtime)}
+
+    def put_file(self, key: str, path: str):
+        """Move a spooled file into place; the spool dir is on the same filesystem"""
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    def put_object(self, key: str, body: bytes):
+        spooled = os.path.join(self.spool_dir, uuid.uuid4().hex)
+        with open(spooled, "wb") as f:
+            f.write(body)
+        self.put_file(key, spooled)
+
+    def touch_object(self, key: str):
+        """Reset an object's modification time, restarting its garbage-collection grace period"""
+        try:
+            os.utime(self.local_path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def iter_object(self, key: str, start: int = 0, length: int = None, chunk_size=CHUNK_SIZE):
+        with open(self.local_path(key), "rb") as f:
+            f.seek(start)
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete_object(self, key: str):
+        try:
+            os.unlink(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_objects(self):
+        """Yield (key, head) for every stored object"""
+        objects = os.path.join(self.root, "objects")
+        for directory, _, files in os.walk(objects):
+            for name in files:
+                head = self.head_object(name)
+                if head is not None:
+                    yield name, head
+
+class S3BlobStore:
+    def __init__(self, bucket=BLOB_S3_BUCKET, endpoint_url=BLOB_S3_ENDPOINT):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url or None
+        self.spool_dir = tempfile.gettempdir()
+        self._client = None
+
+    def __getstate__(self):
+        # boto3 clients don't pickle; thumbnail workers build their own
+        return {**self.__dict__, "_client": None}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+        return self._client
+
+    def local_path(self, key: str):
+        return None
+
+    def head_object(self, key: str):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def put_file(self, key: str, path: str):
+        try:
+            self.client.upload_file(path, self.bucket, key)
+        finally:
+            os.unlink(path)
+
+    def put_object(self, key: str, body: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def touch_object(self, key: str):
+        """Copy an object onto itself, which resets its LastModified"""
+        from botocore.exceptions import ClientError
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": key},
+                MetadataDirective="REPLACE"
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def iter_object(self, key: str, start: int = 0, length: int = None, chunk_size=CHUNK_SIZE):
+        extra = {}
+        if start or length is not None:
+            end = "" if length is None else start + length - 1
+            extra["Range"] = f"bytes={start}-{end}"
+        body = self.client.get_object(Bucket=self.bucket, Key=key, **extra)["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def delete_object(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list_objects(self):
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket):
+            for item in page.get("Contents", []):
+                yield item["Key"], {"ContentLength": item["Size"], "LastModified": item["LastModified"].replace(tzinfo=None)}
+
+def make_store():
+    return S3BlobStore() if BLOB_S3_BUCKET else LocalBlobStore()
+
+class BlobWriter:
+    """Hash and spool a streamed upload, then store it under its digest"""
+
+    def __init__(self, store, max_bytes=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._path = os.path.join(store.spool_dir, f"upload-{uuid.uuid4().hex}")
+        self._file = open(self._path, "wb")
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise BlobTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def commit(self):
+        """Store the upload and return (key, size); identical content is stored once"""
+        self._file.close()
+        key = self._hash.hexdigest()
+        # A dedup hit refreshes the existing blob so garbage collection can't remove it
+        # before the receipt referencing it commits; if it was just removed, store ours
+        if self.store.head_object(key) is not None and self.store.touch_object(key):
+            os.unlink(self._path)
+        else:
+            self.store.put_file(key, self._path)
+        return key, self.size
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
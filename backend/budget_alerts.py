@@ -0,0 +1,271 @@
+"""
+Budget threshold alerts, evaluated as expenses are written.
+
+Each budget alerts at percentages of its amount (BUDGET_ALERT_THRESHOLDS
+by default, 80 and 100). A tracker row per budget holds the month's
+running spend against it: it is computed once when the budget is created
+or changed, and from then on every expense write adds its amount change
+with one UPDATE ... RETURNING per month touched, in the write's own
+transaction. The returned total minus the change just applied is exactly
+what the total was before this write, even with concurrent writers (each
+UPDATE sees the total left by the previous one), so each crossing is seen
+by exactly one write. A threshold fires when spending goes from below it
+to at or above it, and again only after spending has dropped back below
+it. Reads never scan expenses for this.
+
+Alerts are stored as notifications (GET /notifications). Emailing them is
+a separate outbox pass, e.g. from cron:
+
+    python budget_alerts.py deliver
+    python budget_alerts.py track      # trackers for budgets created before alerts existed
+"""
+from collections import defaultdict
+from datetime import datetime
+from html import escape
+from sqlalchemy import JSON, case, delete, func, insert, literal, or_, select, update
+import os
+
+from database import engine
+from models import Budget, BudgetTracker, Expense, Notification, User
+
+BUDGET_ALERT_THRESHOLDS = [
+    float(percent) for percent in os.getenv("BUDGET_ALERT_THRESHOLDS", "80,100").split(",") if percent.strip()
+]
+BUDGET_ALERT_BATCH_SIZE = int(os.getenv("BUDGET_ALERT_BATCH_SIZE", "500"))
+
+def _limit(amount: float, percent: float):
+    return round(amount * percent / 100, 2)
+
+def _reached(thresholds, amount: float, spent: float):
+    return {percent for percent in thresholds if round(spent, 2) >= _limit(amount, percent)}
+
+def crossed(thresholds, amount: float, before: float, after: float):
+    """Thresholds that spending went from below to at or above"""
+    return sorted(_reached(thresholds, amount, after) - _reached(thresholds, amount, before))
+
+def _notification(owner_id: int, budget_id: int, category: str, year: int, month: int, amount: float,
+                  spent: float, percent: float):
+    from sharding import allocate_id
+
+    label = "All spending" if category is None else category
+    row = {
+        "owner_id": owner_id,
+        "kind": "budget_threshold",
+        "message": f"{label} for {month}/{year} has reached {percent:g}% of its budget: "
+                   f"${spent:.2f} of ${amount:.2f}",
+        "data": {"budget_id": budget_id, "year": year, "month": month, "threshold": percent,
+                 "amount": amount, "spent": round(spent, 2)},
+    }
+    new_id = allocate_id(Notification)
+    if new_id is not None:
+        row["id"] = new_id
+    return row
+
+def _notify(db, rows):
+    if rows:
+        db.execute(insert(Notification), rows)
+
+def _category_name(db, category_id):
+    from categories import category_cache
+    return None if category_id is None else category_cache.name(category_id, db)
+
+def track_budget(db, budget: Budget, thresholds=None, previous=None):
+    """Create the budget's tracker from the month's spending so far, alerting for thresholds already passed.
+
+    `previous` is what untrack_budget returned when the budget is being
+    changed; thresholds it had already reached don't alert again.
+    """
+    from crud import month_bounds
+
+    thresholds = BUDGET_ALERT_THRESHOLDS if thresholds is None else sorted(set(thresholds))
+    category_id = None if budget.category == "General" else budget.category_id
+    start, end = month_bounds(budget.month, budget.year)
+    conditions = [Expense.owner_id == budget.owner_id, Expense.date >= start, Expense.date < end]
+    if category_id is not None:
+        conditions.append(Expense.category_id == category_id)
+    spent = db.scalar(
+        insert(BudgetTracker)
+        .from_select(
+            ["budget_id", "owner_id", "year", "month", "category_id", "amount", "thresholds", "spent"],
+            select(
+                literal(budget.id), literal(budget.owner_id), literal(budget.year), literal(budget.month),
+                literal(category_id, type_=BudgetTracker.category_id.type), literal(budget.amount),
+                literal(thresholds, type_=JSON), func.coalesce(func.sum(Expense.amount), 0.0),
+            ).where(*conditions),
+        )
+        .returning(BudgetTracker.spent)
+    )
+    budget.alert_thresholds = thresholds
+
+    reached = _reached(thresholds, budget.amount, spent)
+    if previous is not None:
+        reached -= _reached(previous.thresholds, previous.amount, previous.spent)
+    _notify(db, [
+        _notification(budget.owner_id, budget.id, _category_name(db, category_id),
+                      budget.year, budget.month, budget.amount, spent, percent)
+        for percent in sorted(reached)
+    ])
+
+def untrack_budget(db, owner_id: int, budget_id: int):
+    """Drop a budget's tracker, returning its (amount, thresholds, spent) row or None"""
+    return db.execute(
+        delete(BudgetTracker)
+        .where(BudgetTracker.budget_id == budget_id, BudgetTracker.owner_id == owner_id)
+        .returning(BudgetTracker.amount, BudgetTracker.thresholds, BudgetTracker.spent)
+    ).one_or_none()
+
+def record_spending(db, changes):
+    """Apply (owner_id, date, category_id, amount change) to the trackers and alert on crossings"""
+    by_month = defaultdict(lambda: defaultdict(float))
+    for owner_id, date, category_id, delta in changes:
+        by_month[(owner_id, date.year, date.month)][category_id] += delta
+
+    notifications = []
+    for (owner_id, year, month), deltas in sorted(by_month.items()):
+        total = sum(deltas.values())
+        deltas = {category_id: delta for category_id, delta in deltas.items() if delta and category_id is not None}
+        if not deltas and not total:
+            continue
+        # General budgets (no category) take the month's net change; the rest their category's
+        change = case(
+            (BudgetTracker.category_id.is_(None), total),
+            else_=case(deltas, value=BudgetTracker.category_id, else_=0.0) if deltas else 0.0,
+        )
+        rows = db.execute(
+            update(BudgetTracker)
+            .where(
+                BudgetTracker.owner_id == owner_id, BudgetTracker.year == year, BudgetTracker.month == month,
+                or_(BudgetTracker.category_id.is_(None), BudgetTracker.category_id.in_(list(deltas))),
+            )
+            .values(spent=BudgetTracker.spent + change)
+            .returning(BudgetTracker.budget_id, BudgetTracker.category_id, BudgetTracker.amount,
+                       BudgetTracker.thresholds, BudgetTracker.spent)
+        ).all()
+        for budget_id, category_id, amount, thresholds, spent in rows:
+            before = spent - (total if category_id is None else deltas.get(category_id, 0.0))
+            for percent in crossed(thresholds, amount, before, spent):
+                notifications.append(_notification(
+                    owner_id, budget_id, _category_name(db, category_id),
+                    year, month, amount, spent, percent
+                ))
+    _notify(db, notifications)
+
+def annotate(db, owner_id: int, budgets):
+    """Set `alert_thresholds` on budget entities from their trackers"""
+    if budgets:
+        thresholds = dict(db.execute(
+            select(BudgetTracker.budget_id, BudgetTracker.thresholds).where(
+                BudgetTracker.owner_id == owner_id,
+                BudgetTracker.budget_id.in_([budget.id for budget in budgets]),
+            )
+        ).all())
+        for budget in budgets:
+            budget.alert_thresholds = thresholds.get(budget.id, [])
+    return budgets
+
+def get_notifications(db, owner_id: int, unread_only: bool = False, limit: int = 50):
+    query = select(Notification).where(Notification.owner_id == owner_id)
+    if unread_only:
+        query = query.where(Notification.read_at.is_(None))
+    return db.scalars(query.order_by(Notification.id.desc()).limit(limit)).all()
+
+def mark_read(db, owner_id: int, notification_ids=None):
+    """Mark some (or with None, all) of the user's notifications read; returns how many changed"""
+    from sharding import advance_clock
+
+    conditions = [Notification.owner_id == owner_id, Notification.read_at.is_(None)]
+    if notification_ids is not None:
+        conditions.append(Notification.id.in_(list(notification_ids)))
+    marked = db.execute(update(Notification).where(*conditions).values(read_at=datetime.utcnow())).rowcount
+    advance_clock(db, owner_id)
+    db.commit()
+    return marked
+
+def track_existing(primary=engine, router=None):
+    """Create trackers, with the default thresholds, for budgets that have none; returns how many"""
+    from sqlalchemy.orm import Session
+    import sharding
+
+    router = router or sharding.shard_router
+    binds = set(router.engines.values()) if router.enabled else {primary}
+    tracked = 0
+    for bind in binds:
+        with Session(bind=bind) as db:
+            budgets = db.scalars(
+                select(Budget).outerjoin(BudgetTracker, BudgetTracker.budget_id == Budget.id)
+                .where(BudgetTracker.budget_id.is_(None))
+            ).all()
+            for budget in budgets:
+                track_budget(db, budget)
+            db.commit()
+            tracked += len(budgets)
+    return tracked
+
+def render_notification(notification, user):
+    html = f'''
+        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+            <h2 style="color: #667eea;">Budget alert</h2>
+            <p>Hi {escape(user.full_name or "there")}, {escape(notification.message)}.</p>
+            <hr style="border: none; border-top: 1px solid #e2e8f0; margin: 30px 0;">
+            <p style="color: #718096; font-size: 12px;">
+                This is an automated email from Expense Tracker. Please do not reply to this email.
+            </p>
+        </div>
+        '''
+    return user.email, "Expense Tracker: budget alert", html
+
+def deliver(outbox=None, primary=engine, router=None, batch_size=BUDGET_ALERT_BATCH_SIZE):
+    """Email every notification not yet emailed; returns how many were queued"""
+    from email_service import EmailQueue
+    import sharding
+
+    router = router or sharding.shard_router
+    binds = set(router.engines.values()) if router.enabled else {primary}
+    own_outbox = outbox is None
+    outbox = outbox or EmailQueue()
+    queued = 0
+    try:
+        for bind in binds:
+            last_id = 0
+            while True:
+                with bind.connect() as conn:
+                    pending = conn.execute(
+                        select(Notification)
+                        .where(Notification.emailed_at.is_(None), Notification.id > last_id)
+                        .order_by(Notification.id)
+                        .limit(batch_size)
+                    ).all()
+                if not pending:
+                    break
+                with primary.connect() as conn:
+                    users = {user.id: user for user in conn.execute(
+                        select(User.id, User.email, User.full_name)
+                        .where(User.id.in_({notification.owner_id for notification in pending}))
+                    )}
+                for notification in pending:
+                    if notification.owner_id in users:
+                        outbox.put(*render_notification(notification, users[notification.owner_id]))
+                        queued += 1
+                # Marked once queued: a crash in between re-sends rather than drops an alert
+                with bind.begin() as conn:
+                    conn.execute(
+                        update(Notification)
+                        .where(Notification.id.in_([notification.id for notification in pending]))
+                        .values(emailed_at=datetime.utcnow())
+                    )
+                last_id = pending[-1].id
+    finally:
+        if own_outbox:
+            outbox.close()
+    return queued
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["deliver"]:
+        print(f"Queued {deliver()} budget alert emails")
+    elif sys.argv[1:] == ["track"]:
+        print(f"Created {track_existing()} budget trackers")
+    else:
+        print("Usage: python budget_alerts.py deliver|track")
+        sys.exit(1)
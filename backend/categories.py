@@ -0,0 +1,160 @@
+"""
+Per-user category dimension.
+
+Expenses and budgets store an integer `category_id` instead of repeating the
+category name on every row. `category_cache` is a process-level, interned
+mapping between (owner_id, name) and ids so the API layer can translate
+names without a query on the hot path. Only committed rows are cached: a
+category created in a transaction is held on the session until it commits.
+"""
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+import sys
+import threading
+import os
+
+from models import Budget, Category, Expense
+
+CATEGORY_CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", "200000"))
+
+# Session.info key for categories created in the session's current transaction
+_UNCOMMITTED = "uncommitted_categories"
+
+class CategoryCache:
+    def __init__(self, max_size=CATEGORY_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids = {}
+        self._names = {}
+        # Owners whose categories have all been loaded by warm()
+        self._warm = set()
+        self._lock = threading.Lock()
+
+    def _remember(self, owner_id, category_id, name):
+        name = sys.intern(name)
+        with self._lock:
+            if len(self._names) >= self.max_size:
+                self._ids.clear()
+                self._names.clear()
+                self._warm.clear()
+            self._ids[(owner_id, name)] = category_id
+            self._names[category_id] = name
+
+    def warm(self, db, owner_id: int):
+        """Load all of a user's categories in one query, unless they already are"""
+        if owner_id in self._warm:
+            return
+        for category_id, name in db.execute(
+            select(Category.id, Category.name).where(Category.owner_id == owner_id)
+        ):
+            self._remember(owner_id, category_id, name)
+        with self._lock:
+            self._warm.add(owner_id)
+
+    def lookup(self, db, owner_id: int, name: str):
+        """Id for an existing category name, or None"""
+        category_id = self._ids.get((owner_id, name))
+        if category_id is None:
+            category_id = db.info.get(_UNCOMMITTED, {}).get((owner_id, name))
+        if category_id is None:
+            category_id = db.execute(
+                select(Category.id).where(Category.owner_id == owner_id, Category.name == name)
+            ).scalar()
+            if category_id is not None and not _created_in(db, category_id):
+                self._remember(owner_id, category_id, name)
+        return category_id
+
+    def get_or_create(self, db, owner_id: int, name: str):
+        """Id for a category name, creating the category inside the caller's transaction"""
+        category_id = self.lookup(db, owner_id, name)
+        if category_id is not None:
+            return category_id
+
+        # Imported here to avoid a cycle: sharding imports this module's models
+        from sharding import allocate_id
+        values = {"owner_id": owner_id, "name": name}
+        new_id = allocate_id(Category)
+        if new_id is not None:
+            values["id"] = new_id
+
+        dialect = db.get_bind(mapper=inspect(Category)).dialect.name
+        if dialect == "postgresql":
+            statement = postgresql.insert(Category).on_conflict_do_nothing(index_elements=["owner_id", "name"])
+        elif dialect == "sqlite":
+            statement = sqlite.insert(Category).on_conflict_do_nothing(index_elements=["owner_id", "name"])
+        else:
+            statement = Category.__table__.insert()
+        category_id = db.execute(statement.values(**values).returning(Category.id)).scalar()
+        if category_id is None:
+            # A concurrent request created it first
+            return self.lookup(db, owner_id, name)
+        # Cached once the caller commits (see _cache_committed), so a rollback can't leave a dangling id
+        db.info.setdefault(_UNCOMMITTED, {})[(owner_id, name)] = category_id
+        return category_id
+
+    def name(self, category_id, db=None):
+        if category_id is None:
+            return None
+        name = self._names.get(category_id)
+        if name is None and db is not None:
+            row = db.execute(
+                select(Category.owner_id, Category.name).where(Category.id == category_id)
+            ).first()
+            if row is not None:
+                if not _created_in(db, category_id):
+                    self._remember(row.owner_id, category_id, row.name)
+                name = row.name
+        return name
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+            self._warm.clear()
+
+category_cache = CategoryCache()
+
+def _created_in(db, category_id):
+    return category_id in db.info.get(_UNCOMMITTED, {}).values()
+
+@event.listens_for(Session, "after_commit")
+def _cache_committed(session):
+    for (owner_id, name), category_id in session.info.pop(_UNCOMMITTED, {}).items():
+        category_cache._remember(owner_id, category_id, name)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session):
+    session.info.pop(_UNCOMMITTED, None)
+
+def migrate_category_strings(bind):
+    """Move legacy `category` string columns into the categories table"""
+    inspector = inspect(bind)
+    for model in (Expense, Budget):
+        table = model.__tablename__
+        if not inspector.has_table(table):
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table)}
+        if "category" not in columns:
+            continue
+        with bind.begin() as conn:
+            if "category_id" not in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN category_id INTEGER REFERENCES categories (id)"))
+            conn.execute(text(
+                f"INSERT INTO categories (owner_id, name) "
+                f"SELECT DISTINCT t.owner_id, t.category FROM {table} t "
+                f"WHERE t.category IS NOT NULL AND NOT EXISTS ("
+                f"SELECT 1 FROM categories c WHERE c.owner_id = t.owner_id AND c.name = t.category)"
+            ))
+            conn.execute(text(
+                f"UPDATE {table} SET category_id = ("
+                f"SELECT c.id FROM categories c "
+                f"WHERE c.owner_id = {table}.owner_id AND c.name = {table}.category)"
+            ))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_category_id ON {table} (category_id)"))
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN category"))
+
+if __name__ == "__main__":
+    from database import engine
+
+    migrate_category_strings(engine)
+    print("Categories migrated")
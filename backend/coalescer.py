@@ -0,0 +1,108 @@
+"""
+Group commit for expense creation.
+
+When WRITE_COALESCE_WINDOW_MS is set, concurrent POST /expenses calls are
+queued and a single background thread flushes them as one multi-row INSERT
+and one commit per database, either when the window closes or when
+WRITE_COALESCE_MAX_BATCH rows are waiting. Every caller gets a Future with
+its own row, or its own exception if that row could not be written.
+"""
+from concurrent.futures import Future
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+import queue
+import threading
+import time
+import os
+
+from crud import create_expenses
+from models import Expense
+
+WRITE_COALESCE_WINDOW_MS = float(os.getenv("WRITE_COALESCE_WINDOW_MS", "0"))
+WRITE_COALESCE_MAX_BATCH = int(os.getenv("WRITE_COALESCE_MAX_BATCH", "100"))
+
+class WriteCoalescer:
+    def __init__(self, window_ms=WRITE_COALESCE_WINDOW_MS, max_batch=WRITE_COALESCE_MAX_BATCH):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, db: Session, expense, user_id: int, idempotency_key=None):
+        """Queue an expense; the Future resolves to the created Expense"""
+        self._ensure_started()
+        future = Future()
+        # The request session knows which database (shard) this user's rows live in
+        bind = db.get_bind(mapper=inspect(Expense))
+        self._queue.put((bind, expense, user_id, idempotency_key, future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="write-coalescer", daemon=True)
+                    self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            by_bind = {}
+            for item in batch:
+                by_bind.setdefault(item[0], []).append(item)
+            for bind, items in by_bind.items():
+                try:
+                    self._flush(bind, items)
+                except Exception as exc:
+                    # E.g. no connection to this database: fail the batch, keep the writer running
+                    for *_, future in items:
+                        if not future.done():
+                            future.set_exception(exc)
+
+    def _flush(self, bind, items):
+        db = Session(bind=bind, autoflush=False)
+        try:
+            try:
+                created = create_expenses(
+                    db, [(expense, user_id) for _, expense, user_id, _, _ in items], [key for *_, key, _ in items]
+                )
+            except Exception:
+                db.rollback()
+                # Retry one by one so a single bad row only fails its own caller
+                for item in items:
+                    self._flush_one(db, item)
+                return
+            for (*_, future), db_expense in zip(items, created):
+                if not future.done():
+                    future.set_result(db_expense)
+        finally:
+            db.close()
+
+    def _flush_one(self, db, item):
+        _, expense, user_id, idempotency_key, future = item
+        try:
+            created = create_expenses(db, [(expense, user_id)], [idempotency_key])[0]
+        except Exception as exc:
+            db.rollback()
+            if not future.done():
+                future.set_exception(exc)
+            return
+        # A caller that went away has cancelled its future
+        if not future.done():
+            future.set_result(created)
+
+expense_coalescer = WriteCoalescer() if WRITE_COALESCE_WINDOW_MS > 0 else None
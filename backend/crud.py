@@ -1,131 +1,590 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, extract, func
-from typing import List, Optional
+from sqlalchemy import and_, delete, false, func, insert, inspect, select, text, update
+from typing import List, Optional, Tuple
+from collections import defaultdict
 from datetime import datetime
 
-from models import User, Expense, Budget
-from schemas import UserCreate, ExpenseCreate, ExpenseUpdate, BudgetCreate
+from models import User, Expense, Budget, BudgetTracker, ExpenseRollup, ChangeClock, ChangeLog, CategoryStats, Receipt
+from archive import cold_rows, cold_batches
+from categories import category_cache
+import budget_alerts
+import fieldsets
+import spending_stats
+from suggestions import suggestion_cache
+import tags
+from tags import tag_index
+from sharding import advance_clock, allocate_id
+from exporters import EXPORT_COLUMNS
+from idempotency import idempotency_store
+from schemas import UserCreate, ExpenseCreate, ExpenseUpdate, BudgetCreate, ExpenseResponse, BudgetResponse
 
-def create_user(db: Session, email: str, hashed_password: str, full_name: str):
-    db_user = User(email=email, hashed_password=hashed_password, full_name=full_name)
-    db.add(db_user)
+def _commit_returning(db: Session, obj):
+    # Detach first so commit does not expire the RETURNING values and force a re-select
+    if obj is not None:
+        db.expunge(obj)
     db.commit()
-    db.refresh(db_user)
-    return db_user
+    return obj
+
+def create_user(db: Session, email: str, hashed_password: str, full_name: str):
+    db_user = db.scalars(
+        insert(User).values(email=email, hashed_password=hashed_password, full_name=full_name).returning(User)
+    ).one()
+    return _commit_returning(db, db_user)
 
 def get_user_by_email(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
 
-def create_expense(db: Session, expense: ExpenseCreate, user_id: int):
-    db_expense = Expense(**expense.dict(), owner_id=user_id)
-    db.add(db_expense)
+def _insert_values(model, values: dict, user_id: int):
+    values = dict(values, owner_id=user_id)
+    new_id = allocate_id(model)
+    if new_id is not None:
+        values["id"] = new_id
+    return values
+
+def _resolve_category(db: Session, values: dict, user_id: int):
+    # The API speaks category names; rows store the per-user integer key
+    values = dict(values)
+    if "category" in values:
+        name = values.pop("category")
+        if name is not None:
+            values["category_id"] = category_cache.get_or_create(db, user_id, name)
+    return values
+
+def log_changes(db: Session, changes: List[Tuple[int, str, int, str]]):
+    """Append (owner_id, entity, entity_id, op) rows to the change log in one INSERT"""
+    by_owner = defaultdict(list)
+    for user_id, entity, entity_id, op in changes:
+        by_owner[user_id].append({"entity": entity, "entity_id": entity_id, "op": op})
+    rows = []
+    # Owners in order, so concurrent batches lock their clocks in the same order
+    for user_id in sorted(by_owner):
+        entries = by_owner[user_id]
+        last = advance_clock(db, user_id, len(entries))
+        for seq, entry in enumerate(entries, last - len(entries) + 1):
+            rows.append(_insert_values(ChangeLog, dict(entry, seq=seq), user_id))
+    db.execute(insert(ChangeLog), rows)
+
+def log_change(db: Session, user_id: int, entity: str, entity_id: int, op: str):
+    log_changes(db, [(user_id, entity, entity_id, op)])
+
+def create_expenses(db: Session, expenses: List[Tuple[ExpenseCreate, int]], idempotency_keys=None):
+    """Insert many (expense, user_id) pairs with one multi-row INSERT and one commit.
+
+    `idempotency_keys` (parallel to `expenses`, None where absent) get their
+    responses stored in the same commit.
+    """
+    rows = [
+        _insert_values(Expense, _resolve_category(db, expense.dict(exclude={"tags"}), user_id), user_id)
+        for expense, user_id in expenses
+    ]
+    returned = db.scalars(insert(Expense).returning(Expense), rows).all()
+    
+    # RETURNING order is not guaranteed (and asking SQLAlchemy to sort falls back
+    # to one INSERT per row on SQLite), so match rows back by their values
+    by_values = {}
+    for db_expense in returned:
+        key = (db_expense.owner_id, db_expense.description, db_expense.amount, db_expense.category_id)
+        by_values.setdefault(key, []).append(db_expense)
+    db_expenses = [
+        by_values[(row["owner_id"], row["description"], row["amount"], row["category_id"])].pop()
+        for row in rows
+    ]
+    stats = spending_stats.update_stats(db, added=[(e.owner_id, e.category_id, e.amount) for e in db_expenses])
+    spending_stats.annotate(db_expenses, stats)
+    budget_alerts.record_spending(db, [(e.owner_id, e.date, e.category_id, e.amount) for e in db_expenses])
+    for db_expense, (expense, _) in zip(db_expenses, expenses):
+        db_expense.tags = tags.normalize(expense.tags)
+    tags.tag_expenses(db, [(e.owner_id, e.id, e.tags) for e in db_expenses if e.tags])
+    log_changes(db, [(e.owner_id, "expense", e.id, "upsert") for e in db_expenses])
+    for db_expense, key in zip(db_expenses, idempotency_keys or ()):
+        if key:
+            body = ExpenseResponse.model_validate(db_expense).model_dump(mode="json")
+            idempotency_store.complete(db, db_expense.owner_id, key, body)
+    
+    for db_expense in db_expenses:
+        db.expunge(db_expense)
     db.commit()
-    db.refresh(db_expense)
-    return db_expense
+    for e in db_expenses:
+        suggestion_cache.record(e.owner_id, e.description, e.category_id, e.amount)
+    return db_expenses
+
+def create_expense(db: Session, expense: ExpenseCreate, user_id: int, idempotency_key: Optional[str] = None):
+    return create_expenses(db, [(expense, user_id)], [idempotency_key])[0]
+
+def month_bounds(month: int, year: Optional[int] = None):
+    """Return the [start, end) datetimes of a month, defaulting to the current year"""
+    year = year or datetime.now().year
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
 
-def get_expenses(db: Session, user_id: int, category: Optional[str] = None, month: Optional[int] = None):
+def expense_query(db: Session, user_id: int, category: Optional[str] = None, month: Optional[int] = None,
+                  year: Optional[int] = None, expense_ids: Optional[List[int]] = None):
     query = db.query(Expense).filter(Expense.owner_id == user_id)
     
+    if expense_ids is not None:
+        query = query.filter(tags.id_filter(Expense.id, expense_ids))
+    
     if category:
-        query = query.filter(Expense.category == category)
+        category_id = category_cache.lookup(db, user_id, category)
+        # An unknown name matches nothing (and must not turn into IS NULL)
+        query = query.filter(Expense.category_id == category_id if category_id is not None else false())
     
     if month:
-        query = query.filter(extract('month', Expense.date) == month)
+        # Plain range bounds (not extract()) let the planner prune date partitions
+        start, end = month_bounds(month, year)
+        query = query.filter(Expense.date >= start, Expense.date < end)
+    
+    return query.order_by(Expense.date.desc(), Expense.id.desc())
+
+def _annotate(db: Session, user_id: int, expenses):
+    def category_id_for(row):
+        return category_cache.lookup(db, user_id, row["category"])
+    return spending_stats.annotate(expenses, spending_stats.load_stats(db, user_id), category_id_for)
+
+def _tagged_ids(db: Session, user_id: int, all_tags=None, any_tags=None):
+    """Ids of the user's expenses matching tag filters, or None when there are none"""
+    if not all_tags and not any_tags:
+        return None
+    return tag_index.match(db, user_id, all_tags, any_tags)
+
+def _expense_fields(db: Session, user_id: int, query, fields, cold=()):
+    """Rows of an Expense query as dicts holding only `fields`, selecting just the columns behind them"""
+    rows = [dict(row._mapping) for row in query.with_entities(*fieldsets.columns_for(fields))]
+    hot_ids = {row["id"] for row in rows}
+    rows.extend(row for row in cold if row["id"] not in hot_ids)
     
-    return query.order_by(Expense.date.desc()).all()
+    if "category" in fields or "anomaly_score" in fields:
+        category_cache.warm(db, user_id)
+        for row in rows:
+            if "category_id" in row:
+                row["category"] = category_cache.name(row["category_id"], db)
+    if "anomaly_score" in fields:
+        _annotate(db, user_id, rows)
+    if "tags" in fields:
+        tag_index.annotate(db, user_id, rows)
+    return [{field: row[field] for field in fields} for row in rows]
+
+def get_expenses(db: Session, user_id: int, category: Optional[str] = None, month: Optional[int] = None,
+                 year: Optional[int] = None, fields: Optional[Tuple[str, ...]] = None,
+                 all_tags: Optional[List[str]] = None, any_tags: Optional[List[str]] = None):
+    """The user's expenses, newest first; with `fields`, as dicts of just those fields"""
+    expense_ids = _tagged_ids(db, user_id, all_tags, any_tags)
+    # Archived rows are always older than hot rows, so appending keeps date order
+    start, end = month_bounds(month, year) if month else (None, None)
+    cold = cold_rows(user_id, category, start, end, ids=expense_ids)
+    query = expense_query(db, user_id, category, month, year, expense_ids)
+    if fields is not None:
+        return _expense_fields(db, user_id, query, fields, cold)
+    
+    category_cache.warm(db, user_id)
+    expenses = query.all()
+    hot_ids = {expense.id for expense in expenses}
+    expenses.extend(row for row in cold if row["id"] not in hot_ids)
+    return tag_index.annotate(db, user_id, _annotate(db, user_id, expenses))
+
+def get_recent_expenses(db: Session, user_id: int, limit: int = 5):
+    category_cache.warm(db, user_id)
+    expenses = expense_query(db, user_id).limit(limit).all()
+    if len(expenses) < limit:
+        expenses.extend(cold_rows(user_id, limit=limit - len(expenses)))
+    return tag_index.annotate(db, user_id, _annotate(db, user_id, expenses))
+
+def get_suggestions(db: Session, user_id: int, prefix: str, limit: int = 5):
+    suggestions = suggestion_cache.suggest(db, user_id, prefix, limit)
+    for suggestion in suggestions:
+        suggestion["category"] = category_cache.name(suggestion.pop("category_id"), db)
+    return suggestions
+
+def get_anomalies(db: Session, user_id: int, limit: int = 50):
+    """Expenses at least ANOMALY_Z_THRESHOLD standard deviations above their category mean"""
+    # z >= t  <=>  (amount - mean)^2 * (count - 1) >= t^2 * m2, for amount above the mean
+    deviation = Expense.amount - CategoryStats.mean
+    rows = db.execute(
+        select(Expense, CategoryStats)
+        .join(CategoryStats, and_(
+            CategoryStats.owner_id == Expense.owner_id,
+            CategoryStats.category_id == Expense.category_id
+        ))
+        .where(
+            Expense.owner_id == user_id,
+            CategoryStats.count >= spending_stats.ANOMALY_MIN_COUNT,
+            CategoryStats.m2 > 0,
+            deviation > 0,
+            deviation * deviation * (CategoryStats.count - 1) >= spending_stats.ANOMALY_Z_THRESHOLD ** 2 * CategoryStats.m2
+        )
+        .order_by((deviation * deviation * (CategoryStats.count - 1) / CategoryStats.m2).desc())
+        .limit(limit)
+    ).all()
+    category_cache.warm(db, user_id)
+    
+    anomalies = []
+    for expense, stats in rows:
+        expense.anomaly_score = spending_stats.anomaly_score(stats, expense.amount)
+        expense.category_median = spending_stats.quantile(stats, 0.5)
+        expense.category_p95 = spending_stats.quantile(stats, 0.95)
+        anomalies.append(expense)
+    return tag_index.annotate(db, user_id, anomalies)
+
+def iter_expense_rows(db: Session, user_id: int, batch_size: int = 1000, columns: Tuple[str, ...] = EXPORT_COLUMNS):
+    """Yield the user's expenses in batches of plain row tuples, one value per column.
+
+    Uses a server-side cursor so only one batch is held in memory at a time,
+    then continues with archived rows. Only the columns behind `columns` are read.
+    """
+    selected = fieldsets.columns_for(columns)
+    position = {column.key: i for i, column in enumerate(selected)}
+    if "category" in columns:
+        category_cache.warm(db, user_id)
+    
+    def value(row, column):
+        if column == "category":
+            return category_cache.name(row[position["category_id"]], db)
+        return row[position[column]]
+    
+    query = db.query(*selected).filter(Expense.owner_id == user_id).order_by(Expense.date.desc(), Expense.id.desc())
+    result = db.execute(
+        query.statement.execution_options(stream_results=True, yield_per=batch_size)
+    )
+    hot_ids = set()
+    for partition in result.partitions(batch_size):
+        hot_ids.update(row[0] for row in partition)
+        yield [tuple(value(row, column) for column in columns) for row in partition]
+
+    for batch in cold_batches(user_id, batch_size, ("id", *columns)):
+        batch = [row[1:] for row in batch if row[0] not in hot_ids]
+        if batch:
+            yield batch
 
 def get_expense_by_id(db: Session, expense_id: int, user_id: int):
-    return db.query(Expense).filter(
+    expense = db.query(Expense).filter(
         and_(Expense.id == expense_id, Expense.owner_id == user_id)
     ).first()
+    if expense is not None:
+        _annotate(db, user_id, [expense])
+        expense.tags = tags.tag_names(db, user_id, expense_id)
+    return expense
 
 def update_expense(db: Session, expense_id: int, expense_update: ExpenseUpdate, user_id: int):
-    db_expense = get_expense_by_id(db, expense_id, user_id)
-    if not db_expense:
-        return None
+    values = _resolve_category(db, expense_update.dict(exclude_unset=True), user_id)
+    new_tags = values.pop("tags", None)
+    old = None
+    if "amount" in values or "category_id" in values:
+        # The statistics need the values being replaced
+        old = db.execute(
+            select(Expense.amount, Expense.category_id)
+            .where(Expense.id == expense_id, Expense.owner_id == user_id)
+            .with_for_update()
+        ).first()
+        if old is None:
+            return None
     
-    update_data = expense_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(db_expense, field, value)
+    # Ownership is part of the WHERE clause, so a missing or foreign row updates nothing
+    db_expense = db.scalars(
+        update(Expense)
+        .where(Expense.id == expense_id, Expense.owner_id == user_id)
+        .values(**values, version=Expense.version + 1)
+        .returning(Expense)
+    ).one_or_none()
+    if db_expense is None:
+        return None
     
-    db.commit()
-    db.refresh(db_expense)
+    if old is not None:
+        stats = spending_stats.update_stats(
+            db,
+            removed=[(user_id, old.category_id, old.amount)],
+            added=[(user_id, db_expense.category_id, db_expense.amount)]
+        )
+        budget_alerts.record_spending(db, [
+            (user_id, db_expense.date, old.category_id, -old.amount),
+            (user_id, db_expense.date, db_expense.category_id, db_expense.amount),
+        ])
+    else:
+        stats = spending_stats.load_stats(db, user_id)
+    spending_stats.annotate([db_expense], stats)
+    if new_tags is not None:
+        db_expense.tags = tags.normalize(new_tags)
+        tags.untag_expense(db, user_id, expense_id)
+        tags.tag_expenses(db, [(user_id, expense_id, db_expense.tags)])
+    else:
+        db_expense.tags = tags.tag_names(db, user_id, expense_id)
+    log_change(db, user_id, "expense", expense_id, "upsert")
+    _commit_returning(db, db_expense)
+    suggestion_cache.invalidate(user_id)
     return db_expense
 
 def delete_expense(db: Session, expense_id: int, user_id: int):
-    db_expense = get_expense_by_id(db, expense_id, user_id)
-    if db_expense:
-        db.delete(db_expense)
-        db.commit()
-        return True
-    return False
-
-def create_budget(db: Session, budget: BudgetCreate, user_id: int):
-    db_budget = Budget(**budget.dict(), owner_id=user_id)
-    db.add(db_budget)
+    deleted = db.execute(
+        delete(Expense)
+        .where(Expense.id == expense_id, Expense.owner_id == user_id)
+        .returning(Expense.amount, Expense.category_id, Expense.date)
+    ).one_or_none()
+    if deleted is None:
+        return False
+    
+    spending_stats.update_stats(db, removed=[(user_id, deleted.category_id, deleted.amount)])
+    budget_alerts.record_spending(db, [(user_id, deleted.date, deleted.category_id, -deleted.amount)])
+    # The blob itself stays until `python receipts.py gc`; other receipts may share it
+    db.execute(delete(Receipt).where(Receipt.expense_id == expense_id, Receipt.owner_id == user_id))
+    tags.untag_expense(db, user_id, expense_id)
+    log_change(db, user_id, "expense", expense_id, "delete")
+    db.commit()
+    suggestion_cache.invalidate(user_id)
+    return True
+
+def expense_exists(db: Session, expense_id: int, user_id: int):
+    return db.scalar(select(Expense.id).where(Expense.id == expense_id, Expense.owner_id == user_id)) is not None
+
+def get_receipt(db: Session, expense_id: int, user_id: int):
+    return db.query(Receipt).filter(Receipt.expense_id == expense_id, Receipt.owner_id == user_id).first()
+
+def set_receipt(db: Session, expense_id: int, user_id: int, blob_key: str, size: int, content_type: str):
+    """Attach (or replace) an expense's receipt; None if the expense doesn't exist"""
+    if not expense_exists(db, expense_id, user_id):
+        return None
+    receipt = get_receipt(db, expense_id, user_id)
+    if receipt is None:
+        receipt = Receipt(expense_id=expense_id, owner_id=user_id)
+        db.add(receipt)
+    receipt.blob_key = blob_key
+    receipt.size = size
+    receipt.content_type = content_type
+    receipt.uploaded_at = datetime.utcnow()
+    advance_clock(db, user_id)
+    db.commit()
+    return receipt
+
+def delete_receipt(db: Session, expense_id: int, user_id: int):
+    deleted = db.execute(
+        delete(Receipt).where(Receipt.expense_id == expense_id, Receipt.owner_id == user_id)
+    ).rowcount
+    advance_clock(db, user_id)
     db.commit()
-    db.refresh(db_budget)
-    return db_budget
+    return deleted > 0
+
+def create_budget(db: Session, budget: BudgetCreate, user_id: int, idempotency_key: Optional[str] = None):
+    values = _resolve_category(db, budget.dict(exclude={"alert_thresholds"}), user_id)
+    db_budget = db.scalars(insert(Budget).values(**_insert_values(Budget, values, user_id)).returning(Budget)).one()
+    budget_alerts.track_budget(db, db_budget, budget.alert_thresholds)
+    log_change(db, user_id, "budget", db_budget.id, "upsert")
+    if idempotency_key:
+        body = BudgetResponse.model_validate(db_budget).model_dump(mode="json")
+        idempotency_store.complete(db, user_id, idempotency_key, body)
+    return _commit_returning(db, db_budget)
 
 def get_budget(db: Session, user_id: int):
-    return db.query(Budget).filter(Budget.owner_id == user_id).all()
+    category_cache.warm(db, user_id)
+    return budget_alerts.annotate(db, user_id, db.query(Budget).filter(Budget.owner_id == user_id).all())
 
 def update_budget(db: Session, budget_id: int, budget_update: BudgetCreate, user_id: int):
-    db_budget = db.query(Budget).filter(
-        and_(Budget.id == budget_id, Budget.owner_id == user_id)
-    ).first()
-    
-    if not db_budget:
+    db_budget = db.scalars(
+        update(Budget)
+        .where(Budget.id == budget_id, Budget.owner_id == user_id)
+        .values(**_resolve_category(db, budget_update.dict(exclude={"alert_thresholds"}), user_id), version=Budget.version + 1)
+        .returning(Budget)
+    ).one_or_none()
+    if db_budget is None:
         return None
     
-    update_data = budget_update.dict()
-    for field, value in update_data.items():
-        setattr(db_budget, field, value)
-    
-    db.commit()
-    db.refresh(db_budget)
-    return db_budget
+    # Rebuilt, since the month, category and amount may all have changed
+    previous = budget_alerts.untrack_budget(db, user_id, budget_id)
+    thresholds = budget_update.alert_thresholds
+    if thresholds is None and previous is not None:
+        thresholds = previous.thresholds
+    budget_alerts.track_budget(db, db_budget, thresholds, previous)
+    log_change(db, user_id, "budget", budget_id, "upsert")
+    return _commit_returning(db, db_budget)
 
-def get_expense_summary(db: Session, user_id: int, month: Optional[int] = None):
-    query = db.query(Expense).filter(Expense.owner_id == user_id)
+def get_expense_summary(db: Session, user_id: int, month: Optional[int] = None, year: Optional[int] = None,
+                        all_tags: Optional[List[str]] = None, any_tags: Optional[List[str]] = None):
+    expense_ids = _tagged_ids(db, user_id, all_tags, any_tags)
+    query = db.query(
+        Expense.category_id, func.sum(Expense.amount), func.count(Expense.id)
+    ).filter(Expense.owner_id == user_id)
     
+    start, end = month_bounds(month, year) if month else (None, None)
     if month:
-        query = query.filter(extract('month', Expense.date) == month)
+        query = query.filter(Expense.date >= start, Expense.date < end)
+    if expense_ids is not None:
+        query = query.filter(tags.id_filter(Expense.id, expense_ids))
     
-    expenses = query.all()
+    # Group on the integer key and translate to names only for the result
+    totals = query.group_by(Expense.category_id).all()
+    category_cache.warm(db, user_id)
     
-    total_expenses = sum(expense.amount for expense in expenses)
-    total_count = len(expenses)
+    total_expenses = sum(total for _, total, _ in totals)
+    total_count = sum(count for _, _, count in totals)
     
     # Category breakdown
     category_breakdown = {}
-    for expense in expenses:
-        category = expense.category
-        if category in category_breakdown:
-            category_breakdown[category] += expense.amount
-        else:
-            category_breakdown[category] = expense.amount
+    for category_id, total, _ in totals:
+        category = category_cache.name(category_id, db)
+        category_breakdown[category] = category_breakdown.get(category, 0) + total
     
-    # Budget warning
-    budget_warning = None
-    if month:
-        current_year = datetime.now().year
-        budget = db.query(Budget).filter(
-            and_(
-                Budget.owner_id == user_id,
-                Budget.month == month,
-                Budget.year == current_year
+    if expense_ids is not None:
+        # Rollups don't know about tags, so filter the archived rows themselves
+        for row in cold_rows(user_id, None, start, end, ids=expense_ids):
+            total_expenses += row["amount"]
+            total_count += 1
+            category_breakdown[row["category"]] = category_breakdown.get(row["category"], 0) + row["amount"]
+    else:
+        # Archived expenses only survive as monthly rollups
+        rollups = db.query(ExpenseRollup).filter(ExpenseRollup.owner_id == user_id)
+        if month:
+            rollups = rollups.filter(
+                ExpenseRollup.year == (year or datetime.now().year),
+                ExpenseRollup.month == month
             )
-        ).first()
+        for rollup in rollups:
+            total_expenses += rollup.total
+            total_count += rollup.count
+            category_breakdown[rollup.category] = category_breakdown.get(rollup.category, 0) + rollup.total
+    
+    # Budget warning (budgets cover all spending, so not for a tag-filtered summary)
+    budget_warning = None
+    if month and expense_ids is None:
+        current_year = year or datetime.now().year
+        # The tracker already holds the month's spend against the budget, General ones first
+        tracker = db.query(BudgetTracker).filter(
+            BudgetTracker.owner_id == user_id,
+            BudgetTracker.year == current_year,
+            BudgetTracker.month == month
+        ).order_by(BudgetTracker.category_id.isnot(None), BudgetTracker.budget_id).first()
         
-        if budget and total_expenses > budget.amount:
-            budget_warning = f"Budget exceeded! You've spent ${total_expenses:.2f} out of ${budget.amount:.2f} budget for {month}/{current_year}"
+        if tracker and tracker.spent > tracker.amount:
+            budget_warning = f"Budget exceeded! You've spent ${tracker.spent:.2f} out of ${tracker.amount:.2f} budget for {month}/{current_year}"
     
     return {
         "total_expenses": total_expenses,
         "total_count": total_count,
         "month": month,
-        "year": datetime.now().year if month else None,
+        "year": (year or datetime.now().year) if month else None,
         "category_breakdown": category_breakdown,
         "budget_warning": budget_warning
     }
+
+def get_budget_status(db: Session, user_id: int, month: int, year: int):
+    """Spending against each of the month's budgets ("General" covers all categories)"""
+    budgets = db.query(Budget, BudgetTracker.spent).outerjoin(
+        BudgetTracker, BudgetTracker.budget_id == Budget.id
+    ).filter(
+        Budget.owner_id == user_id, Budget.month == month, Budget.year == year
+    ).all()
+    if not budgets:
+        return []
+    
+    category_cache.warm(db, user_id)
+    spent_by_category = None
+    if any(tracked is None for _, tracked in budgets):
+        # Budgets from before trackers (see `python budget_alerts.py track`) are summed from expenses
+        start, end = month_bounds(month, year)
+        spent_by_category = dict(
+            db.query(Expense.category_id, func.sum(Expense.amount))
+            .filter(Expense.owner_id == user_id, Expense.date >= start, Expense.date < end)
+            .group_by(Expense.category_id)
+            .all()
+        )
+    
+    status = []
+    for budget, spent in budgets:
+        if spent is None:
+            if budget.category == "General":
+                spent = sum(spent_by_category.values())
+            else:
+                spent = spent_by_category.get(budget.category_id, 0.0)
+        status.append({
+            "budget_id": budget.id,
+            "category": budget.category,
+            "amount": budget.amount,
+            "spent": spent,
+            "remaining": budget.amount - spent,
+            "exceeded": spent > budget.amount,
+        })
+    return status
+
+def sync_token(seq: int):
+    return f"s{seq}"
+
+def sync_position(db: Session, user_id: int, token: str):
+    """The change sequence number a sync token stands for; ValueError if it is malformed"""
+    if token.startswith("s"):
+        return int(token[1:])
+    # Tokens issued before per-user sequences were change log ids
+    return db.scalar(
+        select(func.max(ChangeLog.seq)).where(ChangeLog.owner_id == user_id, ChangeLog.id <= int(token))
+    ) or 0
+
+def get_changes(db: Session, user_id: int, since: int, limit: int = 1000, fields: Optional[Tuple[str, ...]] = None):
+    """Collapse the user's change log after sequence number `since` into current rows and tombstones"""
+    entries = db.query(ChangeLog).filter(
+        ChangeLog.owner_id == user_id, ChangeLog.seq > since
+    ).order_by(ChangeLog.seq).limit(limit + 1).all()
+    
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    
+    # Only the latest operation per row matters
+    latest = {}
+    for entry in entries:
+        latest[(entry.entity, entry.entity_id)] = entry.op
+    
+    def changed(entity, op):
+        return [entity_id for (kind, entity_id), last_op in latest.items() if kind == entity and last_op == op]
+    
+    category_cache.warm(db, user_id)
+    expense_ids = changed("expense", "upsert")
+    budget_ids = changed("budget", "upsert")
+    expenses = []
+    if expense_ids:
+        query = db.query(Expense).filter(Expense.owner_id == user_id, Expense.id.in_(expense_ids))
+        if fields is not None:
+            expenses = _expense_fields(db, user_id, query, fields)
+        else:
+            expenses = tag_index.annotate(db, user_id, _annotate(db, user_id, query.all()))
+    budgets = budget_alerts.annotate(db, user_id, db.query(Budget).filter(
+        Budget.owner_id == user_id, Budget.id.in_(budget_ids)
+    ).all()) if budget_ids else []
+    
+    return {
+        "token": sync_token(entries[-1].seq if entries else since),
+        "full": False,
+        "has_more": has_more,
+        "expenses": expenses,
+        "budgets": budgets,
+        "deleted_expenses": changed("expense", "delete"),
+        "deleted_budgets": changed("budget", "delete"),
+    }
+
+def get_snapshot(db: Session, user_id: int, fields: Optional[Tuple[str, ...]] = None):
+    """Full state plus a token to continue from with get_changes"""
+    # Read before the rows, so changes committed meanwhile are sent again rather than skipped
+    last_change = db.scalar(select(ChangeClock.seq).where(ChangeClock.owner_id == user_id))
+    return {
+        "token": sync_token(last_change or 0),
+        "full": True,
+        "has_more": False,
+        "expenses": get_expenses(db, user_id, fields=fields),
+        "budgets": get_budget(db, user_id),
+        "deleted_expenses": [],
+        "deleted_budgets": [],
+    }
+
+def migrate_change_log(bind):
+    """Number a change log from before per-user sequences, in id order"""
+    inspector = inspect(bind)
+    if not inspector.has_table(ChangeLog.__tablename__):
+        return
+    if "seq" in {column["name"] for column in inspector.get_columns(ChangeLog.__tablename__)}:
+        return
+    with bind.begin() as conn:
+        conn.execute(text("ALTER TABLE change_log ADD COLUMN seq INTEGER"))
+        conn.execute(text(
+            "UPDATE change_log SET seq = numbered.seq FROM ("
+            "SELECT id, row_number() OVER (PARTITION BY owner_id ORDER BY id) AS seq FROM change_log"
+            ") AS numbered WHERE change_log.id = numbered.id"
+        ))
+        conn.execute(text(
+            "INSERT INTO change_clocks (owner_id, seq, fenced) "
+            "SELECT owner_id, MAX(seq), FALSE FROM change_log GROUP BY owner_id"
+        ))
+        conn.execute(text("CREATE UNIQUE INDEX ix_change_log_owner_id_seq ON change_log (owner_id, seq)"))
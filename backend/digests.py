@@ -0,0 +1,185 @@
+"""
+Weekly and monthly spending digest emails.
+
+Active users are streamed from the primary in chunks of DIGEST_CHUNK_SIZE.
+For each chunk, period totals per category, the month's budgets and
+month-to-date spending come from a handful of GROUP BY queries per shard,
+not one summary query per user. Digests are rendered in a process pool and
+handed to a bounded email_service.EmailQueue, so memory holds one chunk at a
+time no matter how many users there are.
+
+Usage (e.g. from cron):
+    python digests.py weekly
+    python digests.py monthly 2025-07-01
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from html import escape
+from sqlalchemy import func, select
+import os
+
+from database import engine
+from email_service import EmailQueue
+from models import Budget, Category, Expense, User
+import sharding
+
+DIGEST_CHUNK_SIZE = int(os.getenv("DIGEST_CHUNK_SIZE", "1000"))
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", str(os.cpu_count() or 2)))
+
+def digest_period(kind: str, today: date):
+    """[start, end) of the last full week (Mon-Sun) or calendar month before `today`"""
+    if kind == "weekly":
+        end = today - timedelta(days=today.weekday())
+        return end - timedelta(days=7), end
+    if kind == "monthly":
+        end = today.replace(day=1)
+        return (end - timedelta(days=1)).replace(day=1), end
+    raise ValueError(f"Unknown digest kind: {kind}")
+
+def _user_chunks(primary, chunk_size):
+    last_id = 0
+    while True:
+        with primary.connect() as conn:
+            rows = conn.execute(
+                select(User.id, User.email, User.full_name, User.shard)
+                .where(User.is_active.isnot(False), User.id > last_id)
+                .order_by(User.id)
+                .limit(chunk_size)
+            ).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+def _spent_by_category(conn, user_ids, start, end):
+    return conn.execute(
+        select(Expense.owner_id, Category.name, func.sum(Expense.amount), func.count(Expense.id))
+        .join(Category, Category.id == Expense.category_id)
+        .where(Expense.owner_id.in_(user_ids), Expense.date >= start, Expense.date < end)
+        .group_by(Expense.owner_id, Category.name)
+    ).all()
+
+def collect_chunk(conn, users, start: datetime, end: datetime):
+    """Digest data for one chunk of users whose expenses live behind `conn`"""
+    user_ids = [user.id for user in users]
+    digests = {
+        user.id: {
+            "email": user.email, "name": user.full_name, "start": start, "end": end,
+            "total": 0.0, "count": 0, "categories": {}, "budgets": [],
+        }
+        for user in users
+    }
+    for owner_id, category, total, count in _spent_by_category(conn, user_ids, start, end):
+        digest = digests[owner_id]
+        digest["total"] += total
+        digest["count"] += count
+        digest["categories"][category] = total
+
+    # Budget status is for the month the period ends in, spent month to date
+    last_day = end - timedelta(days=1)
+    month_start = datetime(last_day.year, last_day.month, 1)
+    budgets = conn.execute(
+        select(Budget.owner_id, Category.name, Budget.amount)
+        .join(Category, Category.id == Budget.category_id)
+        .where(Budget.owner_id.in_(user_ids), Budget.year == last_day.year, Budget.month == last_day.month)
+    ).all()
+    if budgets:
+        if month_start == start:
+            # Monthly digests already cover the month to date
+            month_spent = {
+                (owner_id, category): total
+                for owner_id, digest in digests.items()
+                for category, total in digest["categories"].items()
+            }
+        else:
+            budget_users = list({owner_id for owner_id, _, _ in budgets})
+            month_spent = {
+                (owner_id, category): total
+                for owner_id, category, total, _ in _spent_by_category(conn, budget_users, month_start, end)
+            }
+        for owner_id, category, amount in budgets:
+            if category == "General":
+                spent = sum(total for (owner, _), total in month_spent.items() if owner == owner_id)
+            else:
+                spent = month_spent.get((owner_id, category), 0.0)
+            digests[owner_id]["budgets"].append({"category": category, "amount": amount, "spent": spent})
+
+    return [digest for digest in digests.values() if digest["count"] or digest["budgets"]]
+
+def render_digest(digest: dict):
+    """Build (to, subject, html) for one digest; runs in the worker pool"""
+    start, end = digest["start"], digest["end"] - timedelta(days=1)
+    period = f"{start:%b %d} - {end:%b %d, %Y}"
+    rows = "".join(
+        f"<tr><td>{escape(category)}</td><td style=\"text-align: right;\">${total:.2f}</td></tr>"
+        for category, total in sorted(digest["categories"].items(), key=lambda item: -item[1])
+    )
+    exceeded = ' - <strong style="color: #e53e3e;">exceeded</strong>'
+    budgets = "".join(
+        f"<li>{escape(budget['category'])}: ${budget['spent']:.2f} of ${budget['amount']:.2f}"
+        f"{exceeded if budget['spent'] > budget['amount'] else ''}</li>"
+        for budget in digest["budgets"]
+    )
+    html = f'''
+        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+            <h2 style="color: #667eea;">Your spending, {period}</h2>
+            <p>Hi {escape(digest["name"] or "there")}, you spent <strong>${digest["total"]:.2f}</strong>
+            across {digest["count"]} expense{"s" if digest["count"] != 1 else ""}.</p>
+            <table style="width: 100%; border-collapse: collapse;">{rows}</table>
+            {f"<h3>Budgets</h3><ul>{budgets}</ul>" if budgets else ""}
+            <hr style="border: none; border-top: 1px solid #e2e8f0; margin: 30px 0;">
+            <p style="color: #718096; font-size: 12px;">
+                This is an automated email from Expense Tracker. Please do not reply to this email.
+            </p>
+        </div>
+        '''
+    return digest["email"], f"Your Expense Tracker digest: {period}", html
+
+def _expense_binds(users, router, primary):
+    """Group a chunk's users by the engine that holds their expenses"""
+    if not router.enabled:
+        return {primary: users}
+    binds = {}
+    for user in users:
+        shard = user.shard or router.ring.node_for(user.id)
+        binds.setdefault(router.engines[shard], []).append(user)
+    return binds
+
+def run_digests(kind: str, today: date = None, outbox=None, primary=engine, router=None,
+                chunk_size=DIGEST_CHUNK_SIZE, workers=DIGEST_WORKERS):
+    """Queue digests for every active user; returns how many were queued"""
+    router = router or sharding.shard_router
+    start, end = digest_period(kind, today or datetime.utcnow().date())
+    start, end = datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time())
+    own_outbox = outbox is None
+    outbox = outbox or EmailQueue()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    queued = 0
+    try:
+        for users in _user_chunks(primary, chunk_size):
+            digests = []
+            for bind, bind_users in _expense_binds(users, router, primary).items():
+                with bind.connect() as conn:
+                    digests.extend(collect_chunk(conn, bind_users, start, end))
+            rendered = pool.map(render_digest, digests, chunksize=64) if pool else map(render_digest, digests)
+            for to_email, subject, html in rendered:
+                outbox.put(to_email, subject, html)
+                queued += 1
+    finally:
+        if pool:
+            pool.shutdown()
+        if own_outbox:
+            outbox.close()
+    return queued
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("weekly", "monthly"):
+        print("Usage: python digests.py weekly|monthly [YYYY-MM-DD]")
+        sys.exit(1)
+    today = date.fromisoformat(sys.argv[2]) if len(sys.argv) == 3 else None
+    started = time.perf_counter()
+    count = run_digests(sys.argv[1], today)
+    print(f"Queued {count} {sys.argv[1]} digests in {time.perf_counter() - started:.1f}s")
@@ -1,4 +1,6 @@
 import os
+import queue
+import threading
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
@@ -56,3 +58,93 @@ def send_password_reset_email(to_email: str, reset_key: str):
         print(f"[FALLBACK] Password reset key for {to_email}: {reset_key}")
         # Return True to allow the flow to continue (key is still saved in DB)
         return True
+
+# ==================== Queued delivery ====================
+# Bulk mail (digests) goes through a bounded queue drained by sender threads.
+# EMAIL_SINK=local keeps messages in memory (and in EMAIL_SINK_DIR if set)
+# instead of sending them, for tests and local runs.
+
+EMAIL_SINK = os.getenv("EMAIL_SINK", "sendgrid")
+EMAIL_SINK_DIR = os.getenv("EMAIL_SINK_DIR", "")
+EMAIL_SENDERS = int(os.getenv("EMAIL_SENDERS", "4"))
+
+class LocalSink:
+    def __init__(self, directory=EMAIL_SINK_DIR):
+        self.directory = directory
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def send(self, to_email: str, subject: str, html_content: str):
+        with self._lock:
+            self.messages.append({"to": to_email, "subject": subject, "html": html_content})
+            count = len(self.messages)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, f"{count:08d}.html"), "w") as f:
+                f.write(f"<!-- To: {to_email} | Subject: {subject} -->\n{html_content}")
+        return True
+
+class SendGridSink:
+    def __init__(self, api_key=SENDGRID_API_KEY):
+        self.client = SendGridAPIClient(api_key) if api_key else None
+
+    def send(self, to_email: str, subject: str, html_content: str):
+        if self.client is None:
+            print(f"[DEV MODE] Email to {to_email}: {subject}")
+            return True
+        message = Mail(
+            from_email=('Expense Team', FROM_EMAIL),
+            to_emails=to_email,
+            subject=subject,
+            html_content=html_content
+        )
+        try:
+            return self.client.send(message).status_code == 202
+        except Exception as e:
+            print(f"[EMAIL ERROR] Failed to send to {to_email}: {type(e).__name__}: {e}")
+            return False
+
+def make_sink():
+    return LocalSink() if EMAIL_SINK == "local" else SendGridSink()
+
+class EmailQueue:
+    """Bounded outbox; `put` blocks when senders fall behind so memory stays flat"""
+
+    def __init__(self, sink=None, senders=EMAIL_SENDERS, maxsize=1000):
+        self.sink = sink or make_sink()
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"email-sender-{i}", daemon=True)
+            for i in range(max(senders, 1))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, to_email: str, subject: str, html_content: str):
+        self._queue.put((to_email, subject, html_content))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                ok = self.sink.send(*item)
+            except Exception as e:
+                print(f"[EMAIL ERROR] Failed to send to {item[0]}: {type(e).__name__}: {e}")
+                ok = False
+            with self._lock:
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+
+    def close(self):
+        """Wait until every queued message has been handed to the sink"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,113 @@
+import csv
+import io
+import json
+import zlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
+
+# Column layout shared by every export format (matches the original CSV export)
+EXPORT_COLUMNS = ["id", "description", "amount", "category", "date"]
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "expenses.csv"),
+    "csv.gz": ("application/gzip", "expenses.csv.gz"),
+    "csv.zst": ("application/zstd", "expenses.csv.zst"),
+    "ndjson": ("application/x-ndjson", "expenses.ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "expenses.parquet"),
+}
+
+PARQUET_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("description", pa.string()),
+    ("amount", pa.float64()),
+    ("category", pa.string()),
+    ("date", pa.string()),
+])
+
+def _row_dict(row, columns=EXPORT_COLUMNS):
+    values = dict(zip(columns, row))
+    if values.get("date"):
+        values["date"] = values["date"].isoformat()
+    return values
+
+def stream_csv(batches, columns=EXPORT_COLUMNS):
+    """Yield CSV text chunks, one per batch, with a header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, lineterminator="\n")
+    writer.writeheader()
+    yield buffer.getvalue().encode()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_row_dict(row, columns) for row in batch)
+        yield buffer.getvalue().encode()
+
+def stream_ndjson(batches, columns=EXPORT_COLUMNS):
+    for batch in batches:
+        yield "".join(json.dumps(_row_dict(row, columns)) + "\n" for row in batch).encode()
+
+def stream_gzip(chunks):
+    # wbits=31 produces a gzip container instead of a raw zlib stream
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_zstd(chunks):
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to the caller"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_parquet(batches, columns=EXPORT_COLUMNS):
+    """Yield a Parquet file with one row group per batch"""
+    schema = pa.schema([PARQUET_SCHEMA.field(column) for column in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    for batch in batches:
+        rows = [_row_dict(row, columns) for row in batch]
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+def stream_export(batches, export_format: str, columns=EXPORT_COLUMNS):
+    """Return a byte-chunk generator for the given export format and columns"""
+    if export_format == "csv":
+        return stream_csv(batches, columns)
+    if export_format == "csv.gz":
+        return stream_gzip(stream_csv(batches, columns))
+    if export_format == "csv.zst":
+        return stream_zstd(stream_csv(batches, columns))
+    if export_format == "ndjson":
+        return stream_ndjson(batches, columns)
+    if export_format == "parquet":
+        return stream_parquet(batches, columns)
+    raise ValueError(f"Unsupported export format: {export_format}")
@@ -0,0 +1,60 @@
+"""
+Sparse fieldsets for expense listings.
+
+`fields=date,amount` on the list, export and sync endpoints is validated
+against the response schema, then drives both the SELECT column list and
+the serialized shape: only the columns behind the requested fields are
+read, and rows go straight to JSON as plain dicts instead of through ORM
+entities and response-model validation.
+"""
+from typing import Iterable, Optional
+
+from models import Expense
+from schemas import ExpenseResponse
+
+EXPENSE_FIELDS = tuple(ExpenseResponse.model_fields)
+
+# Expense columns each field is computed from
+FIELD_COLUMNS = {
+    "id": ("id",),
+    "description": ("description",),
+    "amount": ("amount",),
+    "category": ("category_id",),
+    "date": ("date",),
+    "owner_id": ("owner_id",),
+    "updated_at": ("updated_at",),
+    "version": ("version",),
+    "anomaly_score": ("owner_id", "category_id", "amount"),
+    "tags": ("id",),
+}
+
+DATETIME_FIELDS = {"date", "updated_at"}
+
+def parse_fields(value: Optional[str], allowed: Iterable[str] = EXPENSE_FIELDS, required: Iterable[str] = ()):
+    """Comma-separated field names as a tuple in schema order, or None for every field"""
+    if value is None:
+        return None
+    allowed = tuple(allowed)
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = sorted(names - set(allowed))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(allowed)}")
+    if not names:
+        raise ValueError(f"No fields requested. Choose from: {', '.join(allowed)}")
+    names.update(required)
+    return tuple(name for name in allowed if name in names)
+
+def columns_for(fields):
+    """Expense columns to select for `fields`; id and date are always read for ordering and merging"""
+    names = ["id", "date"]
+    for field in fields:
+        names.extend(name for name in FIELD_COLUMNS[field] if name not in names)
+    return [getattr(Expense, name) for name in names]
+
+def jsonable(rows):
+    """Make field dicts JSON-serializable in place (datetimes as ISO 8601, like the response models)"""
+    for row in rows:
+        for field in DATETIME_FIELDS.intersection(row):
+            if row[field] is not None:
+                row[field] = row[field].isoformat()
+    return rows
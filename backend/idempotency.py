@@ -0,0 +1,220 @@
+"""
+Idempotency-Key support for create endpoints.
+
+A client that sends `Idempotency-Key: <unique id>` with POST /expenses or
+POST /budgets can retry safely: the first request claims the key by
+inserting a row into `idempotency_keys` (on the user's shard) and stores
+its response there in the same transaction as the write, so a retry on any
+worker gets the stored response back, marked with `Idempotent-Replayed:
+true`, without touching the expenses or budgets tables. Completed responses
+are also kept in a per-worker LRU cache of IDEMPOTENCY_CACHE_SIZE entries,
+so most retries are answered without any query beyond authentication.
+
+Reusing a key with a different payload or endpoint is a 422; retrying while
+the first request is still running is a 409. A claim still without a
+response after IDEMPOTENCY_LEASE_SECONDS belongs to a request that died
+before its write committed, so a retry takes it over; should the first
+request commit after all, whichever completes second is rolled back and
+replays the other's response. Keys are forgotten after
+IDEMPOTENCY_TTL_SECONDS.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import hashlib
+import json
+import threading
+import time
+import os
+
+from models import IdempotencyKey
+
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "30"))
+IDEMPOTENCY_PURGE_SECONDS = 300
+MAX_KEY_LENGTH = 255
+CLAIM_ATTEMPTS = 3
+
+# Session.info key for responses stored in the session's current transaction
+_COMPLETED = "completed_idempotency_keys"
+
+class Replay(Exception):
+    """The key was completed by another request meanwhile; roll back and send `response`"""
+
+    def __init__(self, response):
+        super().__init__("Idempotency-Key already completed")
+        self.response = response
+
+def fingerprint(scope: str, payload: dict):
+    return hashlib.sha256(json.dumps([scope, payload], sort_keys=True, default=str).encode()).hexdigest()
+
+class _Entry:
+    __slots__ = ("scope", "fingerprint", "status_code", "response", "expires_at")
+
+    def __init__(self, row):
+        self.scope = row.scope
+        self.fingerprint = row.fingerprint
+        self.status_code = row.status_code
+        self.response = row.response
+        self.expires_at = row.expires_at
+
+class IdempotencyStore:
+    def __init__(self, ttl_seconds=IDEMPOTENCY_TTL_SECONDS, cache_size=IDEMPOTENCY_CACHE_SIZE,
+                 lease_seconds=IDEMPOTENCY_LEASE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self.lease_seconds = lease_seconds
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def _cached(self, user_id: int, key: str):
+        with self._lock:
+            entry = self._cache.get((user_id, key))
+            if entry is None:
+                return None
+            if entry.expires_at <= datetime.utcnow():
+                del self._cache[(user_id, key)]
+                return None
+            self._cache.move_to_end((user_id, key))
+            return entry
+
+    def _remember(self, user_id: int, key: str, entry: _Entry):
+        with self._lock:
+            self._cache[(user_id, key)] = entry
+            self._cache.move_to_end((user_id, key))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _replay(self, entry: _Entry, scope: str, request_fingerprint: str):
+        if entry.scope != scope or entry.fingerprint != request_fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if entry.status_code is None:
+            raise HTTPException(
+                status_code=409, detail="A request with this Idempotency-Key is still in progress",
+                headers={"Retry-After": "1"},
+            )
+        return JSONResponse(entry.response, status_code=entry.status_code, headers={"Idempotent-Replayed": "true"})
+
+    def _maybe_purge(self, db):
+        # Expired keys are deleted now and then from whichever shard the request is on
+        if time.monotonic() - self._purged_at >= IDEMPOTENCY_PURGE_SECONDS:
+            self._purged_at = time.monotonic()
+            db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow()))
+
+    def begin(self, db, user_id: int, key: str, scope: str, payload: dict):
+        """Claim `key` for this request, or return the stored response to replay"""
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+        request_fingerprint = fingerprint(scope, payload)
+        entry = self._cached(user_id, key)
+        if entry is not None:
+            return self._replay(entry, scope, request_fingerprint)
+
+        for _ in range(CLAIM_ATTEMPTS):
+            now = datetime.utcnow()
+            row = db.get(IdempotencyKey, (user_id, key))
+            if row is not None and row.expires_at <= now:
+                db.delete(row)
+                # Flushed on its own, or the new claim below would become an UPDATE keeping the old response
+                db.flush()
+                row = None
+            if row is None:
+                self._maybe_purge(db)
+                db.add(IdempotencyKey(
+                    owner_id=user_id, key=key, scope=scope, fingerprint=request_fingerprint, claimed_at=now,
+                    expires_at=now + timedelta(seconds=self.ttl_seconds),
+                ))
+                try:
+                    db.commit()
+                    return None
+                except IntegrityError:
+                    # Another worker claimed it first, or released or purged it again since: look again
+                    db.rollback()
+                    continue
+            if (row.status_code is None and row.scope == scope and row.fingerprint == request_fingerprint
+                    and self._lease_expired(row, now)):
+                if self._take_over(db, row, now):
+                    return None
+                continue
+            entry = _Entry(row)
+            db.expunge(row)
+            if entry.status_code is not None:
+                self._remember(user_id, key, entry)
+            return self._replay(entry, scope, request_fingerprint)
+        raise HTTPException(
+            status_code=409, detail="A request with this Idempotency-Key is still in progress",
+            headers={"Retry-After": "1"},
+        )
+
+    def _lease_expired(self, row, now: datetime):
+        # Claims from before leases existed have no claimed_at and count as expired
+        return row.claimed_at is None or row.claimed_at <= now - timedelta(seconds=self.lease_seconds)
+
+    def _take_over(self, db, row, now: datetime):
+        """Claim a key whose first request died; False when another retry got there first"""
+        claimed_at = IdempotencyKey.claimed_at
+        taken = db.execute(
+            update(IdempotencyKey)
+            .where(
+                IdempotencyKey.owner_id == row.owner_id, IdempotencyKey.key == row.key,
+                IdempotencyKey.status_code.is_(None),
+                claimed_at.is_(None) if row.claimed_at is None else claimed_at == row.claimed_at,
+            )
+            .values(claimed_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return taken == 1
+
+    def complete(self, db, user_id: int, key: str, body, status_code: int = 200):
+        """Store the response for replays in the caller's transaction, so it commits with the write.
+
+        Raises Replay when another request holding the same key completed first.
+        """
+        row = db.scalars(
+            select(IdempotencyKey)
+            .where(IdempotencyKey.owner_id == user_id, IdempotencyKey.key == key)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        ).one_or_none()
+        if row is None:
+            # Expired and purged mid-request: roll the write back and let the client retry afresh
+            raise HTTPException(
+                status_code=409, detail="A request with this Idempotency-Key is still in progress",
+                headers={"Retry-After": "1"},
+            )
+        if row.status_code is not None:
+            raise Replay(self._replay(_Entry(row), row.scope, row.fingerprint))
+        row.status_code = status_code
+        row.response = body
+        # Cached by _cache_completed once the caller commits
+        db.info.setdefault(_COMPLETED, []).append((user_id, key, _Entry(row)))
+
+    def abort(self, db, user_id: int, key: str):
+        """Release the key after a failed request so the client can retry"""
+        db.rollback()
+        db.execute(delete(IdempotencyKey).where(
+            IdempotencyKey.owner_id == user_id, IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+        ))
+        db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+idempotency_store = IdempotencyStore()
+
+@event.listens_for(Session, "after_commit")
+def _cache_completed(session):
+    for user_id, key, entry in session.info.pop(_COMPLETED, ()):
+        idempotency_store._remember(user_id, key, entry)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_completed(session):
+    session.info.pop(_COMPLETED, None)
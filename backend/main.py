@@ -1,36 +1,73 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from typing import List, Optional
-import pandas as pd
-import io
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
 
-from database import SessionLocal, engine, get_db
-from models import Base, User, Expense, Budget, PasswordReset
+from database import SessionLocal, add_columns, engine, get_db, get_read_db, mark_write
+from models import Base, User, Expense, Budget, IdempotencyKey, PasswordReset, ReportJob
 from email_service import send_password_reset_email
+from exporters import EXPORT_COLUMNS, EXPORT_FORMATS, stream_export
+from fieldsets import jsonable, parse_fields
+from sharding import shard_router, route_session
+import coalescer
+from profiling import ProfilingMiddleware, profiler
+from revocation import revocations
+from ratelimit import rate_limiter
+from idempotency import Replay, idempotency_store
+from partitioning import maintain as maintain_partitions, partition_maintainer
+from categories import migrate_category_strings
+from password_resets import ensure_indexes as ensure_reset_indexes, invalidate_outstanding, reset_purger, retire
+import receipts
+import reports
 import secrets
+import budget_alerts
+import splits
+from tags import parse_tags, tag_index
 import string
 from schemas import (
     UserCreate, UserResponse, UserLogin, UserUpdate, PasswordChange,
-    ExpenseCreate, ExpenseUpdate, ExpenseResponse,
-    BudgetCreate, BudgetResponse, ExpenseSummary,
-    PasswordResetRequest, PasswordResetVerify
+    ExpenseCreate, ExpenseUpdate, ExpenseResponse, AnomalyResponse, Suggestion,
+    BudgetCreate, BudgetResponse, ExpenseSummary, SyncResponse, DashboardResponse,
+    ProfileCreate, ProfileStatus, ReceiptResponse, ReportJobCreate, ReportJobResponse, TagCount, NotificationResponse,
+    SplitGroupCreate, SplitGroupMemberAdd, SplitGroupResponse, SharedExpenseCreate, SettlementCreate,
+    SharedExpenseResponse, GroupBalances, Transfer, PasswordResetRequest, PasswordResetVerify
 )
 from auth import (
-    create_access_token, verify_token, get_password_hash, 
-    verify_password, get_current_user
+    create_access_token, verify_token, decode_token, revoke_user_tokens, get_password_hash, 
+    verify_password, get_current_user, get_current_reader, require_admin
 )
 from crud import (
     create_user, get_user_by_email, create_expense, get_expenses,
     update_expense, delete_expense, get_expense_by_id,
-    create_budget, get_budget, update_budget, get_expense_summary
+    create_budget, get_budget, update_budget, get_expense_summary,
+    iter_expense_rows, get_changes, get_snapshot, sync_position, migrate_change_log,
+    get_recent_expenses, get_budget_status, get_anomalies, get_suggestions,
+    expense_exists, get_receipt, set_receipt, delete_receipt
 )
 
-# Create database tables
+# Create database tables (the partitioned expenses table first, when enabled)
+maintain_partitions(engine)
 Base.metadata.create_all(bind=engine)
+# Shard placement columns for a users table created before sharding
+add_columns(engine, User, {"shard": None, "shard_locked": "FALSE"})
+shard_router.create_tables()
+for bind in {engine, *shard_router.engines.values()}:
+    migrate_category_strings(bind)
+    # Row versions for sync and optimistic updates on tables from before them
+    for model in (Expense, Budget):
+        add_columns(bind, model, {"updated_at": None, "version": "1"})
+    # Claim leases for an idempotency_keys table from before them
+    add_columns(bind, IdempotencyKey, {"claimed_at": None})
+    migrate_change_log(bind)
+ensure_reset_indexes(engine)
+reports.ensure_indexes(engine)
 
 app = FastAPI(title="Expense Tracker API", version="1.0.0")
 
@@ -45,6 +82,21 @@ app.add_middleware(
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Runs independent dashboard queries side by side, each on its own pooled connection
+dashboard_pool = ThreadPoolExecutor(max_workers=int(os.getenv("DASHBOARD_WORKERS", "8")))
+
+@app.middleware("http")
+async def track_writes(request: Request, call_next):
+    response = await call_next(request)
+    # Keep a client on the primary for a short while after it writes
+    # Register and login carry no token yet, but the cookie still covers the client's next reads
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        mark_write(request.headers.get("authorization"), response)
+    return response
+
+# Added last so it is outermost and profiled timings include the other middleware
+app.add_middleware(ProfilingMiddleware)
+
 # Authentication endpoints
 @app.post("/register", response_model=UserResponse)
 def register(user: UserCreate, db: Session = Depends(get_db)):
@@ -60,7 +112,9 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
     return db_user
 
 @app.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # Before the lookup and bcrypt, so a flood of guesses costs almost nothing
+    rate_limiter.enforce("login", request, form_data.username)
     user = get_user_by_email(db, email=form_data.username)
     if not user or not verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
@@ -72,67 +126,140 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     access_token = create_access_token(data={"sub": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/logout")
+def logout(
+    token: str = Depends(oauth2_scheme),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    payload = decode_token(token, HTTPException(status_code=401, detail="Could not validate credentials"))
+    revocations.revoke_token(db, payload, token)
+    return {"message": "Logged out successfully"}
+
 # Expense endpoints
 @app.post("/expenses", response_model=ExpenseResponse)
-def add_expense(
+async def add_expense(
     expense: ExpenseCreate,
+    idempotency_key: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_expense = create_expense(db, expense, current_user.id)
+    partition_maintainer.maybe_maintain()
+    if idempotency_key:
+        replay = await run_in_threadpool(
+            idempotency_store.begin, db, current_user.id, idempotency_key, "expenses", expense.model_dump(mode="json")
+        )
+        if replay is not None:
+            return replay
+    try:
+        if coalescer.expense_coalescer:
+            # Group commit: wait for the batch holding this row without tying up a thread
+            db_expense = await asyncio.wrap_future(
+                coalescer.expense_coalescer.submit(db, expense, current_user.id, idempotency_key)
+            )
+        else:
+            db_expense = await run_in_threadpool(create_expense, db, expense, current_user.id, idempotency_key)
+    except Replay as replay:
+        await run_in_threadpool(db.rollback)
+        return replay.response
+    except BaseException:
+        if idempotency_key:
+            await run_in_threadpool(idempotency_store.abort, db, current_user.id, idempotency_key)
+        raise
+    if idempotency_key:
+        # The same body was stored for replays in the expense's own transaction
+        return JSONResponse(ExpenseResponse.model_validate(db_expense).model_dump(mode="json"))
     return db_expense
 
+def _requested_fields(fields: Optional[str], **kwargs):
+    try:
+        return parse_fields(fields, **kwargs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/expenses", response_model=List[ExpenseResponse])
 def get_user_expenses(
     category: Optional[str] = None,
-    month: Optional[int] = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    month: Optional[int] = Query(None, ge=1, le=12),
+    year: Optional[int] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated ExpenseResponse fields to return"),
+    tags: Optional[str] = Query(None, description="Comma-separated tags the expenses must all have"),
+    any_tags: Optional[str] = Query(None, description="Comma-separated tags the expenses must have at least one of"),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
 ):
-    expenses = get_expenses(db, current_user.id, category, month)
+    requested = _requested_fields(fields)
+    expenses = get_expenses(db, current_user.id, category, month, year, fields=requested,
+                            all_tags=parse_tags(tags), any_tags=parse_tags(any_tags))
+    if requested is not None:
+        # Plain dicts of just those fields; nothing to validate against the full model
+        return JSONResponse(jsonable(expenses))
     return expenses
 
 @app.get("/expenses/summary", response_model=ExpenseSummary)
 def get_expense_summary_endpoint(
-    month: Optional[int] = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    month: Optional[int] = Query(None, ge=1, le=12),
+    year: Optional[int] = None,
+    tags: Optional[str] = Query(None, description="Comma-separated tags the expenses must all have"),
+    any_tags: Optional[str] = Query(None, description="Comma-separated tags the expenses must have at least one of"),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
 ):
-    summary = get_expense_summary(db, current_user.id, month)
+    summary = get_expense_summary(db, current_user.id, month, year, parse_tags(tags), parse_tags(any_tags))
     return summary
 
-@app.get("/expenses/export/csv")
-def export_expenses_csv(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+@app.get("/expenses/suggest", response_model=List[Suggestion])
+def suggest_expenses(
+    prefix: str = Query(..., min_length=1),
+    limit: int = Query(5, ge=1, le=20),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
 ):
-    expenses = get_expenses(db, current_user.id)
-    
-    # Create DataFrame
-    df = pd.DataFrame([{
-        'id': exp.id,
-        'description': exp.description,
-        'amount': exp.amount,
-        'category': exp.category,
-        'date': exp.date.isoformat()
-    } for exp in expenses])
+    return get_suggestions(db, current_user.id, prefix, limit)
+
+@app.get("/expenses/anomalies", response_model=List[AnomalyResponse])
+def get_expense_anomalies(
+    limit: int = Query(50, ge=1, le=500),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    return get_anomalies(db, current_user.id, limit)
+
+@app.get("/expenses/export")
+def export_expenses(
+    format: str = "csv",
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db),
+    fields: Optional[str] = None
+):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported export format. Choose one of: {', '.join(EXPORT_FORMATS)}"
+        )
+    columns = _requested_fields(fields, allowed=EXPORT_COLUMNS) or EXPORT_COLUMNS
     
-    # Create CSV in memory
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
+    media_type, filename = EXPORT_FORMATS[format]
+    batches = iter_expense_rows(db, current_user.id, columns=columns)
     
     return StreamingResponse(
-        io.BytesIO(output.getvalue().encode()),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=expenses.csv"}
+        stream_export(batches, format, columns),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
+@app.get("/expenses/export/csv")
+def export_expenses_csv(
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    return export_expenses("csv", current_user, db)
+
 @app.get("/expenses/{expense_id}", response_model=ExpenseResponse)
 def get_expense(
     expense_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
 ):
     expense = get_expense_by_id(db, expense_id, current_user.id)
     if not expense:
@@ -146,11 +273,9 @@ def update_expense_endpoint(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    expense = get_expense_by_id(db, expense_id, current_user.id)
-    if not expense:
-        raise HTTPException(status_code=404, detail="Expense not found")
-    
     updated_expense = update_expense(db, expense_id, expense_update, current_user.id)
+    if not updated_expense:
+        raise HTTPException(status_code=404, detail="Expense not found")
     return updated_expense
 
 @app.delete("/expenses/{expense_id}")
@@ -159,27 +284,114 @@ def delete_expense_endpoint(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    expense = get_expense_by_id(db, expense_id, current_user.id)
-    if not expense:
+    if not delete_expense(db, expense_id, current_user.id):
         raise HTTPException(status_code=404, detail="Expense not found")
-    
-    delete_expense(db, expense_id, current_user.id)
     return {"message": "Expense deleted successfully"}
 
+# Receipt endpoints
+@app.put("/expenses/{expense_id}/receipt", response_model=ReceiptResponse)
+async def upload_receipt(
+    expense_id: int,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Attach a receipt; the raw file is the request body, typed by Content-Type"""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in receipts.RECEIPT_TYPES:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported receipt type. Choose one of: {', '.join(sorted(receipts.RECEIPT_TYPES))}"
+        )
+    if int(request.headers.get("content-length") or 0) > receipts.RECEIPT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Receipt is too large")
+    # Check before reading the body so a bad id doesn't cost an upload
+    if not await run_in_threadpool(expense_exists, db, expense_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Expense not found")
+    
+    store = receipts.blob_store
+    try:
+        blob_key, size = await receipts.save_upload(request.stream(), store, receipts.RECEIPT_MAX_BYTES)
+    except receipts.BlobTooLarge:
+        raise HTTPException(status_code=413, detail="Receipt is too large")
+    
+    receipt = await run_in_threadpool(set_receipt, db, expense_id, current_user.id, blob_key, size, content_type)
+    if receipt is None:
+        raise HTTPException(status_code=404, detail="Expense not found")
+    if content_type.startswith("image/"):
+        receipts.schedule_thumbnail(store, blob_key)
+    return receipt
+
+@app.get("/expenses/{expense_id}/receipt")
+def download_receipt(
+    expense_id: int,
+    request: Request,
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    receipt = get_receipt(db, expense_id, current_user.id)
+    if not receipt:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    try:
+        return receipts.BlobResponse(receipts.blob_store, receipt.blob_key, receipt.content_type, request.headers)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+
+@app.get("/expenses/{expense_id}/receipt/thumbnail")
+def download_receipt_thumbnail(
+    expense_id: int,
+    request: Request,
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    receipt = get_receipt(db, expense_id, current_user.id)
+    if not receipt:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    try:
+        return receipts.BlobResponse(
+            receipts.blob_store, receipts.thumbnail_key(receipt.blob_key), "image/jpeg", request.headers
+        )
+    except FileNotFoundError:
+        # PDFs have none, and images get theirs shortly after upload
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+
+@app.delete("/expenses/{expense_id}/receipt")
+def delete_receipt_endpoint(
+    expense_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not delete_receipt(db, expense_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    return {"message": "Receipt deleted successfully"}
+
 # Budget endpoints
 @app.post("/budgets", response_model=BudgetResponse)
 def create_budget_endpoint(
     budget: BudgetCreate,
+    idempotency_key: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    db_budget = create_budget(db, budget, current_user.id)
-    return db_budget
+    if not idempotency_key:
+        return create_budget(db, budget, current_user.id)
+    replay = idempotency_store.begin(db, current_user.id, idempotency_key, "budgets", budget.model_dump(mode="json"))
+    if replay is not None:
+        return replay
+    try:
+        db_budget = create_budget(db, budget, current_user.id, idempotency_key)
+    except Replay as replay:
+        db.rollback()
+        return replay.response
+    except BaseException:
+        idempotency_store.abort(db, current_user.id, idempotency_key)
+        raise
+    return JSONResponse(BudgetResponse.model_validate(db_budget).model_dump(mode="json"))
 
 @app.get("/budgets", response_model=List[BudgetResponse])
 def get_user_budgets(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
 ):
     budgets = get_budget(db, current_user.id)
     return budgets
@@ -196,9 +408,306 @@ def update_budget_endpoint(
         raise HTTPException(status_code=404, detail="Budget not found")
     return budget
 
+# Notification endpoints
+@app.get("/notifications", response_model=List[NotificationResponse])
+def get_notifications(
+    unread_only: bool = False,
+    limit: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    """Budget alerts and other notices, newest first"""
+    return budget_alerts.get_notifications(db, current_user.id, unread_only, limit)
+
+@app.post("/notifications/{notification_id}/read")
+def mark_notification_read(
+    notification_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not budget_alerts.mark_read(db, current_user.id, [notification_id]):
+        raise HTTPException(status_code=404, detail="Unread notification not found")
+    return {"message": "Notification marked as read"}
+
+@app.post("/notifications/read")
+def mark_all_notifications_read(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return {"marked": budget_alerts.mark_read(db, current_user.id)}
+
+# Dashboard endpoint
+def _query_in_own_session(db: Session, user: User, query, *args):
+    # Same engine and shard as the request session, but a separate connection
+    own_db = Session(bind=db.get_bind(), autoflush=False)
+    try:
+        route_session(own_db, user, writable=False)
+        return query(own_db, user.id, *args)
+    finally:
+        own_db.close()
+
+@app.get("/tags", response_model=List[TagCount])
+def get_tags(
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    return tag_index.counts(db, current_user.id)
+
+@app.get("/dashboard", response_model=DashboardResponse)
+def get_dashboard(
+    limit: int = Query(5, ge=1, le=50),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    """Summary, recent expenses and this month's budget status in one round trip"""
+    now = datetime.now()
+    summary = dashboard_pool.submit(_query_in_own_session, db, current_user, get_expense_summary)
+    recent = dashboard_pool.submit(_query_in_own_session, db, current_user, get_recent_expenses, limit)
+    budgets = dashboard_pool.submit(
+        _query_in_own_session, db, current_user, get_budget_status, now.month, now.year
+    )
+    
+    return {
+        "summary": summary.result(),
+        "recent_expenses": recent.result(),
+        "budget_status": budgets.result(),
+    }
+
+# Sync endpoint
+@app.get("/sync", response_model=SyncResponse)
+def sync(
+    since: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    fields: Optional[str] = Query(None, description="Comma-separated expense fields to return (id is always included)"),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    """Return rows changed since a previous sync token (full state without one)"""
+    # Clients merge changes by id, so it is always part of a sparse fieldset
+    requested = _requested_fields(fields, required=("id",))
+    if not since:
+        result = get_snapshot(db, current_user.id, requested)
+    else:
+        try:
+            position = sync_position(db, current_user.id, since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+        result = get_changes(db, current_user.id, position, limit, requested)
+    
+    if requested is not None:
+        return JSONResponse({
+            **result,
+            "expenses": jsonable(result["expenses"]),
+            "budgets": [BudgetResponse.model_validate(budget).model_dump(mode="json") for budget in result["budgets"]],
+        })
+    return result
+
+# Report endpoints
+def _report_job_response(job: ReportJob):
+    return ReportJobResponse(
+        id=job.id, status=job.status, format=job.params["format"], year=job.params["year"],
+        month=job.params.get("month"), error=job.error, size=job.size, created_at=job.created_at,
+        finished_at=job.finished_at, expires_at=job.expires_at,
+        download_url=f"/reports/jobs/{job.id}/download" if job.status == "done" else None,
+    )
+
+def _get_report_job(db: Session, job_id: int, user_id: int):
+    job = db.get(ReportJob, job_id)
+    if not job or job.owner_id != user_id:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return job
+
+@app.post("/reports/jobs", response_model=ReportJobResponse, status_code=202)
+def create_report_job(
+    report_request: ReportJobCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Queue a report, or return the job already building (or holding) the same one"""
+    params = report_request.model_dump()
+    job_hash = reports.params_hash(params, reports.data_version(db, current_user.id))
+    job = reports.report_runner.find(db, current_user.id, job_hash)
+    if job is None:
+        if reports.report_runner.active_count(db, current_user.id) >= reports.REPORT_MAX_ACTIVE:
+            raise HTTPException(
+                status_code=429, detail="Too many reports in progress, please wait for one to finish",
+                headers={"Retry-After": "5"},
+            )
+        job, created = reports.report_runner.create(db, current_user.id, params, job_hash)
+        if created:
+            reports.report_runner.submit(job.id)
+    return _report_job_response(job)
+
+@app.get("/reports/jobs/{job_id}", response_model=ReportJobResponse)
+def get_report_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # The primary, not a replica: clients poll this right after creating the job
+    return _report_job_response(_get_report_job(db, job_id, current_user.id))
+
+@app.get("/reports/jobs/{job_id}/download")
+def download_report(
+    job_id: int,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    job = _get_report_job(db, job_id, current_user.id)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Report is {job.status}")
+    try:
+        if job.expires_at <= datetime.utcnow():
+            raise FileNotFoundError(job.result_key)
+        return receipts.BlobResponse(
+            reports.report_store, job.result_key, reports.REPORT_FORMATS[job.params["format"]],
+            request.headers, filename=reports.report_filename(job)
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=410, detail="Report has expired, please request it again")
+
+# Split endpoints
+def _group_response(group, members):
+    return SplitGroupResponse(
+        id=group.id, name=group.name, created_by=group.created_by, created_at=group.created_at,
+        members=[{"id": user.id, "email": user.email, "full_name": user.full_name} for user in members],
+    )
+
+def _shared_expense_response(expense, shares):
+    return SharedExpenseResponse(
+        id=expense.id, group_id=expense.group_id, description=expense.description,
+        amount=splits.from_cents(expense.amount_cents), paid_by=expense.paid_by, created_by=expense.created_by,
+        is_settlement=expense.is_settlement, date=expense.date,
+        shares=[{"user_id": user_id, "amount": splits.from_cents(cents)} for user_id, cents in sorted(shares.items())],
+    )
+
+def _get_group(db: Session, group_id: int, user_id: int):
+    group = splits.get_group(db, group_id, user_id)
+    if group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return group
+
+@app.post("/groups", response_model=SplitGroupResponse)
+def create_split_group(
+    group: SplitGroupCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        db_group = splits.create_group(db, current_user.id, group.name, group.member_emails)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _group_response(db_group, splits.group_members(db, [db_group.id])[db_group.id])
+
+@app.get("/groups", response_model=List[SplitGroupResponse])
+def get_split_groups(
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    groups = splits.get_groups(db, current_user.id)
+    members = splits.group_members(db, [group.id for group in groups])
+    return [_group_response(group, members[group.id]) for group in groups]
+
+@app.post("/groups/{group_id}/members", response_model=SplitGroupResponse)
+def add_split_group_member(
+    group_id: int,
+    member: SplitGroupMemberAdd,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    group = _get_group(db, group_id, current_user.id)
+    try:
+        splits.add_member(db, group, member.email)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _group_response(group, splits.group_members(db, [group.id])[group.id])
+
+@app.post("/groups/{group_id}/expenses", response_model=SharedExpenseResponse)
+def add_shared_expense(
+    group_id: int,
+    expense: SharedExpenseCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    _get_group(db, group_id, current_user.id)
+    shares = [(share.user_id, share.amount) for share in expense.shares] if expense.shares else None
+    try:
+        db_expense, shares = splits.add_shared_expense(
+            db, group_id, current_user.id, expense.description, expense.amount, paid_by=expense.paid_by,
+            shares=shares, split_between=expense.split_between, date=expense.date,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _shared_expense_response(db_expense, shares)
+
+@app.get("/groups/{group_id}/expenses", response_model=List[SharedExpenseResponse])
+def get_shared_expenses(
+    group_id: int,
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    _get_group(db, group_id, current_user.id)
+    return [_shared_expense_response(expense, shares) for expense, shares in splits.get_shared_expenses(db, group_id, limit)]
+
+@app.delete("/groups/{group_id}/expenses/{expense_id}")
+def delete_shared_expense(
+    group_id: int,
+    expense_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    _get_group(db, group_id, current_user.id)
+    if not splits.delete_shared_expense(db, group_id, expense_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Shared expense not found")
+    return {"message": "Shared expense deleted successfully"}
+
+@app.post("/groups/{group_id}/settlements", response_model=SharedExpenseResponse)
+def record_settlement(
+    group_id: int,
+    settlement: SettlementCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    _get_group(db, group_id, current_user.id)
+    try:
+        db_expense, shares = splits.settle(db, group_id, current_user.id, settlement.to_user, settlement.amount)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _shared_expense_response(db_expense, shares)
+
+def _transfers(debts):
+    return [{"from_user": debtor, "to_user": creditor, "amount": splits.from_cents(cents)} for debtor, creditor, cents in debts]
+
+@app.get("/groups/{group_id}/balances", response_model=GroupBalances)
+def get_group_balances(
+    group_id: int,
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    """Each member's net position and the pairwise debts behind it, read from the ledger"""
+    _get_group(db, group_id, current_user.id)
+    debts = splits.pairwise_debts(db, group_id)
+    net = splits.net_balances(debts, splits.member_ids(db, group_id))
+    return {
+        "members": [{"user_id": user_id, "balance": splits.from_cents(cents)} for user_id, cents in sorted(net.items())],
+        "debts": _transfers(debts),
+    }
+
+@app.get("/groups/{group_id}/settle-up", response_model=List[Transfer])
+def get_settle_up_plan(
+    group_id: int,
+    current_user: User = Depends(get_current_reader),
+    db: Session = Depends(get_read_db)
+):
+    """The fewest payments, by greedy matching, that clear every balance in the group"""
+    _get_group(db, group_id, current_user.id)
+    return _transfers(splits.settle_up(splits.net_balances(splits.pairwise_debts(db, group_id))))
+
 # User Profile endpoints
 @app.get("/users/profile", response_model=UserResponse)
-def get_user_profile(current_user: User = Depends(get_current_user)):
+def get_user_profile(current_user: User = Depends(get_current_reader)):
     return current_user
 
 @app.put("/users/profile", response_model=UserResponse)
@@ -234,6 +743,7 @@ def change_password(
     
     current_user.hashed_password = get_password_hash(password_data.new_password)
     db.commit()
+    revoke_user_tokens(db, current_user.email)
     
     return {"message": "Password changed successfully"}
 
@@ -246,14 +756,19 @@ def generate_reset_key(length=6):
 @app.post("/password-reset/request")
 def request_password_reset(
     reset_request: PasswordResetRequest,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """Request a password reset - sends email with reset key"""
+    rate_limiter.enforce("reset_request", request, reset_request.email)
     user = get_user_by_email(db, reset_request.email)
     if not user:
         # Don't reveal if email exists or not for security
         return {"message": "If the email exists, a reset key has been sent"}
     
+    # Only the newest key works; older outstanding ones are retired
+    invalidate_outstanding(db, reset_request.email)
+    
     # Generate unique reset key
     reset_key = generate_reset_key()
     
@@ -267,6 +782,7 @@ def request_password_reset(
     
     db.add(password_reset)
     db.commit()
+    reset_purger.maybe_purge()
     
     # Send email with reset key (also prints to console as fallback)
     send_password_reset_email(reset_request.email, reset_key)
@@ -276,9 +792,12 @@ def request_password_reset(
 @app.post("/password-reset/verify")
 def verify_and_reset_password(
     reset_data: PasswordResetVerify,
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """Verify reset key and update password"""
+    # Limits key guessing per email, whichever addresses the guesses come from
+    rate_limiter.enforce("reset_verify", request, reset_data.email)
     
     # Find the reset request
     reset_request = db.query(PasswordReset).filter(
@@ -313,12 +832,53 @@ def verify_and_reset_password(
         raise HTTPException(status_code=404, detail="User not found")
     
     user.hashed_password = get_password_hash(reset_data.new_password)
-    reset_request.is_used = True
+    retire(reset_request)
     
     db.commit()
+    revoke_user_tokens(db, user.email)
     
     return {"message": "Password has been reset successfully"}
 
+# Admin endpoints
+@app.post("/admin/profiles", response_model=ProfileStatus, dependencies=[Depends(require_admin)])
+def start_profile(profile: ProfileCreate, db: Session = Depends(get_db)):
+    if profiler.workers > 1:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Profiles are kept per worker and this server runs {profiler.workers}; profile with WEB_CONCURRENCY=1",
+        )
+    email = None
+    if profile.user_id is not None:
+        user = db.get(User, profile.user_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        email = user.email
+    session = profiler.start(profile.route, email, profile.user_id, profile.requests)
+    return session.status()
+
+@app.get("/admin/profiles", response_model=List[ProfileStatus], dependencies=[Depends(require_admin)])
+def list_profiles():
+    return [session.status() for session in list(profiler.sessions.values())]
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str, format: str = "json"):
+    session = profiler.sessions.get(profile_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return PlainTextResponse(session.collapsed())
+    if format == "speedscope":
+        return session.speedscope()
+    if format != "json":
+        raise HTTPException(status_code=400, detail="Unsupported format. Choose one of: json, collapsed, speedscope")
+    return session.summary()
+
+@app.delete("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def stop_profile(profile_id: str):
+    if not profiler.stop(profile_id):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return {"message": "Profile deleted"}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
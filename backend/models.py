@@ -1,8 +1,38 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Index, JSON, UniqueConstraint, text
+from sqlalchemy.orm import object_session, relationship
 from database import Base
 from datetime import datetime
 
+def _category_name(row):
+    # Names are resolved through the process-wide category cache (categories.py)
+    from categories import category_cache
+    return category_cache.name(row.category_id, object_session(row))
+
+class Category(Base):
+    __tablename__ = "categories"
+    __table_args__ = (UniqueConstraint("owner_id", "name"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    name = Column(String, nullable=False)
+
+class Tag(Base):
+    __tablename__ = "tags"
+    __table_args__ = (UniqueConstraint("owner_id", "name"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    name = Column(String, nullable=False)
+
+class ExpenseTag(Base):
+    __tablename__ = "expense_tags"
+    __table_args__ = (Index("ix_expense_tags_owner_id_expense_id", "owner_id", "expense_id"),)
+    
+    # No foreign key to expenses, which may be a partitioned table (see Receipt)
+    expense_id = Column(Integer, primary_key=True)
+    tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+
 class User(Base):
     __tablename__ = "users"
     
@@ -12,6 +42,9 @@ class User(Base):
     full_name = Column(String)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Shard holding this user's expenses and budgets (None until sharding is enabled)
+    shard = Column(String, nullable=True)
+    shard_locked = Column(Boolean, default=False)
     
     expenses = relationship("Expense", back_populates="owner")
     budgets = relationship("Budget", back_populates="owner")
@@ -22,11 +55,21 @@ class Expense(Base):
     id = Column(Integer, primary_key=True, index=True)
     description = Column(String, index=True)
     amount = Column(Float)
-    category = Column(String, default="Other")
+    category_id = Column(Integer, ForeignKey("categories.id"), index=True)
     date = Column(DateTime, default=datetime.utcnow)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(Integer, default=1, nullable=False)
     
     owner = relationship("User", back_populates="expenses")
+    
+    # Filled in by spending_stats.annotate and tags.tag_index.annotate; not stored
+    anomaly_score = None
+    tags = ()
+    
+    @property
+    def category(self):
+        return _category_name(self)
 
 class Budget(Base):
     __tablename__ = "budgets"
@@ -35,18 +78,236 @@ class Budget(Base):
     month = Column(Integer)
     year = Column(Integer)
     amount = Column(Float)
-    category = Column(String, default="General")
+    category_id = Column(Integer, ForeignKey("categories.id"), index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(Integer, default=1, nullable=False)
     
     owner = relationship("User", back_populates="budgets")
+    
+    # Filled in from the budget's tracker by budget_alerts.annotate; not stored here
+    alert_thresholds = ()
+    
+    @property
+    def category(self):
+        return _category_name(self)
+
+class BudgetTracker(Base):
+    __tablename__ = "budget_trackers"
+    __table_args__ = (Index("ix_budget_trackers_owner_id_year_month", "owner_id", "year", "month"),)
+    
+    # Running spend against one budget, kept current by every expense write (budget_alerts.py)
+    budget_id = Column(Integer, ForeignKey("budgets.id"), primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    # None for a "General" budget, which covers every category
+    category_id = Column(Integer, nullable=True)
+    amount = Column(Float, nullable=False)
+    # Percentages of amount to alert at
+    thresholds = Column(JSON, nullable=False)
+    spent = Column(Float, default=0.0, nullable=False)
+
+class Notification(Base):
+    __tablename__ = "notifications"
+    __table_args__ = (
+        Index("ix_notifications_owner_id_id", "owner_id", "id"),
+        # Only notifications still to be emailed are scanned by the delivery job
+        Index(
+            "ix_notifications_pending", "id",
+            postgresql_where=text("emailed_at IS NULL"), sqlite_where=text("emailed_at IS NULL")
+        ),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    kind = Column(String, nullable=False)
+    message = Column(String, nullable=False)
+    data = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    read_at = Column(DateTime, nullable=True)
+    emailed_at = Column(DateTime, nullable=True)
+
+class Receipt(Base):
+    __tablename__ = "receipts"
+    
+    # One attachment per expense; no FK because partitioned expenses have a composite key
+    expense_id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # SHA-256 of the content, the key in the blob store (shared by identical uploads)
+    blob_key = Column(String, nullable=False, index=True)
+    content_type = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    uploaded_at = Column(DateTime, default=datetime.utcnow)
 
 class PasswordReset(Base):
     __tablename__ = "password_resets"
+    __table_args__ = (
+        # Only outstanding keys are ever looked up; the predicates match how
+        # each dialect renders `is_used == False` so the planner can use it
+        Index(
+            "ix_password_resets_outstanding", "email", "reset_key",
+            postgresql_where=text("NOT is_used"), sqlite_where=text("is_used = 0")
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, index=True)
+    email = Column(String)
     reset_key = Column(String, unique=True, index=True)
     is_used = Column(Boolean, default=False)
-    expires_at = Column(DateTime)
+    # Set to the time of use when a key is used or superseded, so purging only checks this
+    expires_at = Column(DateTime, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+class ReportJob(Base):
+    __tablename__ = "report_jobs"
+    __table_args__ = (
+        Index("ix_report_jobs_owner_id_params_hash", "owner_id", "params_hash"),
+        # At most one queued or running job per report, however many identical requests race
+        Index(
+            "ix_report_jobs_active", "owner_id", "params_hash", unique=True,
+            postgresql_where=text("status IN ('queued', 'running')"),
+            sqlite_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+    # Background report renders (reports.py); kept on the primary so any worker can answer status polls
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    params = Column(JSON, nullable=False)
+    # Parameters plus the owner's change sequence number, for deduplication
+    params_hash = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued")
+    error = Column(String, nullable=True)
+    result_key = Column(String, nullable=True)
+    size = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True, index=True)
+
+class SplitGroup(Base):
+    __tablename__ = "split_groups"
+    
+    # Households and trips sharing expenses (splits.py). Groups span users on
+    # different shards, so all split tables stay on the primary
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class SplitGroupMember(Base):
+    __tablename__ = "split_group_members"
+    
+    group_id = Column(Integer, ForeignKey("split_groups.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True, index=True)
+    joined_at = Column(DateTime, default=datetime.utcnow)
+
+class SharedExpense(Base):
+    __tablename__ = "shared_expenses"
+    __table_args__ = (Index("ix_shared_expenses_group_id_date", "group_id", "date"),)
+    
+    # Split amounts are integer cents so the ledger always adds up exactly
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey("split_groups.id"), nullable=False)
+    description = Column(String, nullable=False)
+    amount_cents = Column(Integer, nullable=False)
+    paid_by = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # A payment between two members, recorded as an expense the payer covers for the payee
+    is_settlement = Column(Boolean, default=False, nullable=False)
+    date = Column(DateTime, default=datetime.utcnow)
+
+class ExpenseShare(Base):
+    __tablename__ = "expense_shares"
+    
+    shared_expense_id = Column(Integer, ForeignKey("shared_expenses.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    amount_cents = Column(Integer, nullable=False)
+
+class GroupBalance(Base):
+    __tablename__ = "group_balances"
+    
+    # Pairwise ledger with user_id < other_id: positive means user_id owes other_id
+    group_id = Column(Integer, ForeignKey("split_groups.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    other_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    amount_cents = Column(Integer, default=0, nullable=False)
+
+class ExpenseRollup(Base):
+    __tablename__ = "expense_rollups"
+    
+    # Monthly per-category totals for expenses moved to the cold archive
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    category = Column(String, primary_key=True)
+    total = Column(Float, default=0.0)
+    count = Column(Integer, default=0)
+
+class CategoryStats(Base):
+    __tablename__ = "category_stats"
+    
+    # Running Welford statistics and a log-bucket quantile sketch per category
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    category_id = Column(Integer, ForeignKey("categories.id"), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+    mean = Column(Float, default=0.0, nullable=False)
+    m2 = Column(Float, default=0.0, nullable=False)
+    sketch = Column(JSON, default=dict, nullable=False)
+
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    __table_args__ = (
+        Index("ix_change_log_owner_id_id", "owner_id", "id"),
+        Index("ix_change_log_owner_id_seq", "owner_id", "seq", unique=True),
+    )
+    
+    # One row per write; deletes stay here as tombstones for /sync clients
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # Position in the owner's change sequence (ChangeClock), which sync tokens refer to
+    seq = Column(Integer, nullable=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ChangeClock(Base):
+    __tablename__ = "change_clocks"
+    
+    # Last change sequence number handed out per owner. Writes advance it under
+    # its row lock, so an owner's sequence numbers commit in order, which
+    # global ids from per-process id blocks do not
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    seq = Column(Integer, default=0, nullable=False)
+    # Set on the source shard while the owner is being moved (sharding.move_user)
+    fenced = Column(Boolean, default=False, nullable=False)
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+    
+    # "jti:<id>" for a single token, "user:<email>" for every token issued before not_before
+    key = Column(String, primary_key=True)
+    not_before = Column(Float, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    # Client-chosen Idempotency-Key per user; status_code is NULL while the first request is in flight
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    key = Column(String, primary_key=True)
+    scope = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSON, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class IdBlock(Base):
+    __tablename__ = "id_blocks"
+    
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
@@ -0,0 +1,207 @@
+"""
+Range partitioning of the expenses table by date (PostgreSQL only).
+
+When EXPENSE_PARTITIONING is "month" or "year", the expenses table is
+created as a declaratively partitioned table and partitions are created
+ahead of time, at startup and then every EXPENSE_PARTITION_MAINTAIN_SECONDS
+as expenses are written (or from cron with `python partitioning.py
+maintain`). Rows dated past the last partition land in the DEFAULT
+partition; when their period's partition is created they are moved into
+it, with the default partition detached meanwhile since PostgreSQL won't
+create a partition whose rows already sit in the default. Old partitions
+can be detached into the archive schema so vacuum and index maintenance
+only touch recent data. On SQLite, or when partitioning is off, the plain
+table from models.py is used unchanged.
+"""
+from sqlalchemy import MetaData, PrimaryKeyConstraint, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+from datetime import date, datetime
+import threading
+import time
+import os
+
+from database import Base, engine
+from models import Expense
+
+EXPENSE_PARTITIONING = os.getenv("EXPENSE_PARTITIONING", "")
+PARTITIONS_AHEAD = int(os.getenv("EXPENSE_PARTITIONS_AHEAD", "3"))
+PARTITION_MAINTAIN_SECONDS = float(os.getenv("EXPENSE_PARTITION_MAINTAIN_SECONDS", "86400"))
+DEFAULT_PARTITION = f"{Expense.__tablename__}_default"
+ARCHIVE_SCHEMA = "expense_archive"
+
+def is_enabled(bind):
+    return EXPENSE_PARTITIONING in ("month", "year") and bind.dialect.name == "postgresql"
+
+def partitioned_table_ddl(include_foreign_keys=True):
+    """Build CREATE TABLE/INDEX statements for the partitioned expenses table"""
+    metadata = MetaData()
+    Base.metadata.tables["users"].to_metadata(metadata)
+    Base.metadata.tables["categories"].to_metadata(metadata)
+    table = Expense.__table__.to_metadata(metadata)
+    # The partition key has to be part of every unique constraint
+    table.c.id.autoincrement = True
+    table.c.date.primary_key = True
+    table.append_constraint(PrimaryKeyConstraint(table.c.id, table.c.date))
+    table.dialect_options["postgresql"]["partition_by"] = "RANGE (date)"
+
+    dialect = postgresql.dialect()
+    foreign_keys = None if include_foreign_keys else []
+    statements = [str(CreateTable(table, include_foreign_key_constraints=foreign_keys).compile(dialect=dialect))]
+    statements += [str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes]
+    return statements
+
+def create_partitioned_table(bind, include_foreign_keys=True):
+    """Create the partitioned expenses table if partitioning is enabled and it is missing"""
+    if not is_enabled(bind) or inspect(bind).has_table(Expense.__tablename__):
+        return False
+    if include_foreign_keys:
+        Base.metadata.tables["users"].create(bind, checkfirst=True)
+        Base.metadata.tables["categories"].create(bind, checkfirst=True)
+    with bind.begin() as conn:
+        for statement in partitioned_table_ddl(include_foreign_keys):
+            conn.execute(text(statement))
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+            f"PARTITION OF {Expense.__tablename__} DEFAULT"
+        ))
+    return True
+
+def _next_period(start: date, granularity: str):
+    if granularity == "year":
+        return date(start.year + 1, 1, 1)
+    if start.month == 12:
+        return date(start.year + 1, 1, 1)
+    return date(start.year, start.month + 1, 1)
+
+def _period_start(day: date, granularity: str):
+    return date(day.year, 1, 1) if granularity == "year" else date(day.year, day.month, 1)
+
+def partition_name(start: date, granularity: str):
+    if granularity == "year":
+        return f"{Expense.__tablename__}_y{start.year}"
+    return f"{Expense.__tablename__}_y{start.year}m{start.month:02d}"
+
+def partition_bounds(start: date, end: date, granularity: str):
+    """List (name, lower, upper) for every period overlapping [start, end]"""
+    periods = []
+    lower = _period_start(start, granularity)
+    while lower <= end:
+        upper = _next_period(lower, granularity)
+        periods.append((partition_name(lower, granularity), lower, upper))
+        lower = upper
+    return periods
+
+def new_partition_ddl(name: str, lower: date, upper: date, from_default=False):
+    """Statements creating a partition, moving its rows out of the default partition if `from_default`"""
+    table = Expense.__tablename__
+    create = (
+        f"CREATE TABLE {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+    )
+    if not from_default:
+        return [create]
+    in_range = f"date >= '{lower.isoformat()}' AND date < '{upper.isoformat()}'"
+    return [
+        f"ALTER TABLE {table} DETACH PARTITION {DEFAULT_PARTITION}",
+        create,
+        f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE {in_range}",
+        f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}",
+        f"ALTER TABLE {table} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT",
+    ]
+
+def create_future_partitions(bind, today: date = None, ahead: int = PARTITIONS_AHEAD):
+    """Create partitions from the current period through `ahead` periods out"""
+    if not is_enabled(bind):
+        return []
+    granularity = EXPENSE_PARTITIONING
+    today = today or datetime.utcnow().date()
+    end = today
+    for _ in range(ahead):
+        end = _next_period(_period_start(end, granularity), granularity)
+
+    created = []
+    existing = set(inspect(bind).get_table_names())
+    with bind.begin() as conn:
+        for name, lower, upper in partition_bounds(today, end, granularity):
+            if name in existing:
+                continue
+            from_default = conn.scalar(text(
+                f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= :lower AND date < :upper)"
+            ), {"lower": lower, "upper": upper})
+            for statement in new_partition_ddl(name, lower, upper, from_default):
+                conn.execute(text(statement))
+            created.append(name)
+    return created
+
+def archive_partitions(bind, older_than: date):
+    """Detach partitions that end before `older_than` and move them to the archive schema"""
+    if not is_enabled(bind):
+        return []
+    with bind.begin() as conn:
+        rows = conn.execute(text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :parent"
+        ), {"parent": Expense.__tablename__}).all()
+
+        archived = []
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+        for name, bound in rows:
+            # bound looks like: FOR VALUES FROM ('2024-01-01 00:00:00') TO ('2024-02-01 00:00:00')
+            if "TO ('" not in bound:
+                continue
+            upper = datetime.fromisoformat(bound.split("TO ('")[1].split("'")[0]).date()
+            if upper <= older_than:
+                conn.execute(text(f"ALTER TABLE {Expense.__tablename__} DETACH PARTITION {name}"))
+                conn.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+                archived.append(name)
+    return archived
+
+def maintain(bind=engine, include_foreign_keys=True):
+    create_partitioned_table(bind, include_foreign_keys)
+    return create_future_partitions(bind)
+
+class PartitionMaintainer:
+    def __init__(self, bind=engine, interval_seconds=PARTITION_MAINTAIN_SECONDS):
+        self.bind = bind
+        self.interval_seconds = interval_seconds
+        self._last_run = time.monotonic()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def maybe_maintain(self):
+        """Create upcoming partitions in the background if the last run is older than the interval"""
+        if not is_enabled(self.bind):
+            return None
+        with self._lock:
+            if self._thread is not None or time.monotonic() - self._last_run < self.interval_seconds:
+                return None
+            self._last_run = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="partition-maintain", daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def _run(self):
+        try:
+            create_future_partitions(self.bind)
+        except Exception as e:
+            print(f"[PARTITIONING] Maintenance failed: {e}")
+        finally:
+            with self._lock:
+                self._thread = None
+
+# Startup runs maintain() itself, so the first background run is one interval later
+partition_maintainer = PartitionMaintainer()
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) == 3 and sys.argv[1] == "archive":
+        print(f"Archived: {archive_partitions(engine, date.fromisoformat(sys.argv[2]))}")
+    elif len(sys.argv) == 2 and sys.argv[1] == "maintain":
+        print(f"Created: {maintain()}")
+    else:
+        print("Usage: python partitioning.py maintain | archive <YYYY-MM-DD>")
@@ -0,0 +1,93 @@
+"""
+Password reset key lifecycle.
+
+Issuing a key invalidates the email's older outstanding keys, and using a
+key retires it. Retired keys get expires_at = now, so "expired" is the only
+condition the purge has to look for: `purge_expired` deletes expired rows
+in batches of PASSWORD_RESET_PURGE_BATCH, each in its own short transaction,
+so it never holds long locks. It runs in a background thread at most every
+PASSWORD_RESET_PURGE_SECONDS, triggered by reset requests, or from cron with
+`python password_resets.py`.
+
+Outstanding keys are looked up through a partial index on
+(email, reset_key) WHERE NOT is_used, which stays small however much
+history the table has seen. `ensure_indexes` adds it to existing databases.
+"""
+from sqlalchemy import delete, select, update
+from datetime import datetime
+import threading
+import time
+import os
+
+from database import engine
+from models import PasswordReset
+
+PASSWORD_RESET_PURGE_SECONDS = float(os.getenv("PASSWORD_RESET_PURGE_SECONDS", "3600"))
+PASSWORD_RESET_PURGE_BATCH = int(os.getenv("PASSWORD_RESET_PURGE_BATCH", "1000"))
+
+def ensure_indexes(bind):
+    """Create indexes added after the table was (create_all skips existing tables)"""
+    for index in PasswordReset.__table__.indexes:
+        index.create(bind, checkfirst=True)
+
+def invalidate_outstanding(db, email: str, now: datetime = None):
+    """Retire every unused key for `email`; the caller commits"""
+    return db.execute(
+        update(PasswordReset)
+        .where(PasswordReset.email == email, PasswordReset.is_used == False)
+        .values(is_used=True, expires_at=now or datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+def retire(reset: PasswordReset, now: datetime = None):
+    reset.is_used = True
+    reset.expires_at = now or datetime.utcnow()
+
+def purge_expired(bind=engine, now: datetime = None, batch_size: int = PASSWORD_RESET_PURGE_BATCH):
+    """Delete expired (and so also used) keys in batches; returns how many were deleted"""
+    now = now or datetime.utcnow()
+    deleted = 0
+    while True:
+        with bind.begin() as conn:
+            ids = conn.scalars(
+                select(PasswordReset.id).where(PasswordReset.expires_at < now).limit(batch_size)
+            ).all()
+            if ids:
+                conn.execute(delete(PasswordReset).where(PasswordReset.id.in_(ids)))
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            return deleted
+
+class ResetPurger:
+    def __init__(self, bind=engine, interval_seconds=PASSWORD_RESET_PURGE_SECONDS):
+        self.bind = bind
+        self.interval_seconds = interval_seconds
+        self._last_run = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def maybe_purge(self):
+        """Start a background purge if the last one is older than the interval"""
+        with self._lock:
+            if self._thread is not None or time.monotonic() - self._last_run < self.interval_seconds:
+                return None
+            self._last_run = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="reset-purge", daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def _run(self):
+        try:
+            purge_expired(self.bind)
+        except Exception as e:
+            print(f"[PASSWORD RESET] Purge failed: {e}")
+        finally:
+            with self._lock:
+                self._thread = None
+
+reset_purger = ResetPurger()
+
+if __name__ == "__main__":
+    ensure_indexes(engine)
+    started = time.perf_counter()
+    print(f"Deleted {purge_expired()} expired password reset keys in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,307 @@
+"""
+On-demand request profiling.
+
+An admin arms a profile for a route and/or user for the next N matching
+requests. While one of those requests is in flight, a sampler thread
+records the Python stacks of the threads serving it, and its SQL
+statements are timed through engine events. The event loop and worker
+threads are shared between requests, so each thread is tied to a frame
+that belongs to the request (the middleware call that matched it, or the
+outermost application frame of a worker thread issuing its SQL) and is
+sampled only while that frame is on its stack. Results are served as collapsed stacks (flamegraph.pl, speedscope)
+or a speedscope JSON profile.
+
+Nothing is hooked while no profile is armed: the ASGI middleware only
+checks a flag, and the sampler thread and SQL listeners exist only while
+profiles are active.
+"""
+from collections import Counter
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from jose import JWTError, jwt
+import secrets
+import sys
+import threading
+import time
+import os
+
+from auth import ALGORITHM, SECRET_KEY
+
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SESSIONS = int(os.getenv("PROFILE_MAX_SESSIONS", "20"))
+PROFILE_MAX_STATEMENTS = 10000
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_current = ContextVar("profile_session", default=None)
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class ProfileSession:
+    def __init__(self, route=None, email=None, user_id=None, requests=1):
+        self.id = secrets.token_hex(8)
+        self.route = route
+        self.email = email
+        self.user_id = user_id
+        self.requested = requests
+        self.remaining = requests
+        self.in_flight = 0
+        self.created_at = time.time()
+        self.stacks = Counter()
+        self.statements = []
+        self.requests = []
+        self.anchors = {}
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.remaining == 0 and self.in_flight == 0
+
+    def matches(self, path, email):
+        if self.route and path != self.route:
+            return False
+        return not self.email or email == self.email
+
+    def claim(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            self.in_flight += 1
+            return True
+
+    def finish(self, method, path, status, duration):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests.append({"method": method, "path": path, "status": status, "duration_ms": duration * 1000})
+
+    def add_statement(self, statement, duration):
+        with self._lock:
+            if len(self.statements) < PROFILE_MAX_STATEMENTS:
+                self.statements.append({"statement": " ".join(statement.split())[:500], "duration_ms": duration * 1000})
+
+    def track_thread(self, thread_id, frame):
+        """Sample `thread_id` whenever `frame`, which runs this request's code, is on its stack"""
+        if frame is None:
+            return
+        with self._lock:
+            self.anchors.setdefault(thread_id, set()).add(frame)
+
+    def tracked_threads(self):
+        with self._lock:
+            return [(thread_id, set(frames)) for thread_id, frames in self.anchors.items()]
+
+    def untrack_threads(self):
+        # Drops the frame references, and whatever locals they keep alive
+        with self._lock:
+            self.anchors.clear()
+
+    def add_stacks(self, stacks):
+        with self._lock:
+            self.stacks.update(stacks)
+
+    def status(self):
+        return {
+            "id": self.id,
+            "route": self.route,
+            "user_id": self.user_id,
+            "requests": self.requested,
+            "completed": len(self.requests),
+            "done": self.done,
+            "samples": sum(self.stacks.values()),
+        }
+
+    def summary(self):
+        slowest = sorted(self.statements, key=lambda s: s["duration_ms"], reverse=True)
+        return {
+            **self.status(),
+            "request_log": self.requests,
+            "sql_count": len(self.statements),
+            "sql_ms": sum(s["duration_ms"] for s in self.statements),
+            "slowest_sql": slowest[:20],
+            "top_stacks": [{"stack": stack, "samples": count} for stack, count in self.stacks.most_common(20)],
+        }
+
+    def collapsed(self):
+        """Brendan Gregg's folded format: "root;child;leaf count" per line"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def speedscope(self, interval_ms=PROFILE_INTERVAL_MS):
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, count in self.stacks.items():
+            sample = []
+            for name in stack.split(";"):
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({"name": name})
+                sample.append(index[name])
+            samples.append(sample)
+            weights.append(count * interval_ms)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"profile {self.id}",
+            "exporter": "expense-tracker",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.route or f"user {self.user_id}",
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+class Profiler:
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000.0
+        self.sessions = {}
+        # Set by server.py; sessions are per process, so several workers can't share one
+        self.workers = 1
+        self.armed = False
+        self._active = set()
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._listening = False
+
+    def start(self, route=None, email=None, user_id=None, requests=1):
+        session = ProfileSession(route, email, user_id, requests)
+        with self._lock:
+            if len(self.sessions) >= PROFILE_MAX_SESSIONS:
+                # Forget the oldest finished profile
+                finished = [s for s in self.sessions.values() if s.done]
+                if finished:
+                    del self.sessions[min(finished, key=lambda s: s.created_at).id]
+            self.sessions[session.id] = session
+            self._update_hooks()
+        return session
+
+    def stop(self, session_id):
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+            self._update_hooks()
+        return session
+
+    def _update_hooks(self):
+        # Called with the lock held
+        self.armed = any(s.remaining > 0 for s in self.sessions.values())
+        wants_sql = self.armed or bool(self._active)
+        if wants_sql and not self._listening:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            self._listening = True
+        elif not wants_sql and self._listening:
+            event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+            self._listening = False
+
+    def _claim(self, path, email):
+        with self._lock:
+            for session in self.sessions.values():
+                if session.remaining > 0 and session.matches(path, email) and session.claim():
+                    # The middleware call is this request's own frame on the shared event loop thread
+                    session.track_thread(threading.get_ident(), sys._getframe(1))
+                    self._active.add(session)
+                    if self._sampler is None:
+                        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                        self._sampler.start()
+                    return session
+        return None
+
+    def _release(self, session):
+        session.untrack_threads()
+        with self._lock:
+            self._active.discard(session)
+            self._update_hooks()
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                active = list(self._active)
+                if not active:
+                    self._sampler = None
+                    return
+            frames = sys._current_frames()
+            for session in active:
+                stacks = Counter()
+                for thread_id, anchors in session.tracked_threads():
+                    frame = frames.get(thread_id)
+                    names, in_app, serving = [], False, False
+                    while frame is not None:
+                        code = frame.f_code
+                        in_app = in_app or (code.co_filename.startswith(APP_DIR) and code.co_filename != __file__)
+                        serving = serving or frame in anchors
+                        names.append(_frame_name(code))
+                        frame = frame.f_back
+                    # Skip threads busy with another request, and the bare event loop
+                    if in_app and serving:
+                        stacks[";".join(reversed(names))] += 1
+                session.add_stacks(stacks)
+            time.sleep(self.interval)
+
+profiler = Profiler()
+
+def _outermost_app_frame():
+    """The endpoint (or streamed body generator) frame at the bottom of this thread's application code"""
+    frame, outermost = sys._getframe(1), None
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(APP_DIR) and frame.f_code.co_filename != __file__:
+            outermost = frame
+        frame = frame.f_back
+    return outermost
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    session = _current.get()
+    if session is not None:
+        # Sync endpoints and streamed bodies run in worker threads, which carry the request's context
+        session.track_thread(threading.get_ident(), _outermost_app_frame())
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    session = _current.get()
+    if session is not None and conn.info.get("profile_started"):
+        session.add_statement(statement, time.perf_counter() - conn.info["profile_started"].pop())
+
+def _token_email(scope):
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            token = value.decode("latin-1").partition(" ")[2]
+            try:
+                return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+            except JWTError:
+                return None
+    return None
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware so the unarmed path is a single flag check"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not profiler.armed or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        session = profiler._claim(scope["path"], _token_email(scope))
+        if session is None:
+            return await self.app(scope, receive, send)
+
+        status = {}
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        token = _current.set(session)
+        started = time.perf_counter()
+        try:
+            # Includes streaming the body, so exports are timed end to end
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            session.finish(scope["method"], scope["path"], status.get("code"), time.perf_counter() - started)
+            profiler._release(session)
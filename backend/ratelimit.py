@@ -0,0 +1,179 @@
+"""
+Token-bucket rate limiting for login and password reset.
+
+Each protected action has a bucket per client IP and per email. A bucket
+holds up to `capacity` attempts and refills continuously at capacity/period,
+so "10/300" allows a burst of 10 and then one attempt every 30 seconds.
+Checks run at the top of the endpoint, before any database query or bcrypt
+work, and a rejected request gets 429 with Retry-After.
+
+Buckets live in an in-process store split into RATE_LIMIT_SHARDS
+independently locked dicts, so concurrent requests rarely contend. With
+several workers or hosts, set RATE_LIMIT_BACKEND=redis (needs the `redis`
+package) to share buckets through RATE_LIMIT_REDIS_URL; the refill-and-take
+step then runs as one Lua script so it stays atomic.
+
+Client IPs come from the ASGI scope; behind a proxy, run uvicorn with
+--proxy-headers so X-Forwarded-For is honoured.
+"""
+from fastapi import HTTPException, Request, status
+from typing import NamedTuple
+import math
+import threading
+import time
+import os
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+class Rate(NamedTuple):
+    capacity: float
+    period: float
+
+    @property
+    def refill_per_second(self):
+        return self.capacity / self.period
+
+def parse_rate(value: str):
+    """"10/300" -> burst of 10 attempts, refilled over 300 seconds"""
+    capacity, _, period = value.partition("/")
+    return Rate(float(capacity), float(period))
+
+def _rate(name: str, default: str):
+    return parse_rate(os.getenv(name, default))
+
+RULES = {
+    "login": {
+        "ip": _rate("RATE_LIMIT_LOGIN_IP", "20/60"),
+        "email": _rate("RATE_LIMIT_LOGIN_EMAIL", "10/300"),
+    },
+    "reset_request": {
+        "ip": _rate("RATE_LIMIT_RESET_REQUEST_IP", "5/300"),
+        "email": _rate("RATE_LIMIT_RESET_REQUEST_EMAIL", "3/3600"),
+    },
+    # A 6-character key has 36^6 values; 5 guesses per 15 minutes makes guessing hopeless
+    "reset_verify": {
+        "ip": _rate("RATE_LIMIT_RESET_VERIFY_IP", "10/300"),
+        "email": _rate("RATE_LIMIT_RESET_VERIFY_EMAIL", "5/900"),
+    },
+}
+
+class MemoryStore:
+    """Buckets in this process, sharded across independently locked dicts"""
+
+    def __init__(self, shards=RATE_LIMIT_SHARDS, max_keys=RATE_LIMIT_MAX_KEYS):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.max_keys_per_shard = max(1, max_keys // shards)
+
+    def take(self, key: str, rate: Rate, now: float):
+        """Take one token; returns 0 if allowed, else seconds until one is available"""
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        refill = rate.refill_per_second
+        with lock:
+            tokens, updated, _ = buckets.get(key, (rate.capacity, now, now))
+            tokens = min(rate.capacity, tokens + (now - updated) * refill)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / refill
+            # Also remember when the bucket will be full again, for pruning
+            buckets[key] = (tokens, now, now + (rate.capacity - tokens) / refill)
+            if len(buckets) > self.max_keys_per_shard:
+                self._prune(buckets, now)
+        return wait
+
+    def _prune(self, buckets, now: float):
+        # Called with the shard lock held. Refilled buckets are indistinguishable
+        # from new ones, so dropping them is free; if that is not enough, drop
+        # the buckets closest to full.
+        for key in [key for key, (_, _, full_at) in buckets.items() if full_at <= now]:
+            del buckets[key]
+        excess = len(buckets) - self.max_keys_per_shard
+        if excess > 0:
+            for key in sorted(buckets, key=lambda key: buckets[key][2])[:excess]:
+                del buckets[key]
+
+    def clear(self):
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
+
+class RedisStore:
+    """Buckets shared by every worker through Redis"""
+
+    _SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local refill = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * refill)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / refill
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill))
+    return tostring(wait)
+    """
+
+    def __init__(self, url=RATE_LIMIT_REDIS_URL, prefix="ratelimit:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(self._SCRIPT)
+
+    def take(self, key: str, rate: Rate, now: float):
+        return float(self._take(keys=[self.prefix + key], args=[rate.capacity, rate.refill_per_second, now]))
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(key)
+
+def make_store():
+    return RedisStore() if RATE_LIMIT_BACKEND == "redis" else MemoryStore()
+
+class RateLimiter:
+    def __init__(self, store=None, rules=RULES, enabled=RATE_LIMIT_ENABLED, clock=time.time):
+        self.store = store if store is not None else make_store()
+        self.rules = rules
+        self.enabled = enabled
+        self.clock = clock
+
+    def check(self, action: str, **keys):
+        """Take a token from each of the action's buckets; returns seconds to wait, 0 if allowed"""
+        if not self.enabled:
+            return 0.0
+        now = self.clock()
+        for kind, rate in self.rules[action].items():
+            value = keys.get(kind)
+            if not value:
+                continue
+            wait = self.store.take(f"{action}:{kind}:{value}", rate, now)
+            if wait:
+                # Later buckets are left untouched, so a blocked IP doesn't drain an email's budget
+                return wait
+        return 0.0
+
+    def enforce(self, action: str, request: Request, email: str = None):
+        """Raise 429 if the client IP or the email is over the action's limit"""
+        ip = request.client.host if request.client else None
+        wait = self.check(action, ip=ip, email=email.strip().lower() if email else None)
+        if wait:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many attempts. Please try again later.",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+    def clear(self):
+        self.store.clear()
+
+rate_limiter = RateLimiter()
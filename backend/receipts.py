@@ -0,0 +1,235 @@
+"""
+Receipt attachments: streamed uploads, thumbnails and ranged downloads.
+
+Uploads are read from the request body chunk by chunk into a
+blobstore.BlobWriter, so a large photo never sits in worker memory, and
+receipts with identical content share one blob. Image thumbnails are
+rendered after the response in a process pool (RECEIPT_THUMBNAIL_WORKERS)
+and stored next to the original as "<key>.thumb".
+
+Downloads honour single byte ranges and If-None-Match (keys are content
+hashes, so they make perfect ETags). Local objects are handed to the
+server instead of being read in Python when possible: behind nginx, set
+RECEIPT_ACCEL_PREFIX to an internal location aliased to BLOB_DIR and
+responses carry X-Accel-Redirect; servers offering the ASGI zero-copy
+send extension get the file descriptor. Otherwise the file is streamed in
+64 KiB reads off the event loop.
+
+Blobs are only removed by `python receipts.py gc`, which deletes objects no
+receipt references any more once they are older than a grace period.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+import multiprocessing
+import os
+import re
+
+import anyio
+
+from blobstore import BlobTooLarge, BlobWriter, make_store
+
+RECEIPT_MAX_BYTES = int(os.getenv("RECEIPT_MAX_BYTES", str(10 * 1024 * 1024)))
+RECEIPT_THUMBNAIL_WORKERS = int(os.getenv("RECEIPT_THUMBNAIL_WORKERS", "2"))
+RECEIPT_THUMBNAIL_PX = int(os.getenv("RECEIPT_THUMBNAIL_PX", "256"))
+RECEIPT_ACCEL_PREFIX = os.getenv("RECEIPT_ACCEL_PREFIX", "")
+RECEIPT_GC_GRACE_HOURS = float(os.getenv("RECEIPT_GC_GRACE_HOURS", "24"))
+
+RECEIPT_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif", "application/pdf"}
+
+blob_store = make_store()
+
+def thumbnail_key(key: str):
+    return f"{key}.thumb"
+
+async def save_upload(chunks, store, max_bytes=RECEIPT_MAX_BYTES):
+    """Spool an async stream of body chunks into the store; returns (key, size)"""
+    writer = BlobWriter(store, max_bytes)
+    try:
+        async for chunk in chunks:
+            if chunk:
+                await run_in_threadpool(writer.write, chunk)
+        return await run_in_threadpool(writer.commit)
+    except BaseException:
+        writer.abort()
+        raise
+
+# Thumbnails
+
+def render_thumbnail(store, key: str, size: int = RECEIPT_THUMBNAIL_PX):
+    """Runs in the thumbnail pool; returns the thumbnail key"""
+    from PIL import Image, ImageOps
+    import io
+
+    target = thumbnail_key(key)
+    if store.head_object(target) is not None:
+        return target
+    path = store.local_path(key)
+    source = open(path, "rb") if path else io.BytesIO(b"".join(store.iter_object(key)))
+    with source, Image.open(source) as image:
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=80)
+    store.put_object(target, output.getvalue())
+    return target
+
+_thumbnail_pool = None
+
+def schedule_thumbnail(store, key: str):
+    """Render the thumbnail off the request path; returns a Future"""
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        # Spawned workers: forking a process with live threads and connections is unsafe
+        _thumbnail_pool = ProcessPoolExecutor(
+            max_workers=max(1, RECEIPT_THUMBNAIL_WORKERS),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _thumbnail_pool.submit(render_thumbnail, store, key)
+
+# Downloads
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+def parse_range(header: str, size: int):
+    """(start, length) for a single byte range, None to send everything, or ValueError if unsatisfiable"""
+    match = _RANGE.match(header.strip()) if header else None
+    if not match:
+        # Absent, malformed or multi-range: serving the full body is allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError("Unsatisfiable range")
+        return size - length, length
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Unsatisfiable range")
+    return start, end - start + 1
+
+class BlobResponse(Response):
+    def __init__(self, store, key: str, media_type: str, request_headers, filename: str = None):
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.body = b""
+        self.store = store
+        self.key = key
+        self.start, self.length = 0, None
+        head = store.head_object(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        size = head["ContentLength"]
+        etag = f'"{key}"'
+        headers = {
+            "content-type": media_type,
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "cache-control": "private, max-age=31536000, immutable",
+        }
+        if filename:
+            headers["content-disposition"] = f'inline; filename="{filename}"'
+
+        if request_headers.get("if-none-match") == etag:
+            self.status_code = 304
+            self.length = 0
+        else:
+            try:
+                byte_range = parse_range(request_headers.get("range"), size)
+            except ValueError:
+                self.status_code = 416
+                self.length = 0
+                headers["content-range"] = f"bytes */{size}"
+            else:
+                if byte_range:
+                    self.start, self.length = byte_range
+                    self.status_code = 206
+                    headers["content-range"] = f"bytes {self.start}-{self.start + self.length - 1}/{size}"
+                else:
+                    self.length = size
+            headers["content-length"] = str(self.length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        path = self.store.local_path(self.key)
+        extensions = scope.get("extensions", {})
+
+        if self.length and path and RECEIPT_ACCEL_PREFIX:
+            # nginx serves the file (and the range) with sendfile
+            del self.headers["content-length"]
+            if "content-range" in self.headers:
+                del self.headers["content-range"]
+            self.headers["x-accel-redirect"] = f"{RECEIPT_ACCEL_PREFIX.rstrip('/')}/{self.store.relative_path(self.key)}"
+            await send({"type": "http.response.start", "status": 200, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.length:
+            await send({"type": "http.response.body", "body": b""})
+        elif path and "http.response.zerocopysend" in extensions:
+            with open(path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend", "file": f.fileno(),
+                    "offset": self.start, "count": self.length,
+                })
+        else:
+            chunks = self.store.iter_object(self.key, self.start, self.length)
+            try:
+                while True:
+                    chunk = await anyio.to_thread.run_sync(next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            finally:
+                chunks.close()
+            await send({"type": "http.response.body", "body": b""})
+
+# Garbage collection
+
+def collect_garbage(store, referenced: set, grace_hours: float = RECEIPT_GC_GRACE_HOURS):
+    """Delete blobs no receipt references; returns how many were removed.
+
+    The grace period covers uploads stored but not yet committed to a receipt
+    row, including uploads that deduplicated onto an existing blob: those
+    refresh its modification time, which is checked again just before deleting.
+    """
+    cutoff = datetime.utcnow() - timedelta(hours=grace_hours)
+    removed = 0
+    for key, head in list(store.list_objects()):
+        source = key[:-len(".thumb")] if key.endswith(".thumb") else key
+        if source in referenced or head["LastModified"] >= cutoff:
+            continue
+        current = store.head_object(source)
+        if current is not None and current["LastModified"].replace(tzinfo=None) >= cutoff:
+            continue
+        store.delete_object(key)
+        removed += 1
+    return removed
+
+def referenced_keys():
+    from sqlalchemy import select
+    from database import engine
+    from models import Receipt
+    from sharding import shard_router
+
+    keys = set()
+    for bind in {engine, *shard_router.engines.values()}:
+        with bind.connect() as conn:
+            keys.update(conn.scalars(select(Receipt.blob_key).distinct()))
+    return keys
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ["gc"]:
+        print("Usage: python receipts.py gc")
+        sys.exit(1)
+    removed = collect_garbage(blob_store, referenced_keys())
+    print(f"Removed {removed} unreferenced blobs")
@@ -0,0 +1,432 @@
+"""
+Background report jobs: yearly or monthly spending reports as PDF, XLSX or CSV.
+
+POST /reports/jobs records a job in `report_jobs` and returns at once. The
+job runner aggregates the period with a couple of GROUP BY queries
+(totals per category per month, or per day for a monthly report, plus
+archived rollups and budgets) on one of REPORT_WORKERS threads, and the
+charts and document are rendered in a process pool of the same size, so
+at most REPORT_WORKERS reports are being built by a server process at a
+time and rendering never holds the GIL of a request worker. Each user can
+have REPORT_MAX_ACTIVE jobs queued or running.
+
+Jobs are deduplicated on their parameters plus the user's change
+sequence number: asking again for the same report while it is being built, or
+after it was built and nothing has changed since, returns the existing
+job. A partial unique index allows one queued or running job per report,
+so of two identical requests racing past the lookup, the second gets the
+first one's job. `ensure_indexes` adds it to existing databases. Finished reports are kept under REPORT_DIR for REPORT_TTL_SECONDS.
+Expired reports, and jobs lost with a worker (queued or running for
+longer than REPORT_TIMEOUT_SECONDS), are cleaned up now and then as new
+jobs are submitted, or with `python reports.py purge`.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+import calendar
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from blobstore import LocalBlobStore
+from database import SessionLocal
+from models import Budget, ChangeClock, Expense, ExpenseRollup, ReportJob, User
+
+REPORT_DIR = os.getenv("REPORT_DIR", "./reports")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+REPORT_MAX_ACTIVE = int(os.getenv("REPORT_MAX_ACTIVE", "3"))
+REPORT_TTL_SECONDS = float(os.getenv("REPORT_TTL_SECONDS", "3600"))
+REPORT_TIMEOUT_SECONDS = float(os.getenv("REPORT_TIMEOUT_SECONDS", "600"))
+REPORT_PURGE_SECONDS = 300
+
+REPORT_FORMATS = {
+    "pdf": "application/pdf",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+}
+ACTIVE = ("queued", "running")
+
+report_store = LocalBlobStore(REPORT_DIR)
+
+def ensure_indexes(bind):
+    """Create the active job index on tables from before it, failing all but the newest duplicate"""
+    with bind.begin() as conn:
+        newest = (
+            select(func.max(ReportJob.id)).where(ReportJob.status.in_(ACTIVE))
+            .group_by(ReportJob.owner_id, ReportJob.params_hash)
+        )
+        conn.execute(
+            update(ReportJob).where(ReportJob.status.in_(ACTIVE), ReportJob.id.not_in(newest))
+            .values(status="failed", error="Superseded by an identical job")
+        )
+    for index in ReportJob.__table__.indexes:
+        index.create(bind, checkfirst=True)
+
+def report_key(job: ReportJob):
+    return f"report-{job.id}.{job.params['format']}"
+
+def report_filename(job: ReportJob):
+    params = job.params
+    period = f"{params['year']}-{params['month']:02d}" if params.get("month") else str(params["year"])
+    return f"expenses-{period}.{params['format']}"
+
+def params_hash(params: dict, data_version: int):
+    return hashlib.sha256(json.dumps([params, data_version], sort_keys=True).encode()).hexdigest()
+
+def data_version(db, user_id: int):
+    """The user's change sequence number; any write to their data moves it"""
+    return db.scalar(select(ChangeClock.seq).where(ChangeClock.owner_id == user_id)) or 0
+
+# Aggregation
+
+def collect_report(db, user_id: int, params: dict):
+    """Totals per category per month (or per day) for the report period; db is routed to the user's shard"""
+    from categories import category_cache
+    from crud import month_bounds
+
+    year, month = params["year"], params.get("month")
+    if month:
+        start, end = month_bounds(month, year)
+        bucket = func.extract("day", Expense.date)
+        labels = [str(day) for day in range(1, calendar.monthrange(year, month)[1] + 1)]
+        title = f"Expenses, {calendar.month_name[month]} {year}"
+    else:
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+        bucket = func.extract("month", Expense.date)
+        labels = [calendar.month_abbr[m] for m in range(1, 13)]
+        title = f"Expenses, {year}"
+
+    series, count = {}, 0
+    def add(category, index, total):
+        series.setdefault(category, [0.0] * len(labels))[index] += total
+
+    category_cache.warm(db, user_id)
+    rows = db.execute(
+        select(bucket, Expense.category_id, func.sum(Expense.amount), func.count(Expense.id))
+        .where(Expense.owner_id == user_id, Expense.date >= start, Expense.date < end)
+        .group_by(bucket, Expense.category_id)
+    ).all()
+    for index, category_id, total, n in rows:
+        add(category_cache.name(category_id, db), int(index) - 1, total)
+        count += n
+
+    # Archived expenses only survive as monthly rollups
+    rollups = select(ExpenseRollup).where(ExpenseRollup.owner_id == user_id, ExpenseRollup.year == year)
+    if month:
+        rollups = rollups.where(ExpenseRollup.month == month)
+    archived = list(db.scalars(rollups))
+    if month and archived:
+        labels.append("Archived")
+        for values in series.values():
+            values.append(0.0)
+    for rollup in archived:
+        add(rollup.category, len(labels) - 1 if month else rollup.month - 1, rollup.total)
+        count += rollup.count
+
+    budgets = []
+    budget_rows = select(Budget).where(Budget.owner_id == user_id, Budget.year == year)
+    if month:
+        budget_rows = budget_rows.where(Budget.month == month)
+    for budget in db.scalars(budget_rows.order_by(Budget.month)):
+        if month:
+            spent = {category: sum(values) for category, values in series.items()}
+        else:
+            spent = {category: values[budget.month - 1] for category, values in series.items()}
+        budgets.append({
+            "month": calendar.month_abbr[budget.month], "category": budget.category, "amount": budget.amount,
+            "spent": sum(spent.values()) if budget.category == "General" else spent.get(budget.category, 0.0),
+        })
+
+    return {
+        "title": title, "labels": labels,
+        "series": dict(sorted(series.items(), key=lambda item: -sum(item[1]))),
+        "total": sum(sum(values) for values in series.values()), "count": count,
+        "budgets": budgets, "generated_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC"),
+    }
+
+# Rendering (runs in the process pool)
+
+def render_csv(data: dict):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["period", *data["series"], "total"])
+    for index, label in enumerate(data["labels"]):
+        values = [values[index] for values in data["series"].values()]
+        writer.writerow([label, *(f"{value:.2f}" for value in values), f"{sum(values):.2f}"])
+    writer.writerow(["total", *(f"{sum(values):.2f}" for values in data["series"].values()), f"{data['total']:.2f}"])
+    return buffer.getvalue().encode()
+
+def render_xlsx(data: dict):
+    from openpyxl import Workbook
+    from openpyxl.chart import BarChart, Reference
+    from openpyxl.styles import Font
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "Spending"
+    sheet.append([data["title"]])
+    sheet["A1"].font = Font(bold=True, size=14)
+    sheet.append(["Period", *data["series"], "Total"])
+    for index, label in enumerate(data["labels"]):
+        values = [values[index] for values in data["series"].values()]
+        sheet.append([label, *values, sum(values)])
+    last_row = sheet.max_row
+    sheet.append(["Total", *(sum(values) for values in data["series"].values()), data["total"]])
+    for cell in sheet[2] + sheet[sheet.max_row]:
+        cell.font = Font(bold=True)
+    for row in sheet.iter_rows(min_row=3, min_col=2):
+        for cell in row:
+            cell.number_format = "#,##0.00"
+
+    if data["series"]:
+        chart = BarChart()
+        chart.type = "col"
+        chart.grouping = "stacked"
+        chart.overlap = 100
+        chart.title = data["title"]
+        chart.width, chart.height = 24, 12
+        chart.add_data(Reference(sheet, min_col=2, max_col=len(data["series"]) + 1, min_row=2, max_row=last_row), titles_from_data=True)
+        chart.set_categories(Reference(sheet, min_col=1, min_row=3, max_row=last_row))
+        sheet.add_chart(chart, f"A{sheet.max_row + 2}")
+
+    if data["budgets"]:
+        budgets = workbook.create_sheet("Budgets")
+        budgets.append(["Month", "Category", "Budget", "Spent", "Remaining"])
+        for budget in data["budgets"]:
+            budgets.append([budget["month"], budget["category"], budget["amount"], budget["spent"], budget["amount"] - budget["spent"]])
+
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+PALETTE = ["#667eea", "#48bb78", "#ed8936", "#e53e3e", "#38b2ac", "#9f7aea", "#ecc94b", "#ed64a6", "#4299e1", "#a0aec0"]
+
+def _font(size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow without FreeType only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def render_pdf(data: dict, dpi: int = 150):
+    from PIL import Image, ImageDraw
+
+    width, height = int(8.27 * dpi), int(11.69 * dpi)
+    page = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(page)
+    margin = dpi // 2
+    title, body, small = _font(dpi // 4), _font(dpi // 9), _font(dpi // 12)
+    draw.text((margin, margin), data["title"], fill="#2d3748", font=title)
+    draw.text((margin, margin + dpi // 3),
+              f"${data['total']:,.2f} across {data['count']} expenses. Generated {data['generated_at']}.",
+              fill="#718096", font=body)
+
+    # Stacked columns, one colour per category (the smallest ones share the last colour)
+    categories = list(data["series"])
+    colours = {category: PALETTE[min(i, len(PALETTE) - 1)] for i, category in enumerate(categories)}
+    chart_top, chart_bottom = margin + dpi, margin + dpi * 4
+    chart_left, chart_right = margin + dpi // 2, width - margin
+    totals = [sum(values[i] for values in data["series"].values()) for i in range(len(data["labels"]))]
+    peak = max(totals, default=0) or 1
+    draw.line([(chart_left, chart_bottom), (chart_right, chart_bottom)], fill="#a0aec0", width=2)
+    for tick in range(5):
+        y = chart_bottom - (chart_bottom - chart_top) * tick // 4
+        draw.text((margin, y - dpi // 16), f"{peak * tick / 4:,.0f}", fill="#718096", font=small)
+    slot = (chart_right - chart_left) / max(len(data["labels"]), 1)
+    for i, label in enumerate(data["labels"]):
+        x0 = chart_left + i * slot + slot * 0.15
+        x1 = chart_left + (i + 1) * slot - slot * 0.15
+        y = chart_bottom
+        for category in categories:
+            bar = data["series"][category][i] / peak * (chart_bottom - chart_top)
+            if bar > 0:
+                draw.rectangle([x0, y - bar, x1, y], fill=colours[category])
+                y -= bar
+        if len(data["labels"]) <= 13 or i % 2 == 0:
+            draw.text((x0, chart_bottom + dpi // 20), label, fill="#4a5568", font=small)
+
+    # Category totals table doubling as the legend
+    y = chart_bottom + dpi // 2
+    draw.text((margin, y), "By category", fill="#2d3748", font=body)
+    for category in categories:
+        if y > height - margin * 3:
+            draw.text((margin, y + dpi // 6), "...", fill="#4a5568", font=body)
+            break
+        y += dpi // 6
+        draw.rectangle([margin, y + 4, margin + dpi // 10, y + 4 + dpi // 10], fill=colours[category])
+        draw.text((margin + dpi // 6, y), category, fill="#4a5568", font=body)
+        draw.text((width // 2, y), f"${sum(data['series'][category]):,.2f}", fill="#4a5568", font=body)
+
+    if data["budgets"] and y < height - margin * 3:
+        y += dpi // 3
+        draw.text((margin, y), "Budgets", fill="#2d3748", font=body)
+        for budget in data["budgets"]:
+            y += dpi // 6
+            if y > height - margin:
+                break
+            over = budget["spent"] > budget["amount"]
+            draw.text((margin, y), f"{budget['month']} {budget['category']}: ${budget['spent']:,.2f} of ${budget['amount']:,.2f}"
+                      f"{'  exceeded' if over else ''}", fill="#e53e3e" if over else "#4a5568", font=body)
+
+    output = io.BytesIO()
+    page.save(output, "PDF", resolution=dpi)
+    return output.getvalue()
+
+RENDERERS = {"pdf": render_pdf, "xlsx": render_xlsx, "csv": render_csv}
+
+def render_report(store, key: str, data: dict, report_format: str):
+    """Runs in the render pool; returns the stored size"""
+    body = RENDERERS[report_format](data)
+    store.put_object(key, body)
+    return len(body)
+
+# Jobs
+
+class ReportRunner:
+    def __init__(self, session_factory=SessionLocal, store=report_store, workers=REPORT_WORKERS):
+        self.session_factory = session_factory
+        self.store = store
+        self.workers = max(1, workers)
+        self._threads = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def _executors(self):
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="report")
+                # Spawned workers: forking a process with live threads and connections is unsafe
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._threads, self._pool
+
+    def find(self, db, user_id: int, job_hash: str, now: datetime = None):
+        """A queued, running or still available job for the same report, if any"""
+        now = now or datetime.utcnow()
+        return db.scalars(
+            select(ReportJob)
+            .where(
+                ReportJob.owner_id == user_id, ReportJob.params_hash == job_hash,
+                or_(
+                    and_(ReportJob.status.in_(ACTIVE), ReportJob.created_at > now - timedelta(seconds=REPORT_TIMEOUT_SECONDS)),
+                    and_(ReportJob.status == "done", ReportJob.expires_at > now),
+                ),
+            )
+            .order_by(ReportJob.id.desc())
+            .limit(1)
+        ).first()
+
+    def active_count(self, db, user_id: int, now: datetime = None):
+        now = now or datetime.utcnow()
+        return db.scalar(
+            select(func.count()).select_from(ReportJob).where(
+                ReportJob.owner_id == user_id, ReportJob.status.in_(ACTIVE),
+                ReportJob.created_at > now - timedelta(seconds=REPORT_TIMEOUT_SECONDS),
+            )
+        )
+
+    def create(self, db, user_id: int, params: dict, job_hash: str, now: datetime = None):
+        """Record a queued job; returns (job, created), with the racing request's job if it got there first"""
+        now = now or datetime.utcnow()
+        # A job lost with its worker would otherwise hold the report's slot in the unique index
+        db.execute(
+            update(ReportJob)
+            .where(
+                ReportJob.owner_id == user_id, ReportJob.params_hash == job_hash, ReportJob.status.in_(ACTIVE),
+                ReportJob.created_at <= now - timedelta(seconds=REPORT_TIMEOUT_SECONDS),
+            )
+            .values(status="failed", error="Timed out", finished_at=now, expires_at=now)
+        )
+        job = ReportJob(owner_id=user_id, params=params, params_hash=job_hash, created_at=now)
+        db.add(job)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            existing = self.find(db, user_id, job_hash, now)
+            if existing is None:
+                raise
+            return existing, False
+        return job, True
+
+    def submit(self, job_id: int):
+        """Build the report in the background; returns a Future"""
+        threads, _ = self._executors()
+        self.maybe_purge()
+        return threads.submit(self._run, job_id)
+
+    def _run(self, job_id: int):
+        from sharding import route_session
+
+        db = self.session_factory()
+        try:
+            job = db.get(ReportJob, job_id)
+            job.status, job.started_at = "running", datetime.utcnow()
+            db.commit()
+            try:
+                route_session(db, db.get(User, job.owner_id), writable=False)
+                data = collect_report(db, job.owner_id, job.params)
+                db.rollback()
+                _, pool = self._executors()
+                job.size = pool.submit(render_report, self.store, report_key(job), data, job.params["format"]).result()
+                job.status, job.result_key = "done", report_key(job)
+            except Exception as e:
+                db.rollback()
+                job.status, job.error = "failed", f"{type(e).__name__}: {e}"[:500]
+            job.finished_at = datetime.utcnow()
+            job.expires_at = job.finished_at + timedelta(seconds=REPORT_TTL_SECONDS)
+            db.commit()
+        finally:
+            db.close()
+
+    def maybe_purge(self):
+        if time.monotonic() - self._purged_at < REPORT_PURGE_SECONDS:
+            return
+        self._purged_at = time.monotonic()
+        threads, _ = self._executors()
+        threads.submit(self.purge)
+
+    def purge(self, now: datetime = None):
+        """Delete expired reports and give up on lost jobs; returns how many jobs were removed"""
+        now = now or datetime.utcnow()
+        db = self.session_factory()
+        try:
+            expired = db.scalars(select(ReportJob).where(
+                or_(
+                    ReportJob.expires_at <= now,
+                    and_(ReportJob.status.in_(ACTIVE), ReportJob.created_at <= now - timedelta(seconds=REPORT_TIMEOUT_SECONDS)),
+                )
+            )).all()
+            for job in expired:
+                if job.result_key:
+                    self.store.delete_object(job.result_key)
+            if expired:
+                db.execute(delete(ReportJob).where(ReportJob.id.in_([job.id for job in expired])))
+                db.commit()
+            return len(expired)
+        finally:
+            db.close()
+
+    def shutdown(self):
+        with self._lock:
+            if self._threads is not None:
+                self._threads.shutdown()
+                self._pool.shutdown()
+                self._threads = self._pool = None
+
+report_runner = ReportRunner()
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ["purge"]:
+        print("Usage: python reports.py purge")
+        sys.exit(1)
+    print(f"Removed {report_runner.purge()} expired report jobs")
@@ -0,0 +1,135 @@
+"""
+Access token revocation.
+
+Revoked tokens (logout) and users whose credentials changed are stored in
+the `revoked_tokens` table until the affected tokens would have expired.
+Every worker keeps a bloom filter of the live denylist keys, refreshed from
+the database every REVOCATION_SYNC_SECONDS, so authenticating a token that
+was never revoked costs a few hash probes and no query. A filter hit is
+confirmed against the table. Revocations made on another worker take
+effect there on its next refresh. One request per worker performs each
+refresh; the others keep using the current filter meanwhile.
+"""
+from sqlalchemy import delete, select
+from datetime import datetime, timedelta
+import hashlib
+import threading
+import time
+import os
+
+from database import SessionLocal
+from models import RevokedToken
+
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+REVOCATION_BLOOM_BITS = int(os.getenv("REVOCATION_BLOOM_BITS", str(1 << 20)))
+BLOOM_HASHES = 7
+
+class BloomFilter:
+    def __init__(self, bits=REVOCATION_BLOOM_BITS, hashes=BLOOM_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing: h1 + i*h2 gives k independent-enough probes from one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+def token_key(payload: dict, token: str):
+    jti = payload.get("jti")
+    # Tokens issued before jti existed are keyed by their digest
+    return f"jti:{jti}" if jti else f"token:{hashlib.sha256(token.encode()).hexdigest()}"
+
+def user_key(email: str):
+    return f"user:{email}"
+
+class RevocationList:
+    def __init__(self, session_factory=SessionLocal, sync_seconds=REVOCATION_SYNC_SECONDS):
+        self.session_factory = session_factory
+        self.sync_seconds = sync_seconds
+        self._filter = BloomFilter()
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def sync(self):
+        """Rebuild the filter from the live rows and drop expired ones"""
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            db.execute(delete(RevokedToken).where(RevokedToken.expires_at <= now))
+            db.commit()
+            keys = db.scalars(select(RevokedToken.key)).all()
+        finally:
+            db.close()
+        bloom = BloomFilter(max(REVOCATION_BLOOM_BITS, len(keys) * 10))
+        for key in keys:
+            bloom.add(key)
+        with self._lock:
+            self._filter = bloom
+            self._synced_at = time.monotonic()
+
+    def _stale(self):
+        return time.monotonic() - self._synced_at >= self.sync_seconds
+
+    def _maybe_sync(self):
+        if not self._stale():
+            return
+        if not self._synced_at:
+            # No filter yet: an empty one would let revoked tokens through, so wait for it
+            with self._sync_lock:
+                if not self._synced_at:
+                    self.sync()
+            return
+        if self._sync_lock.acquire(blocking=False):
+            try:
+                if self._stale():
+                    self.sync()
+            finally:
+                self._sync_lock.release()
+
+    def is_revoked(self, db, payload: dict, token: str):
+        self._maybe_sync()
+        bloom = self._filter
+        keys = [key for key in (token_key(payload, token), user_key(payload.get("sub"))) if key in bloom]
+        if not keys:
+            return False
+        # Possible hit: confirm against the table
+        for entry in db.scalars(select(RevokedToken).where(RevokedToken.key.in_(keys))):
+            if entry.not_before is None or payload.get("iat", 0) < entry.not_before:
+                return True
+        return False
+
+    def _store(self, db, key: str, expires_at: datetime, not_before=None):
+        entry = db.get(RevokedToken, key)
+        if entry is None:
+            db.add(RevokedToken(key=key, expires_at=expires_at, not_before=not_before))
+        else:
+            entry.expires_at = max(entry.expires_at, expires_at)
+            entry.not_before = not_before
+        db.commit()
+        with self._lock:
+            self._filter.add(key)
+
+    def revoke_token(self, db, payload: dict, token: str):
+        """Revoke one token until it expires (logout)"""
+        self._store(db, token_key(payload, token), datetime.utcfromtimestamp(payload["exp"]))
+
+    def revoke_user(self, db, email: str, lifetime_minutes: int):
+        """Revoke every token issued to `email` so far (credential change)"""
+        self._store(
+            db, user_key(email),
+            datetime.utcnow() + timedelta(minutes=lifetime_minutes),
+            not_before=time.time()
+        )
+
+revocations = RevocationList()
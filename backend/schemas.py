@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import Annotated, List, Literal, Optional
 from datetime import datetime
 
 class UserBase(BaseModel):
@@ -26,18 +26,49 @@ class ExpenseBase(BaseModel):
     amount: float
     category: str = "Other"
 
+TagName = Annotated[str, Field(min_length=1, max_length=50)]
+
 class ExpenseCreate(ExpenseBase):
-    pass
+    tags: List[TagName] = Field([], max_length=20)
 
 class ExpenseUpdate(BaseModel):
     description: Optional[str] = None
     amount: Optional[float] = None
     category: Optional[str] = None
+    tags: Optional[List[TagName]] = Field(None, max_length=20)
 
 class ExpenseResponse(ExpenseBase):
     id: int
     date: datetime
     owner_id: int
+    updated_at: Optional[datetime] = None
+    version: Optional[int] = None
+    anomaly_score: Optional[float] = None
+    tags: List[str] = []
+    
+    class Config:
+        from_attributes = True
+
+class AnomalyResponse(ExpenseResponse):
+    category_median: Optional[float] = None
+    category_p95: Optional[float] = None
+
+class TagCount(BaseModel):
+    name: str
+    count: int
+
+class Suggestion(BaseModel):
+    description: str
+    count: int
+    category: Optional[str] = None
+    amount: Optional[float] = None
+
+class ReceiptResponse(BaseModel):
+    expense_id: int
+    blob_key: str
+    content_type: str
+    size: int
+    uploaded_at: datetime
     
     class Config:
         from_attributes = True
@@ -48,13 +79,20 @@ class BudgetBase(BaseModel):
     amount: float
     category: str = "General"
 
+# Percent of the budget amount
+AlertThreshold = Annotated[float, Field(gt=0, le=1000)]
+
 class BudgetCreate(BudgetBase):
-    pass
+    # Defaults to BUDGET_ALERT_THRESHOLDS; [] turns alerts off
+    alert_thresholds: Optional[List[AlertThreshold]] = Field(None, max_length=10)
 
 class BudgetResponse(BudgetBase):
     id: int
     owner_id: int
     created_at: datetime
+    updated_at: Optional[datetime] = None
+    version: Optional[int] = None
+    alert_thresholds: List[float] = []
     
     class Config:
         from_attributes = True
@@ -67,6 +105,134 @@ class ExpenseSummary(BaseModel):
     category_breakdown: dict = {}
     budget_warning: Optional[str] = None
 
+class BudgetStatus(BaseModel):
+    budget_id: int
+    category: str
+    amount: float
+    spent: float
+    remaining: float
+    exceeded: bool
+
+class DashboardResponse(BaseModel):
+    summary: ExpenseSummary
+    recent_expenses: List[ExpenseResponse] = []
+    budget_status: List[BudgetStatus] = []
+
+class SyncResponse(BaseModel):
+    token: str
+    full: bool
+    has_more: bool
+    expenses: List[ExpenseResponse] = []
+    budgets: List[BudgetResponse] = []
+    deleted_expenses: List[int] = []
+    deleted_budgets: List[int] = []
+
+class NotificationResponse(BaseModel):
+    id: int
+    kind: str
+    message: str
+    data: Optional[dict] = None
+    created_at: datetime
+    read_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
+class ReportJobCreate(BaseModel):
+    format: Literal["pdf", "xlsx", "csv"] = "pdf"
+    year: int = Field(..., ge=1900, le=9999)
+    month: Optional[int] = Field(None, ge=1, le=12)
+
+class ReportJobResponse(BaseModel):
+    id: int
+    status: str
+    format: str
+    year: int
+    month: Optional[int] = None
+    error: Optional[str] = None
+    size: Optional[int] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    download_url: Optional[str] = None
+
+class SplitGroupCreate(BaseModel):
+    name: str = Field(..., min_length=1, max_length=100)
+    # Registered users to add besides the creator
+    member_emails: List[EmailStr] = Field([], max_length=50)
+
+class SplitGroupMemberAdd(BaseModel):
+    email: EmailStr
+
+class SplitMember(BaseModel):
+    id: int
+    email: str
+    full_name: Optional[str] = None
+
+class SplitGroupResponse(BaseModel):
+    id: int
+    name: str
+    created_by: int
+    created_at: datetime
+    members: List[SplitMember] = []
+
+class ShareAmount(BaseModel):
+    user_id: int
+    amount: float = Field(..., ge=0)
+
+class SharedExpenseCreate(BaseModel):
+    description: str = Field(..., min_length=1, max_length=200)
+    amount: float = Field(..., gt=0)
+    # Defaults to the current user
+    paid_by: Optional[int] = None
+    # Exact shares, or else an equal split between these members (default: all of them)
+    shares: Optional[List[ShareAmount]] = Field(None, min_length=1)
+    split_between: Optional[List[int]] = Field(None, min_length=1)
+    date: Optional[datetime] = None
+
+class SettlementCreate(BaseModel):
+    to_user: int
+    amount: float = Field(..., gt=0)
+
+class SharedExpenseResponse(BaseModel):
+    id: int
+    group_id: int
+    description: str
+    amount: float
+    paid_by: int
+    created_by: int
+    is_settlement: bool
+    date: datetime
+    shares: List[ShareAmount] = []
+
+class Transfer(BaseModel):
+    from_user: int
+    to_user: int
+    amount: float
+
+class MemberBalance(BaseModel):
+    user_id: int
+    # Positive: the group owes this member; negative: they owe the group
+    balance: float
+
+class GroupBalances(BaseModel):
+    members: List[MemberBalance] = []
+    debts: List[Transfer] = []
+
+class ProfileCreate(BaseModel):
+    route: Optional[str] = None
+    user_id: Optional[int] = None
+    requests: int = Field(1, ge=1, le=100)
+
+class ProfileStatus(BaseModel):
+    id: str
+    route: Optional[str] = None
+    user_id: Optional[int] = None
+    requests: int
+    completed: int
+    done: bool
+    samples: int
+
 class UserUpdate(BaseModel):
     full_name: Optional[str] = None
     email: Optional[EmailStr] = None
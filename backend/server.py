@@ -0,0 +1,108 @@
+"""
+Production server: gunicorn managing uvicorn workers.
+
+    python server.py                  # or: gunicorn -c python:server main:app
+
+The app is imported once in the master (preload_app) before the workers
+are forked, so startup work such as table creation and migrations runs
+once, and the imported modules are shared copy-on-write. gc.freeze()
+before each fork keeps the collector from writing to, and so copying,
+those pages. Each worker then drops the database connections it
+inherited and opens its own.
+
+WEB_CONCURRENCY workers are started (default: one per CPU available to
+the process). On SIGTERM each worker stops accepting connections and
+finishes its in-flight requests for up to WEB_GRACEFUL_TIMEOUT seconds.
+A worker is replaced after WEB_MAX_REQUESTS requests, plus up to
+WEB_MAX_REQUESTS_JITTER so they don't all restart together.
+
+With more than one worker the in-memory rate limiter would give each worker
+its own buckets, multiplying every limit by the worker count, so unless
+RATE_LIMIT_BACKEND=redis (or rate limiting is off) the server logs a warning
+and starts a single worker instead. Profiles are kept by the worker that
+armed them, so /admin/profiles refuses to start one while several workers
+run. Report jobs are rows in `report_jobs` that any worker can serve; a
+worker that exits first finishes the reports it has queued.
+"""
+import gc
+import os
+
+from gunicorn.app.base import BaseApplication
+from gunicorn.util import import_app
+from uvicorn.workers import UvicornWorker
+
+def cpu_count():
+    # Honours CPU affinity (container cpusets), unlike os.cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "0")) or cpu_count()
+worker_class = "server.DrainingUvicornWorker"
+preload_app = True
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "1000"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+class DrainingUvicornWorker(UvicornWorker):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Give up on stragglers just before the master would SIGKILL the worker
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - 1, 1)
+
+def reset_connection_pools():
+    """Forget pooled connections inherited from the master without closing them under it"""
+    from database import engine, replica_router
+    from sharding import shard_router
+    for bind in {engine, *replica_router.engines, *shard_router.engines.values()}:
+        bind.dispose(close=False)
+
+def shared_state_workers(workers, log):
+    """The worker count to run, falling back to one if more would loosen per-process limits"""
+    from ratelimit import RATE_LIMIT_BACKEND, RATE_LIMIT_ENABLED
+    if workers > 1 and RATE_LIMIT_ENABLED and RATE_LIMIT_BACKEND != "redis":
+        log.warning(
+            "Starting 1 worker instead of %d: in-memory rate limits would allow %dx the configured "
+            "login and reset attempts; set RATE_LIMIT_BACKEND=redis (or RATE_LIMIT_ENABLED=0) to run more",
+            workers, workers,
+        )
+        return 1
+    return workers
+
+def on_starting(server):
+    from profiling import profiler
+    workers = shared_state_workers(server.cfg.workers, server.log)
+    # Also kept in the config, which a reload (SIGHUP) reads the count from again
+    server.cfg.set("workers", workers)
+    server.num_workers = profiler.workers = workers
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+def post_fork(server, worker):
+    reset_connection_pools()
+
+def worker_exit(server, worker):
+    from reports import report_runner
+    report_runner.shutdown()
+
+class Server(BaseApplication):
+    def __init__(self, app_uri="main:app", **overrides):
+        self.app_uri = app_uri
+        self.overrides = overrides
+        super().__init__()
+
+    def load_config(self):
+        settings = {name: value for name, value in globals().items() if name in self.cfg.settings}
+        for name, value in {**settings, **self.overrides}.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return import_app(self.app_uri)
+
+if __name__ == "__main__":
+    Server().run()
@@ -0,0 +1,310 @@
+"""
+Owner-based sharding of expense data.
+
+Users, password resets and id blocks stay on the primary database. Expenses
+and budgets live on one of several shard databases, chosen per user through a
+consistent-hash ring and pinned on ``User.shard`` so that adding a shard only
+moves the users that ``rebalance`` explicitly migrates.
+"""
+from sqlalchemy import create_engine, event, insert, inspect, select, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from fastapi import HTTPException
+import bisect
+import hashlib
+import threading
+import os
+
+from database import SessionLocal, engine, engine_options
+from models import Category, CategoryStats, Expense, Budget, BudgetTracker, ChangeClock, ChangeLog, ExpenseRollup, ExpenseTag, IdBlock, IdempotencyKey, Notification, Receipt, Tag, User
+from partitioning import maintain as maintain_partitions
+
+# Comma-separated shard URLs, named shard0, shard1, ... in order. Append new
+# shards at the end so existing names stay stable.
+SHARD_URLS = os.getenv("SHARD_URLS", "")
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "1000"))
+
+SHARDED_MODELS = [
+    Category, Tag, Expense, Budget, BudgetTracker, ExpenseRollup, CategoryStats, Receipt, ExpenseTag,
+    IdempotencyKey, Notification, ChangeLog, ChangeClock,
+]
+
+def _hash(key: str):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes, vnodes=128):
+        self._ring = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys = [point for point, _ in self._ring]
+
+    def node_for(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._keys, _hash(str(key))) % len(self._ring)
+        return self._ring[index][1]
+
+class IdAllocator:
+    """Hands out globally unique ids in blocks reserved on the primary (hi/lo)"""
+
+    def __init__(self, primary_engine, block_size=ID_BLOCK_SIZE):
+        self.engine = primary_engine
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def _reserve(self, name, seed):
+        with self.engine.begin() as conn:
+            reserved = conn.execute(
+                update(IdBlock.__table__)
+                .where(IdBlock.name == name)
+                .values(next_id=IdBlock.next_id + self.block_size)
+                .returning(IdBlock.next_id)
+            ).scalar()
+            if reserved is None:
+                conn.execute(IdBlock.__table__.insert().values(
+                    name=name, next_id=seed + self.block_size
+                ))
+                reserved = seed + self.block_size
+        return reserved - self.block_size, reserved
+
+    def next_id(self, name, seed=lambda: 1):
+        with self._lock:
+            start, end = self._blocks.get(name, (0, 0))
+            if start >= end:
+                try:
+                    start, end = self._reserve(name, seed())
+                except IntegrityError:
+                    # Another worker created the row first
+                    start, end = self._reserve(name, seed())
+            self._blocks[name] = (start + 1, end)
+            return start
+
+def moving_error():
+    return HTTPException(
+        status_code=503,
+        detail="Your data is being moved, please retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
+class ShardRouter:
+    def __init__(self, urls, primary_engine=engine):
+        self.primary_engine = primary_engine
+        self.engines = {}
+        for index, url in enumerate(urls):
+            if url == str(primary_engine.url):
+                self.engines[f"shard{index}"] = primary_engine
+            else:
+                self.engines[f"shard{index}"] = create_engine(url, **engine_options(url))
+        self.ring = HashRing(list(self.engines))
+        self.ids = IdAllocator(primary_engine)
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def create_tables(self):
+        """Create sharded tables without cross-database foreign keys"""
+        for shard_engine in self.engines.values():
+            if shard_engine is self.primary_engine:
+                continue
+            maintain_partitions(shard_engine, include_foreign_keys=False)
+            existing = inspect(shard_engine).get_table_names()
+            with shard_engine.begin() as conn:
+                for model in SHARDED_MODELS:
+                    table = model.__table__
+                    if table.name in existing:
+                        continue
+                    conn.execute(CreateTable(table, include_foreign_key_constraints=[]))
+                    for index in table.indexes:
+                        conn.execute(CreateIndex(index))
+
+    def shard_for(self, user: User):
+        return user.shard or self.ring.node_for(user.id)
+
+    def route(self, db, user: User, writable: bool = True):
+        """Bind the session's sharded models to the user's shard"""
+        if not self.enabled:
+            return db
+        if user.shard is None and writable:
+            # Pin the placement so later ring changes need an explicit move
+            user.shard = self.ring.node_for(user.id)
+            db.commit()
+        if writable and user.shard_locked:
+            raise moving_error()
+        shard_engine = self.engines[self.shard_for(user)]
+        for model in SHARDED_MODELS:
+            db.bind_mapper(model, shard_engine)
+        return db
+
+    def allocate_id(self, model):
+        table = model.__table__
+
+        def seed():
+            # Continue after the highest id already present on any shard
+            highest = 0
+            for shard_engine in self.engines.values():
+                with shard_engine.connect() as conn:
+                    highest = max(highest, conn.execute(select(func.max(table.c.id))).scalar() or 0)
+            return highest + 1
+
+        return self.ids.next_id(table.name, seed)
+
+shard_router = ShardRouter([url.strip() for url in SHARD_URLS.split(",") if url.strip()])
+
+def route_session(db, user: User, writable: bool = True):
+    return shard_router.route(db, user, writable)
+
+def allocate_id(model):
+    """Global id for a new sharded row, or None to use the table's autoincrement"""
+    return shard_router.allocate_id(model) if shard_router.enabled else None
+
+def advance_clock(db, user_id: int, count: int = 0):
+    """Reserve the user's next `count` change sequence numbers; returns the last one.
+
+    The clock row stays locked until the caller's transaction ends, so the
+    user's sequence numbers become visible in order and a sync token never
+    skips a change that commits after it. Writes to a user's sharded rows
+    take this lock just before committing (with count=0 when they log no
+    change), which is also what fences them during move_user.
+    """
+    dialect = db.get_bind(mapper=inspect(ChangeClock)).dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = dialect_insert(ChangeClock).values(owner_id=user_id, seq=count)
+        seq, fenced = db.execute(statement.on_conflict_do_update(
+            index_elements=["owner_id"], set_={"seq": ChangeClock.seq + statement.excluded.seq}
+        ).returning(ChangeClock.seq, ChangeClock.fenced)).one()
+    else:
+        row = db.execute(
+            update(ChangeClock).where(ChangeClock.owner_id == user_id)
+            .values(seq=ChangeClock.seq + count).returning(ChangeClock.seq, ChangeClock.fenced)
+        ).one_or_none()
+        if row is None:
+            db.execute(insert(ChangeClock).values(owner_id=user_id, seq=count))
+            row = (count, False)
+        seq, fenced = row
+    if fenced:
+        # The user is being moved and the copy may already have passed this write
+        raise moving_error()
+    return seq
+
+def _set_fence(bind, user_id: int, fenced: bool):
+    """Set the user's clock fence on one shard, waiting for writes holding the clock to commit"""
+    table = ChangeClock.__table__
+    for attempt in range(2):
+        try:
+            with bind.begin() as conn:
+                if not conn.execute(update(table).where(table.c.owner_id == user_id).values(fenced=fenced)).rowcount:
+                    conn.execute(table.insert().values(owner_id=user_id, seq=0, fenced=fenced))
+            return
+        except IntegrityError:
+            # The user's first write created the clock meanwhile
+            if attempt:
+                raise
+
+@event.listens_for(Category, "before_insert")
+@event.listens_for(Expense, "before_insert")
+@event.listens_for(Budget, "before_insert")
+@event.listens_for(ChangeLog, "before_insert")
+def _assign_global_id(mapper, connection, target):
+    # Per-shard autoincrement would collide when a user moves between shards
+    if shard_router.enabled and target.id is None:
+        target.id = shard_router.allocate_id(type(target))
+
+def _copy_rows(model, user_id, source, target, batch_size):
+    table = model.__table__
+    copied = 0
+    with source.connect() as src, target.begin() as dst:
+        # Rows left by an interrupted move may be stale, so copy everything afresh
+        dst.execute(table.delete().where(table.c.owner_id == user_id))
+        result = src.execution_options(stream_results=True).execute(
+            select(table).where(table.c.owner_id == user_id).order_by(*table.primary_key.columns)
+        )
+        for partition in result.mappings().partitions(batch_size):
+            dst.execute(table.insert(), [dict(row) for row in partition])
+            copied += len(partition)
+    return copied
+
+def move_user(db, user_id: int, target_shard: str, batch_size: int = 1000):
+    """Move one user's expenses and budgets to another shard.
+
+    New writes are refused (HTTP 503 + Retry-After) from the moment the
+    user is locked. Fencing the user's change clock on the source then
+    waits for writes already holding it to commit, and makes any write
+    still in flight fail when it reaches the clock, so the single copy
+    pass sees every committed write and nothing commits after it. Reads
+    keep being served from the source until routing flips.
+    """
+    router = shard_router
+    if target_shard not in router.engines:
+        raise ValueError(f"Unknown shard: {target_shard}")
+
+    user = db.get(User, user_id)
+    if user is None:
+        raise ValueError(f"Unknown user: {user_id}")
+    source_shard = router.shard_for(user)
+    if source_shard == target_shard:
+        return 0
+
+    user.shard_locked = True
+    db.commit()
+
+    source = router.engines[source_shard]
+    target = router.engines[target_shard]
+    try:
+        _set_fence(source, user_id, True)
+        moved = sum(
+            _copy_rows(model, user_id, source, target, batch_size)
+            for model in SHARDED_MODELS
+        )
+        _set_fence(target, user_id, False)
+    except BaseException:
+        _set_fence(source, user_id, False)
+        user.shard_locked = False
+        db.commit()
+        raise
+    user.shard = target_shard
+    user.shard_locked = False
+    db.commit()
+
+    with source.begin() as conn:
+        for model in SHARDED_MODELS:
+            if model is ChangeClock:
+                # Left fenced, so a write routed here before the move still fails
+                continue
+            table = model.__table__
+            conn.execute(table.delete().where(table.c.owner_id == user_id))
+    return moved
+
+def rebalance(db, batch_size: int = 1000):
+    """Move every user whose pinned shard differs from its ring position"""
+    users = db.query(User.id, User.shard).filter(User.shard.isnot(None)).all()
+
+    moved_users = 0
+    for user_id, shard in users:
+        target = shard_router.ring.node_for(user_id)
+        if target != shard:
+            move_user(db, user_id, target, batch_size)
+            moved_users += 1
+    return moved_users
+
+if __name__ == "__main__":
+    import sys
+
+    shard_router.create_tables()
+    db = SessionLocal()
+    try:
+        if len(sys.argv) == 4 and sys.argv[1] == "move":
+            rows = move_user(db, int(sys.argv[2]), sys.argv[3])
+            print(f"Moved {rows} rows for user {sys.argv[2]} to {sys.argv[3]}")
+        elif len(sys.argv) == 2 and sys.argv[1] == "rebalance":
+            print(f"Moved {rebalance(db)} users")
+        else:
+            print("Usage: python sharding.py move <user_id> <shard> | rebalance")
+    finally:
+        db.close()
@@ -0,0 +1,178 @@
+"""
+Running per-category spending statistics and anomaly scores.
+
+Every expense write adjusts one `category_stats` row per touched
+(owner_id, category_id) in O(1): count, mean and sum of squared deviations
+via Welford's algorithm (with its inverse for removals), plus a log-bucket
+quantile sketch with SKETCH_GAMMA relative accuracy. Anomaly scores are
+z-scores against those statistics, so flagging an expense never rescans the
+user's history. Statistics cover archived expenses too.
+"""
+from sqlalchemy import inspect, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+import math
+import os
+
+from models import CategoryStats, Expense
+
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "3"))
+ANOMALY_MIN_COUNT = int(os.getenv("ANOMALY_MIN_COUNT", "5"))
+SKETCH_GAMMA = 1.02
+SKETCH_MIN_VALUE = 0.01
+
+def _bucket(amount: float):
+    # Bucket i holds values in (gamma^(i-1), gamma^i]
+    return math.ceil(math.log(max(abs(amount), SKETCH_MIN_VALUE), SKETCH_GAMMA))
+
+def _bucket_value(index: int):
+    return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+
+def _adjust_sketch(stats: CategoryStats, amount: float, delta: int):
+    # Assign a new dict so the JSON column is marked dirty
+    sketch = dict(stats.sketch or {})
+    key = str(_bucket(amount))
+    count = sketch.get(key, 0) + delta
+    if count > 0:
+        sketch[key] = count
+    else:
+        sketch.pop(key, None)
+    stats.sketch = sketch
+
+def add(stats: CategoryStats, amount: float):
+    stats.count += 1
+    delta = amount - stats.mean
+    stats.mean += delta / stats.count
+    stats.m2 += delta * (amount - stats.mean)
+    _adjust_sketch(stats, amount, 1)
+
+def remove(stats: CategoryStats, amount: float):
+    if stats.count <= 1:
+        stats.count, stats.mean, stats.m2, stats.sketch = 0, 0.0, 0.0, {}
+        return
+    count = stats.count - 1
+    mean = (stats.count * stats.mean - amount) / count
+    stats.m2 = max(stats.m2 - (amount - stats.mean) * (amount - mean), 0.0)
+    stats.count, stats.mean = count, mean
+    _adjust_sketch(stats, amount, -1)
+
+def variance(stats: CategoryStats):
+    return stats.m2 / (stats.count - 1) if stats.count > 1 else 0.0
+
+def quantile(stats: CategoryStats, q: float):
+    """Approximate q-quantile from the sketch, or None when empty"""
+    if not stats.sketch:
+        return None
+    rank = q * (stats.count - 1)
+    seen = 0
+    for index, count in sorted((int(key), count) for key, count in stats.sketch.items()):
+        seen += count
+        if seen > rank:
+            return _bucket_value(index)
+    return _bucket_value(max(int(key) for key in stats.sketch))
+
+def anomaly_score(stats, amount: float):
+    """Standard deviations above the category mean, or None without enough history"""
+    if stats is None or stats.count < ANOMALY_MIN_COUNT or stats.m2 <= 0:
+        return None
+    return (amount - stats.mean) / math.sqrt(variance(stats))
+
+def _new_stats(owner_id: int, category_id: int):
+    return CategoryStats(owner_id=owner_id, category_id=category_id, count=0, mean=0.0, m2=0.0, sketch={})
+
+def load_stats(db, owner_id: int):
+    """All of a user's statistics keyed by (owner_id, category_id)"""
+    rows = db.scalars(select(CategoryStats).where(CategoryStats.owner_id == owner_id))
+    return {(row.owner_id, row.category_id): row for row in rows}
+
+def _lock_stats(db, keys):
+    return {
+        (row.owner_id, row.category_id): row
+        for row in db.scalars(
+            select(CategoryStats)
+            .where(tuple_(CategoryStats.owner_id, CategoryStats.category_id).in_(keys))
+            .with_for_update()
+        )
+    }
+
+def _insert_missing(db, keys):
+    # Concurrent first expenses in a category both get here; only one row is created
+    dialect = db.get_bind(mapper=inspect(CategoryStats)).dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(CategoryStats).on_conflict_do_nothing(index_elements=["owner_id", "category_id"])
+    elif dialect == "sqlite":
+        statement = sqlite.insert(CategoryStats).on_conflict_do_nothing(index_elements=["owner_id", "category_id"])
+    else:
+        statement = CategoryStats.__table__.insert()
+    db.execute(statement.values([
+        {"owner_id": owner_id, "category_id": category_id, "count": 0, "mean": 0.0, "m2": 0.0, "sketch": {}}
+        for owner_id, category_id in sorted(keys)
+    ]))
+
+def update_stats(db, removed=(), added=()):
+    """Apply (owner_id, category_id, amount) removals and additions in the caller's transaction.
+
+    Returns the touched statistics keyed by (owner_id, category_id).
+    """
+    keys = {(owner_id, category_id) for owner_id, category_id, _ in [*removed, *added] if category_id is not None}
+    if not keys:
+        return {}
+    stats = _lock_stats(db, keys)
+    missing = {(owner_id, category_id) for owner_id, category_id, _ in added if category_id is not None} - stats.keys()
+    if missing:
+        # FOR UPDATE can't lock a row that doesn't exist yet, so create it first
+        _insert_missing(db, missing)
+        stats.update(_lock_stats(db, missing))
+    for owner_id, category_id, amount in removed:
+        if (owner_id, category_id) in stats:
+            remove(stats[(owner_id, category_id)], amount)
+    for owner_id, category_id, amount in added:
+        if category_id is not None:
+            add(stats[(owner_id, category_id)], amount)
+    return stats
+
+def annotate(expenses, stats, category_id_for=None):
+    """Set anomaly_score on ORM expenses (and archived row dicts) from `stats`"""
+    for expense in expenses:
+        if isinstance(expense, dict):
+            key = (expense["owner_id"], category_id_for(expense) if category_id_for else None)
+            expense["anomaly_score"] = anomaly_score(stats.get(key), expense["amount"])
+        else:
+            expense.anomaly_score = anomaly_score(stats.get((expense.owner_id, expense.category_id)), expense.amount)
+    return expenses
+
+def recompute(db, owner_id: int):
+    """Statistics for a user rebuilt from scratch by scanning their expenses"""
+    stats = {}
+    rows = db.execute(
+        select(Expense.category_id, Expense.amount)
+        .where(Expense.owner_id == owner_id, Expense.category_id.isnot(None))
+        .order_by(Expense.id)
+    )
+    for category_id, amount in rows:
+        key = (owner_id, category_id)
+        if key not in stats:
+            stats[key] = _new_stats(owner_id, category_id)
+        add(stats[key], amount)
+    return stats
+
+def rebuild(db, owner_id: int):
+    """Replace a user's stored statistics with a recomputation (archived expenses drop out)"""
+    db.query(CategoryStats).filter(CategoryStats.owner_id == owner_id).delete(synchronize_session=False)
+    stats = recompute(db, owner_id)
+    db.add_all(stats.values())
+    db.commit()
+    return len(stats)
+
+if __name__ == "__main__":
+    from database import SessionLocal
+    from models import User
+    from sharding import route_session
+
+    db = SessionLocal()
+    try:
+        for user in db.query(User).all():
+            route_session(db, user)
+            rebuild(db, user.id)
+        print("Spending statistics rebuilt")
+    finally:
+        db.close()
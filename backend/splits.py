@@ -0,0 +1,304 @@
+"""
+Shared expenses split between the members of a group, and who owes whom.
+
+A group (a household, a trip) has members; any member can record an
+expense one of them paid and how it is shared, either in exact amounts or
+equally. Balances are never recomputed from the split rows on a read:
+each group keeps a pairwise ledger, one row per pair of members holding
+the net amount one owes the other, and every write adds its shares to
+those rows with an upsert in the same transaction as the split rows
+themselves. Reading balances is then one query over at most n(n-1)/2
+rows, however many expenses the group has.
+
+The settle-up plan nets each member's position from the ledger and
+repeatedly pairs the largest creditor with the largest debtor (two heaps,
+O(n log n)), so a group of n members needs at most n - 1 payments
+however tangled the pairwise debts are. Payments are recorded as
+settlements: an expense the payer covers entirely for the payee.
+
+All amounts are integer cents. check_ledger recomputes every balance
+from the split rows and reports (or repairs) any drift:
+
+    python splits.py check [--repair]
+"""
+import heapq
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import delete, func, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import ExpenseShare, GroupBalance, SharedExpense, SplitGroup, SplitGroupMember, User
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+def split_equally(total_cents: int, user_ids):
+    """Equal shares of a total; the leftover cents go one each to the lowest ids"""
+    user_ids = sorted(set(user_ids))
+    base, leftover = divmod(total_cents, len(user_ids))
+    return {user_id: base + (1 if i < leftover else 0) for i, user_id in enumerate(user_ids)}
+
+def member_ids(db, group_id: int):
+    return set(db.scalars(select(SplitGroupMember.user_id).where(SplitGroupMember.group_id == group_id)))
+
+def get_group(db, group_id: int, user_id: int):
+    """The group if the user is a member of it, else None"""
+    return db.scalar(
+        select(SplitGroup)
+        .join(SplitGroupMember, SplitGroupMember.group_id == SplitGroup.id)
+        .where(SplitGroup.id == group_id, SplitGroupMember.user_id == user_id)
+    )
+
+def get_groups(db, user_id: int):
+    return db.scalars(
+        select(SplitGroup)
+        .join(SplitGroupMember, SplitGroupMember.group_id == SplitGroup.id)
+        .where(SplitGroupMember.user_id == user_id)
+        .order_by(SplitGroup.id)
+    ).all()
+
+def group_members(db, group_ids):
+    """{group_id: [User, ...]} for the given groups"""
+    members = defaultdict(list)
+    for group_id, user in db.execute(
+        select(SplitGroupMember.group_id, User)
+        .join(User, User.id == SplitGroupMember.user_id)
+        .where(SplitGroupMember.group_id.in_(list(group_ids)))
+        .order_by(User.id)
+    ):
+        members[group_id].append(user)
+    return members
+
+def _users_by_email(db, emails):
+    emails = set(emails)
+    users = db.scalars(select(User).where(User.email.in_(emails))).all() if emails else []
+    unknown = sorted(emails - {user.email for user in users})
+    if unknown:
+        raise ValueError(f"No registered user with email: {', '.join(unknown)}")
+    return users
+
+def create_group(db, user_id: int, name: str, member_emails=()):
+    users = _users_by_email(db, member_emails)
+    group = SplitGroup(name=name, created_by=user_id)
+    db.add(group)
+    db.flush()
+    db.add_all(
+        SplitGroupMember(group_id=group.id, user_id=member_id)
+        for member_id in sorted({user_id, *(user.id for user in users)})
+    )
+    db.commit()
+    return group
+
+def add_member(db, group: SplitGroup, email: str):
+    user, = _users_by_email(db, [email])
+    if user.id not in member_ids(db, group.id):
+        db.add(SplitGroupMember(group_id=group.id, user_id=user.id))
+        db.commit()
+    return group
+
+def _add_to_ledger(db, group_id: int, payer_id: int, shares, sign: int = 1):
+    """Add (or with sign=-1 take back) what each sharer owes the payer"""
+    deltas = defaultdict(int)
+    for user_id, cents in shares.items():
+        if user_id == payer_id or not cents:
+            continue
+        low, high = sorted((user_id, payer_id))
+        deltas[(low, high)] += sign * (cents if user_id == low else -cents)
+    # Pairs in key order, so concurrent writes lock ledger rows in the same order
+    rows = [
+        {"group_id": group_id, "user_id": low, "other_id": high, "amount_cents": cents}
+        for (low, high), cents in sorted(deltas.items()) if cents
+    ]
+    if not rows:
+        return
+    dialect = db.get_bind(mapper=inspect(GroupBalance)).dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = dialect_insert(GroupBalance)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=["group_id", "user_id", "other_id"],
+            set_={"amount_cents": GroupBalance.amount_cents + statement.excluded.amount_cents},
+        ), rows)
+        return
+    for row in rows:
+        updated = db.execute(
+            update(GroupBalance)
+            .where(GroupBalance.group_id == group_id, GroupBalance.user_id == row["user_id"],
+                   GroupBalance.other_id == row["other_id"])
+            .values(amount_cents=GroupBalance.amount_cents + row["amount_cents"])
+        ).rowcount
+        if not updated:
+            db.execute(GroupBalance.__table__.insert(), [row])
+
+def add_shared_expense(db, group_id: int, user_id: int, description: str, amount: float, paid_by=None,
+                       shares=None, split_between=None, date=None, is_settlement=False):
+    """Record a split and update the ledger in one transaction; returns (expense, {user_id: cents})
+
+    `shares` are (user_id, amount) pairs; without them the amount is split
+    equally between `split_between` (default: every member).
+    """
+    members = member_ids(db, group_id)
+    paid_by = user_id if paid_by is None else paid_by
+    total = to_cents(amount)
+    if total <= 0:
+        raise ValueError("Amount must be at least 0.01")
+    if shares is not None:
+        share_cents = defaultdict(int)
+        for sharer, share in shares:
+            share_cents[sharer] += to_cents(share)
+        if sum(share_cents.values()) != total:
+            raise ValueError("Shares must add up to the amount")
+    else:
+        share_cents = split_equally(total, members if split_between is None else split_between)
+    outsiders = sorted(({paid_by} | set(share_cents)) - members)
+    if outsiders:
+        raise ValueError(f"Not members of this group: {', '.join(map(str, outsiders))}")
+
+    expense = SharedExpense(
+        group_id=group_id, description=description, amount_cents=total, paid_by=paid_by,
+        created_by=user_id, is_settlement=is_settlement, date=date or datetime.utcnow(),
+    )
+    db.add(expense)
+    db.flush()
+    db.execute(ExpenseShare.__table__.insert(), [
+        {"shared_expense_id": expense.id, "user_id": sharer, "amount_cents": cents}
+        for sharer, cents in sorted(share_cents.items())
+    ])
+    _add_to_ledger(db, group_id, paid_by, share_cents)
+    db.commit()
+    return expense, dict(share_cents)
+
+def settle(db, group_id: int, user_id: int, to_user: int, amount: float):
+    """Record that the user paid another member back"""
+    if to_user == user_id:
+        raise ValueError("Cannot settle up with yourself")
+    return add_shared_expense(
+        db, group_id, user_id, "Settlement", amount,
+        shares=[(to_user, amount)], is_settlement=True,
+    )
+
+def get_shares(db, expense_ids):
+    """{expense_id: {user_id: cents}}"""
+    shares = defaultdict(dict)
+    if expense_ids:
+        for expense_id, user_id, cents in db.execute(
+            select(ExpenseShare.shared_expense_id, ExpenseShare.user_id, ExpenseShare.amount_cents)
+            .where(ExpenseShare.shared_expense_id.in_(list(expense_ids)))
+        ):
+            shares[expense_id][user_id] = cents
+    return shares
+
+def get_shared_expenses(db, group_id: int, limit: int = 100):
+    """The group's newest expenses with their shares, as (expense, {user_id: cents})"""
+    expenses = db.scalars(
+        select(SharedExpense)
+        .where(SharedExpense.group_id == group_id)
+        .order_by(SharedExpense.date.desc(), SharedExpense.id.desc())
+        .limit(limit)
+    ).all()
+    shares = get_shares(db, [expense.id for expense in expenses])
+    return [(expense, shares[expense.id]) for expense in expenses]
+
+def delete_shared_expense(db, group_id: int, expense_id: int, user_id: int):
+    """Delete an expense the user recorded or paid, taking its shares back out of the ledger"""
+    expense = db.scalar(select(SharedExpense).where(
+        SharedExpense.id == expense_id, SharedExpense.group_id == group_id
+    ).with_for_update())
+    if expense is None or user_id not in (expense.created_by, expense.paid_by):
+        return False
+    _add_to_ledger(db, group_id, expense.paid_by, get_shares(db, [expense_id])[expense_id], sign=-1)
+    db.execute(delete(ExpenseShare).where(ExpenseShare.shared_expense_id == expense_id))
+    db.execute(delete(SharedExpense).where(SharedExpense.id == expense_id))
+    db.commit()
+    return True
+
+def pairwise_debts(db, group_id: int):
+    """[(debtor, creditor, cents)] straight from the ledger"""
+    debts = []
+    for user_id, other_id, cents in db.execute(
+        select(GroupBalance.user_id, GroupBalance.other_id, GroupBalance.amount_cents)
+        .where(GroupBalance.group_id == group_id, GroupBalance.amount_cents != 0)
+        .order_by(GroupBalance.user_id, GroupBalance.other_id)
+    ):
+        debts.append((user_id, other_id, cents) if cents > 0 else (other_id, user_id, -cents))
+    return debts
+
+def net_balances(debts, members=()):
+    """{user_id: cents}, positive for members the group owes"""
+    net = dict.fromkeys(members, 0)
+    for debtor, creditor, cents in debts:
+        net[debtor] = net.get(debtor, 0) - cents
+        net[creditor] = net.get(creditor, 0) + cents
+    return net
+
+def settle_up(net):
+    """Payments [(from, to, cents)] clearing every balance, at most one fewer than the members involved"""
+    creditors = [(-cents, user_id) for user_id, cents in net.items() if cents > 0]
+    debtors = [(cents, user_id) for user_id, cents in net.items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    payments = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        cents = min(-credit, -debt)
+        payments.append((debtor, creditor, cents))
+        # Each payment clears at least one of the two
+        if -credit > cents:
+            heapq.heappush(creditors, (credit + cents, creditor))
+        if -debt > cents:
+            heapq.heappush(debtors, (debt + cents, debtor))
+    return payments
+
+def check_ledger(db, group_id=None, repair: bool = False):
+    """Ledger rows that disagree with a recomputation from the shares: [(group, user, other, stored, expected)]"""
+    expected = defaultdict(int)
+    query = (
+        select(SharedExpense.group_id, SharedExpense.paid_by, ExpenseShare.user_id, func.sum(ExpenseShare.amount_cents))
+        .join(ExpenseShare, ExpenseShare.shared_expense_id == SharedExpense.id)
+        .where(ExpenseShare.user_id != SharedExpense.paid_by)
+        .group_by(SharedExpense.group_id, SharedExpense.paid_by, ExpenseShare.user_id)
+    )
+    stored_query = select(GroupBalance.group_id, GroupBalance.user_id, GroupBalance.other_id, GroupBalance.amount_cents)
+    if group_id is not None:
+        query = query.where(SharedExpense.group_id == group_id)
+        stored_query = stored_query.where(GroupBalance.group_id == group_id)
+    for group, payer, sharer, cents in db.execute(query):
+        low, high = sorted((sharer, payer))
+        expected[(group, low, high)] += cents if sharer == low else -cents
+    stored = {(group, low, high): cents for group, low, high, cents in db.execute(stored_query)}
+
+    mismatches = [
+        (*key, stored.get(key, 0), expected.get(key, 0))
+        for key in sorted(set(stored) | set(expected))
+        if stored.get(key, 0) != expected.get(key, 0)
+    ]
+    if repair and mismatches:
+        for group, low, high, _, cents in mismatches:
+            db.execute(delete(GroupBalance).where(
+                GroupBalance.group_id == group, GroupBalance.user_id == low, GroupBalance.other_id == high
+            ))
+            db.add(GroupBalance(group_id=group, user_id=low, other_id=high, amount_cents=cents))
+        db.commit()
+    return mismatches
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    if sys.argv[1:2] != ["check"]:
+        sys.exit("usage: python splits.py check [--repair]")
+    repair = "--repair" in sys.argv[2:]
+    db = SessionLocal()
+    try:
+        mismatches = check_ledger(db, repair=repair)
+    finally:
+        db.close()
+    for group, low, high, stored, expected in mismatches:
+        print(f"group {group}: users {low}/{high} ledger {from_cents(stored):.2f}, shares say {from_cents(expected):.2f}")
+    print(f"{len(mismatches)} mismatched balances" + (" repaired" if repair and mismatches else ""))
+    sys.exit(1 if mismatches and not repair else 0)
@@ -0,0 +1,152 @@
+"""
+Description autocomplete.
+
+Each user's distinct expense descriptions are kept in memory as a sorted
+array of case-folded keys, so a prefix lookup is a binary search plus a scan
+of the matching range, ranked by how often each description was used. An
+index is built lazily with one GROUP BY over the user's history, extended
+in place when this worker creates expenses, dropped on updates and deletes,
+and rebuilt after SUGGEST_INDEX_TTL_SECONDS to pick up writes handled by
+other workers. Indexes are evicted least-recently-used once their estimated
+size exceeds SUGGEST_MEMORY_BYTES.
+"""
+from collections import Counter, OrderedDict
+from sqlalchemy import func, select
+import bisect
+import threading
+import time
+import os
+
+from models import Expense
+
+SUGGEST_MEMORY_BYTES = int(os.getenv("SUGGEST_MEMORY_BYTES", str(64 * 1024 * 1024)))
+SUGGEST_INDEX_TTL_SECONDS = float(os.getenv("SUGGEST_INDEX_TTL_SECONDS", "300"))
+
+# Rough per-object costs, used only to enforce the memory budget
+_ENTRY_BYTES = 400
+_COUNTER_ITEM_BYTES = 100
+
+class _Entry:
+    __slots__ = ("count", "spellings", "categories", "amounts")
+
+    def __init__(self):
+        self.count = 0
+        self.spellings = Counter()
+        self.categories = Counter()
+        self.amounts = Counter()
+
+class UserIndex:
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+        self.size = 0
+        self.built_at = time.monotonic()
+
+    def add(self, description: str, category_id, amount: float, count: int = 1):
+        key = description.casefold()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = _Entry()
+            bisect.insort(self.keys, key)
+            self.size += _ENTRY_BYTES + 2 * len(key)
+        for counter, value in ((entry.spellings, description), (entry.categories, category_id), (entry.amounts, amount)):
+            if value not in counter:
+                self.size += _COUNTER_ITEM_BYTES
+            counter[value] += count
+        entry.count += count
+
+    def suggest(self, prefix: str, limit: int):
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\U0010ffff")
+        ranked = sorted(self.keys[start:end], key=lambda key: (-self.entries[key].count, key))
+        return [self.entries[key] for key in ranked[:limit]]
+
+class SuggestionCache:
+    def __init__(self, memory_bytes=SUGGEST_MEMORY_BYTES, ttl_seconds=SUGGEST_INDEX_TTL_SECONDS):
+        self.memory_bytes = memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self._indexes = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _build(self, db, user_id: int):
+        index = UserIndex()
+        rows = db.execute(
+            select(Expense.description, Expense.category_id, Expense.amount, func.count())
+            .where(Expense.owner_id == user_id, Expense.description.isnot(None))
+            .group_by(Expense.description, Expense.category_id, Expense.amount)
+        )
+        for description, category_id, amount, count in rows:
+            index.add(description, category_id, amount, count)
+        return index
+
+    def _get(self, db, user_id: int):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and time.monotonic() - index.built_at < self.ttl_seconds:
+                self._indexes.move_to_end(user_id)
+                return index
+        index = self._build(db, user_id)
+        with self._lock:
+            self._store(user_id, index)
+        return index
+
+    def _store(self, user_id: int, index: UserIndex):
+        # Called with the lock held. The total is kept running so writes don't re-add every index
+        self._discard(user_id)
+        self._indexes[user_id] = index
+        self._size += index.size
+        self._evict()
+
+    def _discard(self, user_id: int):
+        # Called with the lock held
+        index = self._indexes.pop(user_id, None)
+        if index is not None:
+            self._size -= index.size
+
+    def _evict(self):
+        # Called with the lock held; always keep the index just used
+        while self._size > self.memory_bytes and len(self._indexes) > 1:
+            _, evicted = self._indexes.popitem(last=False)
+            self._size -= evicted.size
+
+    def suggest(self, db, user_id: int, prefix: str, limit: int = 5):
+        """Top descriptions starting with `prefix`, with their most likely category id and amount"""
+        index = self._get(db, user_id)
+        with self._lock:
+            return [
+                {
+                    "description": entry.spellings.most_common(1)[0][0],
+                    "count": entry.count,
+                    "category_id": entry.categories.most_common(1)[0][0],
+                    "amount": entry.amounts.most_common(1)[0][0],
+                }
+                for entry in index.suggest(prefix, limit)
+            ]
+
+    def record(self, user_id: int, description: str, category_id, amount: float):
+        """Add a new expense to the user's index if it is loaded"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and description:
+                before = index.size
+                index.add(description, category_id, amount)
+                self._size += index.size - before
+                self._indexes.move_to_end(user_id)
+                self._evict()
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._discard(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._size = 0
+
+suggestion_cache = SuggestionCache()
@@ -0,0 +1,311 @@
+"""
+Expense tags and the per-user tag bitmap index.
+
+An expense can carry any number of free-form tags (trip, reimbursable,
+client X). `tags=a,b` on the list and summary endpoints keeps expenses
+having all of the tags, `any_tags=a,b` those having at least one.
+
+Filters are answered from memory rather than with a join per tag. Each
+user's index gives every tagged expense a bit position and keeps one bitmap
+(a Python int) per tag, so "all of" is an AND and "any of" an OR of a few
+integers; the matching ids then reach the expense query as one IN list.
+The index also maps each expense to its tags, for the `tags` field of
+responses. It is built lazily with one query over the user's tag
+assignments, and kept current from the change log that every expense
+write appends to: a read first checks the user's change sequence number
+(which, unlike change log ids, grows in commit order), and re-reads the
+tags of expenses written since. Indexes are rebuilt after
+TAG_INDEX_TTL_SECONDS, and evicted least-recently-used once their
+estimated size exceeds TAG_INDEX_MEMORY_BYTES.
+"""
+from array import array
+from collections import OrderedDict
+from sqlalchemy import bindparam, delete, false, insert, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+import threading
+import time
+import os
+
+import numpy as np
+
+from models import ChangeClock, ChangeLog, ExpenseTag, Tag
+
+TAG_INDEX_MEMORY_BYTES = int(os.getenv("TAG_INDEX_MEMORY_BYTES", str(128 * 1024 * 1024)))
+TAG_INDEX_TTL_SECONDS = float(os.getenv("TAG_INDEX_TTL_SECONDS", "300"))
+# More changes than this since the index was built and it is rebuilt instead
+TAG_INDEX_CATCH_UP = 1000
+
+# Rough per-object costs, used only to enforce the memory budget
+_EXPENSE_BYTES = 200
+_TAG_BYTES = 200
+
+def normalize(names):
+    """Stripped, de-duplicated tag names, sorted as they are in responses"""
+    return sorted({name.strip() for name in names or ()} - {""})
+
+def parse_tags(value):
+    """Comma-separated tag names from a query parameter, or None"""
+    return normalize(value.split(",")) or None if value else None
+
+def id_filter(column, ids):
+    """`column IN ids`, rendered inline so a long list doesn't hit bound parameter limits"""
+    if not ids:
+        return false()
+    return column.in_(bindparam(f"{column.key}_ids", list(ids), expanding=True, literal_execute=True))
+
+def latest_change(db, user_id: int):
+    return db.scalar(select(ChangeClock.seq).where(ChangeClock.owner_id == user_id)) or 0
+
+def _bit_positions(bits: int):
+    if not bits:
+        return np.empty(0, dtype=np.int64)
+    raw = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little"))
+
+class UserTagIndex:
+    def __init__(self, version: int):
+        self.version = version
+        self.positions = {}
+        self.expense_ids = array("q")
+        self.tags_of = {}
+        self.bitmaps = {}
+        self.names = {}
+        self.ids = {}
+        self.built_at = time.monotonic()
+
+    @property
+    def size(self):
+        return (
+            len(self.tags_of) * _EXPENSE_BYTES + len(self.names) * _TAG_BYTES
+            + sum(bitmap.bit_length() // 8 for bitmap in self.bitmaps.values())
+        )
+
+    def add_tag(self, tag_id: int, name: str):
+        self.names[tag_id] = name
+        self.ids[name] = tag_id
+        self.bitmaps.setdefault(tag_id, 0)
+
+    def set_tags(self, expense_id: int, tag_ids):
+        """Replace an expense's tags (an empty list removes it)"""
+        tag_ids = tuple(sorted(set(tag_ids)))
+        old = self.tags_of.get(expense_id, ())
+        if old == tag_ids:
+            return
+        position = self.positions.get(expense_id)
+        if position is None:
+            position = self.positions[expense_id] = len(self.expense_ids)
+            self.expense_ids.append(expense_id)
+        bit = 1 << position
+        for tag_id in old:
+            self.bitmaps[tag_id] &= ~bit
+        for tag_id in tag_ids:
+            self.bitmaps[tag_id] |= bit
+        if tag_ids:
+            self.tags_of[expense_id] = tag_ids
+        else:
+            self.tags_of.pop(expense_id, None)
+
+    def load(self, tags_of):
+        """Fill an empty index from {expense_id: tag_ids}, packing each bitmap in one go"""
+        members = {tag_id: [] for tag_id in self.bitmaps}
+        for expense_id, tag_ids in tags_of.items():
+            self.positions[expense_id] = len(self.expense_ids)
+            self.tags_of[expense_id] = tag_ids = tuple(sorted(set(tag_ids)))
+            for tag_id in tag_ids:
+                members.setdefault(tag_id, []).append(len(self.expense_ids))
+            self.expense_ids.append(expense_id)
+        for tag_id, positions in members.items():
+            bits = np.zeros(len(self.expense_ids), dtype=bool)
+            bits[positions] = True
+            self.bitmaps[tag_id] = int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+
+    def match(self, all_of=(), any_of=()):
+        """Ids of expenses having every tag in `all_of` and at least one in `any_of`"""
+        bits = None
+        for name in all_of:
+            bitmap = self.bitmaps.get(self.ids.get(name), 0)
+            bits = bitmap if bits is None else bits & bitmap
+        if any_of:
+            either = 0
+            for name in any_of:
+                either |= self.bitmaps.get(self.ids.get(name), 0)
+            bits = either if bits is None else bits & either
+        positions = _bit_positions(bits or 0)
+        return np.frombuffer(self.expense_ids, dtype=np.int64)[positions].tolist() if len(positions) else []
+
+    def tag_names(self, expense_id: int):
+        return sorted(self.names[tag_id] for tag_id in self.tags_of.get(expense_id, ()))
+
+class TagIndex:
+    def __init__(self, memory_bytes=TAG_INDEX_MEMORY_BYTES, ttl_seconds=TAG_INDEX_TTL_SECONDS):
+        self.memory_bytes = memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _build(self, db, user_id: int):
+        index = UserTagIndex(latest_change(db, user_id))
+        for tag_id, name in db.execute(select(Tag.id, Tag.name).where(Tag.owner_id == user_id)):
+            index.add_tag(tag_id, name)
+        tags_of = {}
+        for expense_id, tag_id in db.execute(
+            select(ExpenseTag.expense_id, ExpenseTag.tag_id)
+            .where(ExpenseTag.owner_id == user_id)
+            .order_by(ExpenseTag.expense_id)
+        ):
+            tags_of.setdefault(expense_id, []).append(tag_id)
+        # Positions in id order, so bitmaps of older expenses stay dense
+        index.load(tags_of)
+        return index
+
+    def _catch_up(self, db, user_id: int, index: UserTagIndex):
+        """Apply expense writes since the index's sequence number; False if a rebuild is cheaper"""
+        latest = latest_change(db, user_id)
+        if latest <= index.version:
+            return True
+        changes = db.execute(
+            select(ChangeLog.entity_id, ChangeLog.op)
+            .where(
+                ChangeLog.owner_id == user_id, ChangeLog.entity == "expense",
+                ChangeLog.seq > index.version, ChangeLog.seq <= latest,
+            )
+            .order_by(ChangeLog.seq)
+            .limit(TAG_INDEX_CATCH_UP + 1)
+        ).all()
+        if len(changes) > TAG_INDEX_CATCH_UP:
+            return False
+        last_op = dict(changes)
+        upserted = [expense_id for expense_id, op in last_op.items() if op == "upsert"]
+        tags_of = {}
+        if upserted:
+            for expense_id, tag_id in db.execute(
+                select(ExpenseTag.expense_id, ExpenseTag.tag_id)
+                .where(ExpenseTag.owner_id == user_id, id_filter(ExpenseTag.expense_id, upserted))
+            ):
+                tags_of.setdefault(expense_id, []).append(tag_id)
+        new_tags = {tag_id for tag_ids in tags_of.values() for tag_id in tag_ids} - set(index.names)
+        names = db.execute(select(Tag.id, Tag.name).where(id_filter(Tag.id, new_tags))).all() if new_tags else []
+        with self._lock:
+            for tag_id, name in names:
+                index.add_tag(tag_id, name)
+            for expense_id in last_op:
+                index.set_tags(expense_id, tags_of.get(expense_id, ()))
+            index.version = max(index.version, latest)
+        return True
+
+    def _get(self, db, user_id: int):
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and time.monotonic() - index.built_at < self.ttl_seconds:
+                self._indexes.move_to_end(user_id)
+            else:
+                index = None
+        if index is not None and self._catch_up(db, user_id, index):
+            return index
+        index = self._build(db, user_id)
+        with self._lock:
+            self._indexes[user_id] = index
+            self._indexes.move_to_end(user_id)
+            self._evict()
+        return index
+
+    def _evict(self):
+        # Called with the lock held; always keep the index just used
+        total = sum(index.size for index in self._indexes.values())
+        while total > self.memory_bytes and len(self._indexes) > 1:
+            _, evicted = self._indexes.popitem(last=False)
+            total -= evicted.size
+
+    def match(self, db, user_id: int, all_of=(), any_of=()):
+        """Ids of the user's expenses matching the tag filters"""
+        index = self._get(db, user_id)
+        with self._lock:
+            return index.match(all_of or (), any_of or ())
+
+    def annotate(self, db, user_id: int, expenses):
+        """Set `tags` on each expense (entity or field dict)"""
+        if not expenses:
+            return expenses
+        index = self._get(db, user_id)
+        with self._lock:
+            for expense in expenses:
+                if isinstance(expense, dict):
+                    expense["tags"] = index.tag_names(expense["id"])
+                else:
+                    expense.tags = index.tag_names(expense.id)
+        return expenses
+
+    def counts(self, db, user_id: int):
+        """Each of the user's tags with its number of expenses, most used first"""
+        index = self._get(db, user_id)
+        with self._lock:
+            counts = [
+                {"name": index.names[tag_id], "count": bitmap.bit_count()}
+                for tag_id, bitmap in index.bitmaps.items() if bitmap
+            ]
+        return sorted(counts, key=lambda tag: (-tag["count"], tag["name"]))
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._indexes.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+tag_index = TagIndex()
+
+def resolve(db, user_id: int, names):
+    """Ids for tag names, creating missing tags inside the caller's transaction"""
+    from sharding import allocate_id
+
+    ids = dict(db.execute(select(Tag.name, Tag.id).where(Tag.owner_id == user_id, Tag.name.in_(names))).all())
+    missing = [name for name in names if name not in ids]
+    if missing:
+        rows = []
+        for name in missing:
+            row = {"owner_id": user_id, "name": name}
+            new_id = allocate_id(Tag)
+            if new_id is not None:
+                row["id"] = new_id
+            rows.append(row)
+        dialect = db.get_bind(mapper=inspect(Tag)).dialect.name
+        if dialect == "postgresql":
+            statement = postgresql.insert(Tag).on_conflict_do_nothing(index_elements=["owner_id", "name"])
+        elif dialect == "sqlite":
+            statement = sqlite.insert(Tag).on_conflict_do_nothing(index_elements=["owner_id", "name"])
+        else:
+            statement = Tag.__table__.insert()
+        db.execute(statement, rows)
+        # Includes any a concurrent request created first
+        ids.update(db.execute(select(Tag.name, Tag.id).where(Tag.owner_id == user_id, Tag.name.in_(missing))).all())
+    return [ids[name] for name in names]
+
+def tag_expenses(db, assignments):
+    """Tag new expenses from (owner_id, expense_id, names) in the caller's transaction"""
+    names_by_user = {}
+    for user_id, _, names in assignments:
+        names_by_user.setdefault(user_id, set()).update(names)
+    ids = {
+        user_id: dict(zip(sorted(names), resolve(db, user_id, sorted(names))))
+        for user_id, names in names_by_user.items() if names
+    }
+    rows = [
+        {"owner_id": user_id, "expense_id": expense_id, "tag_id": ids[user_id][name]}
+        for user_id, expense_id, names in assignments
+        for name in names
+    ]
+    if rows:
+        db.execute(insert(ExpenseTag), rows)
+
+def untag_expense(db, user_id: int, expense_id: int):
+    db.execute(delete(ExpenseTag).where(ExpenseTag.owner_id == user_id, ExpenseTag.expense_id == expense_id))
+
+def tag_names(db, user_id: int, expense_id: int):
+    """One expense's tag names, read directly (cheaper than the index for a single row)"""
+    return list(db.scalars(
+        select(Tag.name)
+        .join(ExpenseTag, ExpenseTag.tag_id == Tag.id)
+        .where(ExpenseTag.owner_id == user_id, ExpenseTag.expense_id == expense_id)
+        .order_by(Tag.name)
+    ))
@@ -1,12 +1,30 @@
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from datetime import date, datetime
+import gzip
+import io
+import json
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+import zstandard
 
 from main import app
+import database
+import password_resets
+import reports
+import revocation
+import sharding
 from database import Base, get_db
-from models import User, Expense, Budget
+from models import User, Expense, Budget, Category
+from categories import category_cache
+from suggestions import suggestion_cache
+from ratelimit import rate_limiter
+from idempotency import idempotency_store
+from tags import tag_index
+from schemas import ExpenseCreate
 
 # Test database setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -21,12 +39,25 @@ def override_get_db():
         db.close()
 
 app.dependency_overrides[get_db] = override_get_db
+revocation.revocations.session_factory = TestingSessionLocal
+reports.report_runner.session_factory = TestingSessionLocal
+password_resets.reset_purger.bind = engine
+# Purges run only when a test asks for one
+password_resets.reset_purger.interval_seconds = float("inf")
 
 @pytest.fixture(scope="function")
 def test_db():
+    # Ids are reused once the tables are recreated
+    category_cache.clear()
+    suggestion_cache.clear()
+    rate_limiter.clear()
+    idempotency_store.clear()
+    tag_index.clear()
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
+    category_cache.clear()
+    suggestion_cache.clear()
 
 @pytest.fixture
 def client(test_db):
@@ -331,6 +362,2249 @@ def test_update_budget(client, auth_token):
     assert data["amount"] == 1500.00
     print("✓ Update budget test passed")
 
+# ==================== EXPORT TESTS ====================
+
+def _create_export_expenses(client, auth_token):
+    for description, amount, category in [
+        ("Lunch, with friends", 20.50, "Food"),
+        ("Bus pass", 45.00, "Transport"),
+        ("Movie \"night\"", 12.00, "Entertainment"),
+    ]:
+        client.post(
+            "/expenses",
+            json={"description": description, "amount": amount, "category": category},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+def _export(client, auth_token, export_format):
+    response = client.get(
+        f"/expenses/export?format={export_format}",
+        headers={"Authorization": f"Bearer {auth_token}"}
+    )
+    assert response.status_code == 200
+    return response
+
+def test_export_csv_layout(client, auth_token):
+    """Test the CSV export keeps its original column layout"""
+    _create_export_expenses(client, auth_token)
+    
+    legacy = client.get(
+        "/expenses/export/csv",
+        headers={"Authorization": f"Bearer {auth_token}"}
+    )
+    assert legacy.status_code == 200
+    assert legacy.content == _export(client, auth_token, "csv").content
+    
+    df = pd.read_csv(io.BytesIO(legacy.content))
+    assert list(df.columns) == ["id", "description", "amount", "category", "date"]
+    assert len(df) == 3
+    assert "Lunch, with friends" in df["description"].tolist()
+    print("✓ CSV export layout test passed")
+
+def test_export_formats_round_trip(client, auth_token):
+    """Test every export format round-trips to the same rows as CSV"""
+    _create_export_expenses(client, auth_token)
+    expected = pd.read_csv(io.BytesIO(_export(client, auth_token, "csv").content))
+    
+    gz = _export(client, auth_token, "csv.gz").content
+    zst = _export(client, auth_token, "csv.zst").content
+    ndjson = _export(client, auth_token, "ndjson").content
+    parquet = _export(client, auth_token, "parquet").content
+    
+    decoded = {
+        "csv.gz": pd.read_csv(io.BytesIO(gzip.decompress(gz))),
+        "csv.zst": pd.read_csv(io.BytesIO(
+            zstandard.ZstdDecompressor().decompressobj().decompress(zst)
+        )),
+        "ndjson": pd.DataFrame([json.loads(line) for line in ndjson.decode().splitlines()]),
+        "parquet": pq.read_table(io.BytesIO(parquet)).to_pandas(),
+    }
+    
+    for export_format, df in decoded.items():
+        assert list(df.columns) == list(expected.columns), export_format
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False, obj=export_format)
+    print("✓ Export formats round-trip test passed")
+
+def test_export_parquet_row_groups(client, auth_token):
+    """Test Parquet export writes one row group per streamed batch"""
+    from crud import iter_expense_rows
+    from exporters import stream_parquet
+    
+    _create_export_expenses(client, auth_token)
+    db = TestingSessionLocal()
+    try:
+        user = db.query(User).first()
+        data = b"".join(stream_parquet(iter_expense_rows(db, user.id, batch_size=2)))
+    finally:
+        db.close()
+    
+    parquet_file = pq.ParquetFile(io.BytesIO(data))
+    assert parquet_file.num_row_groups == 2
+    assert parquet_file.metadata.num_rows == 3
+    print("✓ Parquet row group test passed")
+
+def test_export_invalid_format(client, auth_token):
+    """Test export with an unsupported format"""
+    response = client.get(
+        "/expenses/export?format=xml",
+        headers={"Authorization": f"Bearer {auth_token}"}
+    )
+    
+    assert response.status_code == 400
+    print("✓ Invalid export format test passed")
+
+# ==================== READ REPLICA TESTS ====================
+
+def _use_replicas(urls, **kwargs):
+    router = database.ReplicaRouter(urls, **kwargs)
+    for replica_engine in router.engines:
+        Base.metadata.create_all(bind=replica_engine)
+    database.replica_router = router
+    return router
+
+@pytest.fixture
+def replicas(test_db, tmp_path):
+    original = database.replica_router
+    router = _use_replicas([f"sqlite:///{tmp_path}/replica_{name}.db" for name in ("a", "b")])
+    yield router
+    database.replica_router = original
+    for replica_engine in router.engines:
+        Base.metadata.drop_all(bind=replica_engine)
+        replica_engine.dispose()
+
+def _replicate_users(router):
+    """Copy users from the primary so replicas can authenticate requests"""
+    db = TestingSessionLocal()
+    users = db.query(User).all()
+    other_id = category_cache.get_or_create(db, users[0].id, "Other")
+    db.commit()
+    categories = db.query(Category).all()
+    for make_session in router.sessionmakers:
+        replica_db = make_session()
+        for user in users:
+            replica_db.merge(User(
+                id=user.id, email=user.email, hashed_password=user.hashed_password,
+                full_name=user.full_name, is_active=user.is_active, created_at=user.created_at
+            ))
+        for category in categories:
+            replica_db.merge(Category(id=category.id, owner_id=category.owner_id, name=category.name))
+        replica_db.add(Expense(
+            description=f"replica {make_session.kw['bind'].url.database}",
+            amount=1.0, category_id=other_id, owner_id=users[0].id
+        ))
+        replica_db.commit()
+        replica_db.close()
+    db.close()
+
+def test_reads_balance_across_replicas(client, auth_token, replicas):
+    """Test GET endpoints are spread over the configured replicas"""
+    _replicate_users(replicas)
+    
+    seen = set()
+    for _ in range(4):
+        response = client.get("/expenses", headers={"Authorization": f"Bearer {auth_token}"})
+        assert response.status_code == 200
+        seen.add(response.json()[0]["description"])
+    
+    assert seen == {f"replica {replica_engine.url.database}" for replica_engine in replicas.engines}
+    print("✓ Replica load balancing test passed")
+
+def test_reads_stick_to_primary_after_write(client, auth_token, replicas):
+    """Test a client reads its own writes right after writing"""
+    _replicate_users(replicas)
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    client.post("/expenses", json={"description": "Fresh", "amount": 5.0}, headers=headers)
+    response = client.get("/expenses", headers=headers)
+    
+    assert [e["description"] for e in response.json()] == ["Fresh"]
+    print("✓ Read-your-writes stickiness test passed")
+
+def test_reads_stick_to_primary_on_other_workers(client, auth_token, replicas):
+    """Test the stickiness cookie keeps a writer on the primary where the write wasn't seen"""
+    _replicate_users(replicas)
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    response = client.post("/expenses", json={"description": "Fresh", "amount": 5.0}, headers=headers)
+    assert database.STICKY_COOKIE in response.cookies
+    # Another worker never saw the write in its own memory
+    replicas._recent_writes.clear()
+    assert [e["description"] for e in client.get("/expenses", headers=headers).json()] == ["Fresh"]
+    
+    client.cookies.clear()
+    assert client.get("/expenses", headers=headers).json()[0]["description"].startswith("replica")
+    print("✓ Cross-worker stickiness test passed")
+
+def test_new_users_read_before_replicas_catch_up(client, replicas, test_user_data):
+    """Test a just-registered user is authenticated on the primary when replicas lack the row"""
+    assert database.STICKY_COOKIE in client.post("/register", json=test_user_data).cookies
+    response = client.post("/login", data={"username": test_user_data["email"], "password": test_user_data["password"]})
+    assert database.STICKY_COOKIE in response.cookies
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    # Even without the cookie, a user missing from the replica is looked up on the primary
+    client.cookies.clear()
+    response = client.get("/users/profile", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["email"] == test_user_data["email"]
+    
+    # A revocation the replica hasn't received yet still applies
+    _replicate_users(replicas)
+    assert client.post("/logout", headers=headers).status_code == 200
+    client.cookies.clear()
+    replicas._recent_writes.clear()
+    assert client.get("/users/profile", headers=headers).status_code == 401
+    print("✓ Replica lag authentication test passed")
+
+def test_reads_fall_back_to_primary(client, auth_token, test_db):
+    """Test reads use the primary when no replica can be reached"""
+    original = database.replica_router
+    database.replica_router = database.ReplicaRouter(["sqlite:////nonexistent/dir/replica.db"])
+    try:
+        db = TestingSessionLocal()
+        user_id = db.query(User).first().id
+        db.add(Expense(description="Primary", amount=5.0, category_id=category_cache.get_or_create(db, user_id, "Other"), owner_id=user_id))
+        db.commit()
+        db.close()
+        response = client.get("/expenses", headers={"Authorization": f"Bearer {auth_token}"})
+    finally:
+        database.replica_router = original
+    
+    assert response.status_code == 200
+    assert response.json()[0]["description"] == "Primary"
+    print("✓ Replica fallback test passed")
+
+# ==================== SHARDING TESTS ====================
+
+@pytest.fixture
+def shards(test_db, tmp_path):
+    original = sharding.shard_router
+    router = sharding.ShardRouter([f"sqlite:///{tmp_path}/shard_{i}.db" for i in range(3)], primary_engine=engine)
+    router.create_tables()
+    sharding.shard_router = router
+    yield router
+    sharding.shard_router = original
+    for shard_engine in router.engines.values():
+        Base.metadata.drop_all(bind=shard_engine, tables=[model.__table__ for model in sharding.SHARDED_MODELS])
+        shard_engine.dispose()
+
+def _shard_expense_ids(router, shard):
+    with router.engines[shard].connect() as conn:
+        return sorted(conn.execute(select(Expense.id)).scalars())
+
+def test_hash_ring_is_consistent():
+    """Test adding a shard only moves keys onto the new shard"""
+    before = sharding.HashRing(["shard0", "shard1", "shard2"])
+    after = sharding.HashRing(["shard0", "shard1", "shard2", "shard3"])
+    
+    moved = [key for key in range(10000) if before.node_for(key) != after.node_for(key)]
+    
+    assert all(after.node_for(key) == "shard3" for key in moved)
+    assert 1500 < len(moved) < 3500
+    print("✓ Consistent hash ring test passed")
+
+def test_expenses_written_to_owner_shard(client, auth_token, shards):
+    """Test expenses are stored on the shard chosen for their owner"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    ids = [
+        client.post("/expenses", json={"description": f"E{i}", "amount": 1.0}, headers=headers).json()["id"]
+        for i in range(3)
+    ]
+    
+    db = TestingSessionLocal()
+    user = db.query(User).first()
+    db.close()
+    
+    assert user.shard == shards.ring.node_for(user.id)
+    assert _shard_expense_ids(shards, user.shard) == sorted(ids)
+    response = client.get("/expenses", headers=headers)
+    assert sorted(e["id"] for e in response.json()) == sorted(ids)
+    print("✓ Shard placement test passed")
+
+def test_move_user_between_shards(client, auth_token, shards):
+    """Test moving a user's rows keeps ids and API results intact"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    for i in range(5):
+        client.post("/expenses", json={"description": f"E{i}", "amount": 1.0}, headers=headers)
+    client.post("/budgets", json={"month": 1, "year": 2025, "amount": 10.0}, headers=headers)
+    before = client.get("/expenses", headers=headers).json()
+    
+    db = TestingSessionLocal()
+    user = db.query(User).first()
+    source = user.shard
+    target = next(name for name in shards.engines if name != source)
+    moved = sharding.move_user(db, user.id, target, batch_size=2)
+    db.close()
+    
+    # 5 expenses, 1 budget and its tracker, 6 change log rows and their clock, the 2 categories they use
+    # and 1 stats row; the source keeps only the fenced clock
+    assert moved == 17
+    assert _shard_expense_ids(shards, source) == []
+    assert client.get("/expenses", headers=headers).json() == before
+    assert len(client.get("/budgets", headers=headers).json()) == 1
+    print("✓ Shard move test passed")
+
+def test_move_fences_writes_in_flight(client, auth_token, shards):
+    """Test a write routed before a move fails rather than committing to the old shard"""
+    from fastapi import HTTPException
+    from crud import create_expense
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    client.post("/expenses", json={"description": "Before", "amount": 1.0}, headers=headers)
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    source = db.get(User, user_id).shard
+    target = next(name for name in shards.engines if name != source)
+    in_flight = TestingSessionLocal()
+    sharding.route_session(in_flight, in_flight.get(User, user_id))
+    sharding.move_user(db, user_id, target)
+    db.close()
+    
+    with pytest.raises(HTTPException) as error:
+        create_expense(in_flight, ExpenseCreate(description="Late", amount=1.0), user_id)
+    assert error.value.status_code == 503
+    in_flight.close()
+    assert _shard_expense_ids(shards, source) == []
+    assert [e["description"] for e in client.get("/expenses", headers=headers).json()] == ["Before"]
+    print("✓ Shard move in-flight fence test passed")
+
+def test_writes_fenced_while_moving(client, auth_token, shards):
+    """Test writes are rejected with a retry hint while a user is being moved"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    client.post("/expenses", json={"description": "E", "amount": 1.0}, headers=headers)
+    
+    db = TestingSessionLocal()
+    db.query(User).update({User.shard_locked: True})
+    db.commit()
+    db.close()
+    
+    response = client.post("/expenses", json={"description": "F", "amount": 1.0}, headers=headers)
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert client.get("/expenses", headers=headers).status_code == 200
+    print("✓ Shard write fence test passed")
+
+def test_shard_columns_added_to_existing_users_table(tmp_path):
+    """Test a users table from before sharding gains the placement columns"""
+    from sqlalchemy import text
+
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with legacy.begin() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR, hashed_password VARCHAR, "
+                          "full_name VARCHAR, is_active BOOLEAN, created_at DATETIME)"))
+        conn.execute(text("INSERT INTO users (id, email, hashed_password) VALUES (1, 'a@example.com', 'x')"))
+
+    database.add_columns(legacy, User, {"shard": None, "shard_locked": "FALSE"})
+    database.add_columns(legacy, User, {"shard": None, "shard_locked": "FALSE"})
+
+    db = sessionmaker(bind=legacy)()
+    user = db.get(User, 1)
+    assert user.shard is None and user.shard_locked is False
+    db.close()
+    print("✓ Shard column migration test passed")
+
+# ==================== PARTITIONING TESTS ====================
+
+def test_month_filter_uses_date_bounds(client, auth_token):
+    """Test month filters select one calendar month of one year"""
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    food_id = category_cache.get_or_create(db, user_id, "Food")
+    for day in [datetime(2024, 3, 31, 23, 59), datetime(2025, 3, 1), datetime(2025, 3, 31, 23, 59), datetime(2025, 4, 1)]:
+        db.add(Expense(description=day.isoformat(), amount=10.0, category_id=food_id, date=day, owner_id=user_id))
+    db.commit()
+    db.close()
+    
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    expenses = client.get("/expenses?month=3&year=2025", headers=headers).json()
+    summary = client.get("/expenses/summary?month=3&year=2025", headers=headers).json()
+    
+    assert sorted(e["description"] for e in expenses) == ["2025-03-01T00:00:00", "2025-03-31T23:59:00"]
+    assert summary["total_count"] == 2
+    assert summary["year"] == 2025
+    assert client.get("/expenses?month=13", headers=headers).status_code == 422
+    print("✓ Month date bounds test passed")
+
+def test_partitioned_table_ddl():
+    """Test the partitioned expenses DDL keys partitions on date"""
+    import partitioning
+    from datetime import date
+    
+    ddl = partitioning.partitioned_table_ddl()
+    assert "PARTITION BY RANGE (date)" in ddl[0]
+    assert "PRIMARY KEY (id, date)" in ddl[0]
+    assert "id SERIAL" in ddl[0]
+    assert "REFERENCES users" not in partitioning.partitioned_table_ddl(include_foreign_keys=False)[0]
+    
+    bounds = partitioning.partition_bounds(date(2025, 11, 15), date(2026, 1, 1), "month")
+    assert bounds == [
+        ("expenses_y2025m11", date(2025, 11, 1), date(2025, 12, 1)),
+        ("expenses_y2025m12", date(2025, 12, 1), date(2026, 1, 1)),
+        ("expenses_y2026m01", date(2026, 1, 1), date(2026, 2, 1)),
+    ]
+    
+    assert len(partitioning.new_partition_ddl("expenses_y2026m01", date(2026, 1, 1), date(2026, 2, 1))) == 1
+    moved = partitioning.new_partition_ddl("expenses_y2026m01", date(2026, 1, 1), date(2026, 2, 1), from_default=True)
+    assert moved[0] == "ALTER TABLE expenses DETACH PARTITION expenses_default"
+    assert moved[2] == (
+        "INSERT INTO expenses_y2026m01 SELECT * FROM expenses_default "
+        "WHERE date >= '2026-01-01' AND date < '2026-02-01'"
+    )
+    assert moved[-1] == "ALTER TABLE expenses ATTACH PARTITION expenses_default DEFAULT"
+    print("✓ Partition DDL test passed")
+
+def test_partitions_maintained_while_running(monkeypatch):
+    """Test a long-running server keeps creating partitions, at most once per interval"""
+    import partitioning
+    runs = []
+    monkeypatch.setattr(partitioning, "is_enabled", lambda bind: True)
+    monkeypatch.setattr(partitioning, "create_future_partitions", lambda bind: runs.append(bind))
+    maintainer = partitioning.PartitionMaintainer(bind=database.engine, interval_seconds=60)
+    assert maintainer.maybe_maintain() is None
+    
+    maintainer._last_run -= 61
+    maintainer.maybe_maintain().join()
+    assert maintainer.maybe_maintain() is None
+    assert runs == [database.engine]
+    print("✓ Partition maintenance test passed")
+
+# ==================== ARCHIVE TESTS ====================
+
+def test_archived_expenses_merge_with_hot_rows(client, auth_token, tmp_path, monkeypatch):
+    """Test archived expenses still show up in listings, summaries and exports"""
+    import archive
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    food_id = category_cache.get_or_create(db, user_id, "Food")
+    old = [datetime(2020, 5, 3), datetime(2020, 5, 20), datetime(2021, 1, 9)]
+    for i, day in enumerate(old):
+        db.add(Expense(description=f"Old {i}", amount=10.0 * (i + 1), category_id=food_id, date=day, owner_id=user_id))
+    db.commit()
+    client.post("/expenses", json={"description": "Recent", "amount": 5.0, "category": "Transport"}, headers=headers)
+    
+    before_list = client.get("/expenses", headers=headers).json()
+    before_summary = client.get("/expenses/summary", headers=headers).json()
+    before_csv = client.get("/expenses/export?format=csv", headers=headers).content
+    
+    assert archive.archive_expenses(db, horizon_days=365) == 3
+    assert db.query(Expense).count() == 1
+    db.close()
+    
+    assert client.get("/expenses", headers=headers).json() == before_list
+    assert client.get("/expenses/summary", headers=headers).json() == before_summary
+    assert client.get("/expenses/export?format=csv", headers=headers).content == before_csv
+    
+    may_2020 = client.get("/expenses/summary?month=5&year=2020", headers=headers).json()
+    assert may_2020["total_expenses"] == 30.0
+    assert may_2020["total_count"] == 2
+    food = client.get("/expenses?category=Food&month=5&year=2020", headers=headers).json()
+    assert [e["description"] for e in food] == ["Old 1", "Old 0"]
+    print("✓ Archive merge test passed")
+
+def test_archive_job_is_idempotent(client, auth_token, tmp_path, monkeypatch):
+    """Test re-running the archive job does not duplicate rows or rollups"""
+    import archive
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    food_id = category_cache.get_or_create(db, user_id, "Food")
+    db.add(Expense(description="Old", amount=10.0, category_id=food_id, date=datetime(2020, 1, 1), owner_id=user_id))
+    db.commit()
+    archive.archive_expenses(db, horizon_days=365)
+    archive.archive_expenses(db, horizon_days=365)
+    db.close()
+    
+    assert archive.read_archive(user_id).num_rows == 1
+    summary = client.get("/expenses/summary", headers={"Authorization": f"Bearer {auth_token}"}).json()
+    assert summary["total_count"] == 1
+    print("✓ Archive idempotency test passed")
+
+def test_archive_replaces_stale_copies_and_keeps_late_rows(client, auth_token, tmp_path, monkeypatch):
+    """Test an interrupted run's stale copy is replaced and rows added mid-run stay in the database"""
+    import archive
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    food_id = category_cache.get_or_create(db, user_id, "Food")
+    expense = Expense(description="Edited", amount=10.0, category_id=food_id, date=datetime(2020, 1, 1), owner_id=user_id)
+    db.add(expense)
+    db.commit()
+    # Left behind by a run whose database commit failed, before the user edited the row
+    stale = dict(id=expense.id, description="Original", amount=5.0, category="Food", date=datetime(2020, 1, 1))
+    archive._write_archive(user_id, archive.pa.Table.from_pylist([stale], schema=archive.ARCHIVE_SCHEMA))
+    
+    read_archive = archive.read_archive
+    def backdate_during_run(owner_id):
+        other = TestingSessionLocal()
+        other.add(Expense(description="Late", amount=1.0, category_id=food_id, date=datetime(2020, 2, 1), owner_id=user_id))
+        other.commit()
+        other.close()
+        return read_archive(owner_id)
+    monkeypatch.setattr(archive, "read_archive", backdate_during_run)
+    assert archive.archive_user(db, user_id, datetime(2021, 1, 1)) == 1
+    monkeypatch.setattr(archive, "read_archive", read_archive)
+    
+    rows = archive.read_archive(user_id).to_pylist()
+    assert [(row["description"], row["amount"]) for row in rows] == [("Edited", 10.0)]
+    assert [e.description for e in db.query(Expense).filter(Expense.owner_id == user_id)] == ["Late"]
+    db.close()
+    print("✓ Archive stale copy test passed")
+
+def test_archive_reads_only_needed_batches(test_db, tmp_path, monkeypatch):
+    """Test archived rows are stored newest first and read a batch at a time"""
+    import archive
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(archive, "ARCHIVE_BATCH_ROWS", 2)
+
+    db = TestingSessionLocal()
+    user = User(email="archive@example.com", hashed_password="x")
+    db.add(user)
+    db.commit()
+    food_id = category_cache.get_or_create(db, user.id, "Food")
+    for month in (3, 1, 5, 2, 4):
+        db.add(Expense(description=f"M{month}", amount=float(month), category_id=food_id,
+                       date=datetime(2020, month, 1), owner_id=user.id))
+    db.commit()
+    archive.archive_expenses(db, horizon_days=365)
+    user_id = user.id
+    db.close()
+
+    assert [batch.num_rows for batch in archive._batches(user_id)] == [2, 2, 1]
+    # March only needs the batch holding March and February
+    march = list(archive._batches(user_id, datetime(2020, 3, 1), datetime(2020, 4, 1)))
+    assert [batch["description"].to_pylist() for batch in march] == [["M3", "M2"]]
+    assert [row["description"] for row in archive.cold_rows(user_id, limit=3)] == ["M5", "M4", "M3"]
+    assert [row["description"] for row in archive.cold_rows(user_id, ids=[1, 2])] == ["M3", "M1"]
+
+    batches = archive.cold_batches(user_id, batch_size=10, columns=("description", "amount"))
+    assert next(batches) == [("M5", 5.0), ("M4", 4.0)]
+    assert list(batches) == [[("M3", 3.0), ("M2", 2.0)], [("M1", 1.0)]]
+    print("✓ Archive batch pruning test passed")
+
+# ==================== SYNC TESTS ====================
+
+def test_sync_returns_only_changes(client, auth_token):
+    """Test delta sync returns changed rows and tombstones after a token"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    keep = client.post("/expenses", json={"description": "Keep", "amount": 1.0}, headers=headers).json()
+    edit = client.post("/expenses", json={"description": "Edit", "amount": 2.0}, headers=headers).json()
+    drop = client.post("/expenses", json={"description": "Drop", "amount": 3.0}, headers=headers).json()
+    
+    snapshot = client.get("/sync", headers=headers).json()
+    assert snapshot["full"] is True
+    assert len(snapshot["expenses"]) == 3
+    
+    client.put(f"/expenses/{edit['id']}", json={"amount": 20.0}, headers=headers)
+    client.delete(f"/expenses/{drop['id']}", headers=headers)
+    budget = client.post("/budgets", json={"month": 1, "year": 2025, "amount": 100.0}, headers=headers).json()
+    
+    delta = client.get(f"/sync?since={snapshot['token']}", headers=headers).json()
+    assert delta["full"] is False
+    assert [(e["id"], e["amount"], e["version"]) for e in delta["expenses"]] == [(edit["id"], 20.0, 2)]
+    assert delta["deleted_expenses"] == [drop["id"]]
+    assert [b["id"] for b in delta["budgets"]] == [budget["id"]]
+    assert keep["id"] not in [e["id"] for e in delta["expenses"]]
+    
+    empty = client.get(f"/sync?since={delta['token']}", headers=headers).json()
+    assert empty["expenses"] == [] and empty["deleted_expenses"] == []
+    assert empty["token"] == delta["token"]
+    print("✓ Delta sync test passed")
+
+def test_sync_create_then_delete_is_tombstone(client, auth_token):
+    """Test a row created and deleted between syncs only shows as a tombstone"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    token = client.get("/sync", headers=headers).json()["token"]
+    expense = client.post("/expenses", json={"description": "Temp", "amount": 1.0}, headers=headers).json()
+    client.delete(f"/expenses/{expense['id']}", headers=headers)
+    
+    delta = client.get(f"/sync?since={token}&limit=1", headers=headers).json()
+    assert delta["has_more"] is True
+    delta = client.get(f"/sync?since={token}", headers=headers).json()
+    assert delta["expenses"] == []
+    assert delta["deleted_expenses"] == [expense["id"]]
+    assert client.get("/sync?since=abc", headers=headers).status_code == 400
+    print("✓ Sync tombstone test passed")
+
+def test_sync_token_follows_commit_order(client, auth_token):
+    """Test a change committed after a token is returned even when its log id is lower"""
+    from sqlalchemy import update
+    from models import ChangeLog
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    first = client.post("/expenses", json={"description": "First", "amount": 1.0}, headers=headers).json()
+    token = client.get("/sync", headers=headers).json()["token"]
+    
+    db = TestingSessionLocal()
+    legacy_token = str(db.scalar(select(ChangeLog.id).where(ChangeLog.entity_id == first["id"])))
+    db.close()
+    second = client.post("/expenses", json={"description": "Second", "amount": 2.0}, headers=headers).json()
+    # Tokens from before sequences were change log ids
+    legacy = client.get(f"/sync?since={legacy_token}", headers=headers).json()
+    assert [e["id"] for e in legacy["expenses"]] == [second["id"]]
+    
+    # As if another worker allocated it from an older id block
+    db = TestingSessionLocal()
+    db.execute(update(ChangeLog).where(ChangeLog.entity_id == second["id"]).values(id=-1))
+    db.commit()
+    db.close()
+    
+    delta = client.get(f"/sync?since={token}", headers=headers).json()
+    assert [e["id"] for e in delta["expenses"]] == [second["id"]]
+    assert delta["token"] == legacy["token"]
+    print("✓ Sync commit order test passed")
+
+def test_change_log_numbered_per_owner(tmp_path):
+    """Test a change log from before sequences is numbered per owner in id order"""
+    from sqlalchemy import text
+    from crud import migrate_change_log
+    
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.tables["change_clocks"].create(legacy)
+    with legacy.begin() as conn:
+        conn.execute(text("CREATE TABLE change_log (id INTEGER PRIMARY KEY, owner_id INTEGER, entity VARCHAR, "
+                          "entity_id INTEGER, op VARCHAR, created_at DATETIME)"))
+        conn.execute(text("INSERT INTO change_log (id, owner_id, entity, entity_id, op) VALUES "
+                          "(5, 1, 'expense', 1, 'upsert'), (7, 2, 'expense', 2, 'upsert'), (9, 1, 'expense', 1, 'delete')"))
+    
+    migrate_change_log(legacy)
+    migrate_change_log(legacy)
+    
+    with legacy.connect() as conn:
+        assert conn.execute(text("SELECT id, seq FROM change_log ORDER BY id")).all() == [(5, 1), (7, 1), (9, 2)]
+        assert conn.execute(text("SELECT owner_id, seq FROM change_clocks ORDER BY owner_id")).all() == [(1, 2), (2, 1)]
+    print("✓ Change log numbering test passed")
+
+def test_version_columns_added_to_existing_tables(tmp_path):
+    """Test expenses and budgets from before row versions can still be updated"""
+    from sqlalchemy import text, update
+
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with legacy.begin() as conn:
+        conn.execute(text("CREATE TABLE expenses (id INTEGER PRIMARY KEY, description VARCHAR, amount FLOAT, "
+                          "category_id INTEGER, date DATETIME, owner_id INTEGER)"))
+        conn.execute(text("INSERT INTO expenses (id, description, amount, owner_id) VALUES (1, 'a', 1.0, 1)"))
+
+    for _ in range(2):
+        for model in (Expense, Budget):
+            database.add_columns(legacy, model, {"updated_at": None, "version": "1"})
+
+    with legacy.begin() as conn:
+        version = conn.execute(
+            update(Expense).where(Expense.id == 1).values(version=Expense.version + 1).returning(Expense.version)
+        ).scalar()
+    assert version == 2
+    print("✓ Version column migration test passed")
+
+# ==================== DASHBOARD TESTS ====================
+
+def test_dashboard_single_round_trip(client, auth_token):
+    """Test the dashboard returns summary, recent expenses and budget status together"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    for i in range(7):
+        client.post("/expenses", json={"description": f"E{i}", "amount": 10.0, "category": "Food"}, headers=headers)
+    now = datetime.now()
+    client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 50.0, "category": "Food"}, headers=headers)
+    client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 100.0}, headers=headers)
+    
+    response = client.get("/dashboard", headers=headers)
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["summary"]["total_expenses"] == 70.0
+    assert [e["description"] for e in data["recent_expenses"]] == ["E6", "E5", "E4", "E3", "E2"]
+    status = {b["category"]: b for b in data["budget_status"]}
+    assert status["Food"]["spent"] == 70.0 and status["Food"]["exceeded"] is True
+    assert status["General"]["remaining"] == 30.0 and status["General"]["exceeded"] is False
+    print("✓ Dashboard test passed")
+
+def test_budget_status_and_warning_use_trackers(client, auth_token):
+    """Test budget status and the summary warning come from trackers, scanning only for untracked budgets"""
+    from crud import get_budget_status
+    from models import BudgetTracker
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    now = datetime.now()
+    for amount, category in [(30.0, "Food"), (45.0, "Food"), (20.0, "Fun")]:
+        client.post("/expenses", json={"description": category, "amount": amount, "category": category}, headers=headers)
+    client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 60.0, "category": "Food"}, headers=headers)
+    client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 90.0}, headers=headers)
+    
+    summary = client.get(f"/expenses/summary?month={now.month}&year={now.year}", headers=headers).json()
+    assert summary["budget_warning"] == f"Budget exceeded! You've spent $95.00 out of $90.00 budget for {now.month}/{now.year}"
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).one().id
+    with StatementRecorder() as recorder:
+        status = {row["category"]: row for row in get_budget_status(db, user_id, now.month, now.year)}
+    assert status["Food"]["spent"] == 75.0 and status["Food"]["exceeded"] is True
+    assert status["General"]["spent"] == 95.0 and status["General"]["remaining"] == -5.0
+    assert not any("EXPENSES" in statement for statement in recorder.statements)
+    
+    # A budget from before trackers existed is still summed from its expenses
+    db.query(BudgetTracker).delete()
+    db.commit()
+    status = {row["category"]: row for row in get_budget_status(db, user_id, now.month, now.year)}
+    assert status["Food"]["spent"] == 75.0 and status["General"]["spent"] == 95.0
+    db.close()
+    print("✓ Tracker-backed budget status test passed")
+
+# ==================== QUERY COUNT TESTS ====================
+
+class StatementRecorder:
+    """Collect the SQL statements the test engine runs inside a with-block"""
+    
+    def __init__(self):
+        self.statements = []
+    
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(" ".join(statement.split()[:3]).upper())
+    
+    def __enter__(self):
+        # Refresh now so a periodic revocation sync does not land inside the block
+        revocation.revocations.sync()
+        event.listen(engine, "before_cursor_execute", self._record)
+        return self
+    
+    def __exit__(self, *exc):
+        event.remove(engine, "before_cursor_execute", self._record)
+
+def test_register_query_count(client, test_user_data):
+    """Test registration is a lookup plus a single INSERT ... RETURNING"""
+    with StatementRecorder() as recorder:
+        client.post("/register", json=test_user_data)
+    
+    assert recorder.statements == ["SELECT USERS.ID AS", "INSERT INTO USERS"]
+    print("✓ Register query count test passed")
+
+def test_write_endpoints_query_count(client, auth_token):
+    """Test each write is one statement plus its change log, stats and budget tracker rows after auth"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    auth = "SELECT USERS.ID AS"
+    stats = "SELECT CATEGORY_STATS.OWNER_ID, CATEGORY_STATS.CATEGORY_ID,"
+    trackers = "UPDATE BUDGET_TRACKERS SET"
+    clock = "INSERT INTO CHANGE_CLOCKS"
+    
+    # Only the first use of a category name touches the categories table
+    with StatementRecorder() as recorder:
+        client.post("/expenses", json={"description": "First", "amount": 1.0}, headers=headers)
+    assert recorder.statements == [
+        auth, "SELECT CATEGORIES.ID FROM", "INSERT INTO CATEGORIES", "INSERT INTO EXPENSES",
+        stats, "INSERT INTO CATEGORY_STATS", stats, trackers, clock, "INSERT INTO CHANGE_LOG", "UPDATE CATEGORY_STATS SET"
+    ]
+    client.post("/budgets", json={"month": 1, "year": 2024, "amount": 10.0}, headers=headers)
+    
+    with StatementRecorder() as recorder:
+        expense = client.post("/expenses", json={"description": "A", "amount": 1.0}, headers=headers).json()
+    assert recorder.statements == [
+        auth, "INSERT INTO EXPENSES", stats, trackers, clock, "INSERT INTO CHANGE_LOG", "UPDATE CATEGORY_STATS SET"
+    ]
+    
+    with StatementRecorder() as recorder:
+        response = client.put(f"/expenses/{expense['id']}", json={"amount": 2.0}, headers=headers)
+    assert response.json()["amount"] == 2.0
+    assert recorder.statements == [
+        auth, "SELECT EXPENSES.AMOUNT, EXPENSES.CATEGORY_ID", "UPDATE EXPENSES SET",
+        stats, trackers, "SELECT TAGS.NAME FROM", clock, "INSERT INTO CHANGE_LOG", "UPDATE CATEGORY_STATS SET"
+    ]
+    
+    with StatementRecorder() as recorder:
+        budget = client.post("/budgets", json={"month": 1, "year": 2025, "amount": 10.0}, headers=headers).json()
+    assert recorder.statements == [auth, "INSERT INTO BUDGETS", "INSERT INTO BUDGET_TRACKERS", clock, "INSERT INTO CHANGE_LOG"]
+    
+    with StatementRecorder() as recorder:
+        response = client.put(f"/budgets/{budget['id']}", json={"month": 2, "year": 2025, "amount": 20.0}, headers=headers)
+    assert response.json()["month"] == 2 and response.json()["version"] == 2
+    assert recorder.statements == [
+        auth, "UPDATE BUDGETS SET", "DELETE FROM BUDGET_TRACKERS", "INSERT INTO BUDGET_TRACKERS", clock,
+        "INSERT INTO CHANGE_LOG"
+    ]
+    
+    with StatementRecorder() as recorder:
+        client.delete(f"/expenses/{expense['id']}", headers=headers)
+    assert recorder.statements == [
+        auth, "DELETE FROM EXPENSES", stats, trackers, "DELETE FROM RECEIPTS", "DELETE FROM EXPENSE_TAGS",
+        clock, "INSERT INTO CHANGE_LOG", "UPDATE CATEGORY_STATS SET"
+    ]
+    
+    with StatementRecorder() as recorder:
+        response = client.delete(f"/expenses/{expense['id']}", headers=headers)
+    assert response.status_code == 404
+    assert recorder.statements == [auth, "DELETE FROM EXPENSES"]
+    print("✓ Write query count test passed")
+
+def test_update_other_users_expense(client, auth_token):
+    """Test ownership is enforced by the UPDATE itself"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    expense = client.post("/expenses", json={"description": "Mine", "amount": 1.0}, headers=headers).json()
+    
+    client.post("/register", json={"email": "other@example.com", "password": "otherpassword", "full_name": "Other"})
+    other_token = client.post(
+        "/login", data={"username": "other@example.com", "password": "otherpassword"}
+    ).json()["access_token"]
+    other = {"Authorization": f"Bearer {other_token}"}
+    
+    assert client.put(f"/expenses/{expense['id']}", json={"amount": 99.0}, headers=other).status_code == 404
+    assert client.delete(f"/expenses/{expense['id']}", headers=other).status_code == 404
+    assert client.get(f"/expenses/{expense['id']}", headers=headers).json()["amount"] == 1.0
+    print("✓ Ownership in WHERE clause test passed")
+
+# ==================== WRITE COALESCING TESTS ====================
+
+def test_coalescer_batches_concurrent_creates(client, auth_token, monkeypatch):
+    """Test concurrent POST /expenses calls share INSERTs and commits"""
+    import coalescer
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr(coalescer, "expense_coalescer", coalescer.WriteCoalescer(window_ms=100, max_batch=10))
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    def post(i):
+        return client.post("/expenses", json={"description": f"E{i}", "amount": float(i)}, headers=headers).json()
+    
+    with StatementRecorder() as recorder:
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(post, range(20)))
+    
+    assert sorted(r["description"] for r in results) == sorted(f"E{i}" for i in range(20))
+    assert all(r["amount"] == float(r["description"][1:]) for r in results)
+    assert len({r["id"] for r in results}) == 20
+    assert recorder.statements.count("INSERT INTO EXPENSES") < 20
+    assert len(client.get("/expenses", headers=headers).json()) == 20
+    print("✓ Write coalescing test passed")
+
+def test_coalescer_isolates_failed_rows(client, auth_token):
+    """Test one bad row in a batch only fails its own caller"""
+    import coalescer
+    writer = coalescer.WriteCoalescer(window_ms=100, max_batch=10)
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    
+    good = writer.submit(db, ExpenseCreate(description="Good", amount=1.0), user_id)
+    bad = writer.submit(db, ExpenseCreate.model_construct(description="Bad", amount=object(), category="Other"), user_id)
+    also_good = writer.submit(db, ExpenseCreate(description="Also good", amount=2.0), user_id)
+    
+    assert good.result(timeout=5).description == "Good"
+    assert also_good.result(timeout=5).description == "Also good"
+    with pytest.raises(Exception):
+        bad.result(timeout=5)
+    assert db.query(Expense).count() == 2
+    db.close()
+    print("✓ Write coalescing error isolation test passed")
+
+def test_coalescer_survives_flush_errors(client, auth_token, monkeypatch):
+    """Test an error outside the per-row retry fails its batch and the writer keeps running"""
+    import coalescer
+    connect = coalescer.Session
+    attempts = []
+    
+    def unreachable_once(*args, **kwargs):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("database unreachable")
+        return connect(*args, **kwargs)
+    
+    monkeypatch.setattr(coalescer, "Session", unreachable_once)
+    monkeypatch.setattr(coalescer, "expense_coalescer", coalescer.WriteCoalescer(window_ms=1, max_batch=10))
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    with pytest.raises(ConnectionError):
+        client.post("/expenses", json={"description": "Lost", "amount": 1.0}, headers=headers)
+    response = client.post("/expenses", json={"description": "Saved", "amount": 1.0}, headers=headers)
+    assert response.status_code == 200
+    assert [e["description"] for e in client.get("/expenses", headers=headers).json()] == ["Saved"]
+    print("✓ Write coalescer recovery test passed")
+
+# ==================== CATEGORY TESTS ====================
+
+def test_summary_groups_on_category_id(client, auth_token):
+    """Test summaries group on the integer key and still return names"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    for category, amount in [("Food", 10.0), ("Food", 5.0), ("Transport", 3.0)]:
+        client.post("/expenses", json={"description": category, "amount": amount, "category": category}, headers=headers)
+    
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(" ".join(statement.split()).upper())
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        summary = client.get("/expenses/summary", headers=headers).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    
+    assert summary["category_breakdown"] == {"Food": 15.0, "Transport": 3.0}
+    assert summary["total_count"] == 3
+    assert any("GROUP BY EXPENSES.CATEGORY_ID" in statement for statement in statements)
+    
+    db = TestingSessionLocal()
+    assert db.query(Category).count() == 2
+    db.close()
+    food = client.get("/expenses?category=Food", headers=headers).json()
+    assert [e["category"] for e in food] == ["Food", "Food"]
+    assert client.get("/expenses?category=Unknown", headers=headers).json() == []
+    print("✓ Category grouping test passed")
+
+def test_migrate_category_strings(tmp_path):
+    """Test legacy category strings are moved into the categories table"""
+    from sqlalchemy import inspect, text
+    from categories import migrate_category_strings
+    
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.tables["users"].create(legacy)
+    Base.metadata.tables["categories"].create(legacy)
+    with legacy.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, email, hashed_password) VALUES (1, 'a@example.com', 'x')"))
+        conn.execute(text("CREATE TABLE expenses (id INTEGER PRIMARY KEY, description VARCHAR, amount FLOAT, category VARCHAR, owner_id INTEGER)"))
+        conn.execute(text(
+            "INSERT INTO expenses (description, amount, category, owner_id) "
+            "VALUES ('a', 1.0, 'Food', 1), ('b', 2.0, 'Food', 1), ('c', 3.0, 'Bills', 1)"
+        ))
+    
+    migrate_category_strings(legacy)
+    migrate_category_strings(legacy)
+    
+    assert "category" not in {column["name"] for column in inspect(legacy).get_columns("expenses")}
+    with legacy.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT e.description, c.name FROM expenses e JOIN categories c ON c.id = e.category_id ORDER BY e.id"
+        )).all()
+        assert conn.execute(text("SELECT COUNT(*) FROM categories")).scalar() == 2
+    assert [tuple(row) for row in rows] == [("a", "Food"), ("b", "Food"), ("c", "Bills")]
+    print("✓ Category migration test passed")
+
+def test_category_cache_ignores_rolled_back_inserts(client, auth_token):
+    """Test a category created in a rolled-back transaction is never cached"""
+    client.get("/expenses", headers={"Authorization": f"Bearer {auth_token}"})
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    
+    lost = category_cache.get_or_create(db, user_id, "Travel")
+    assert category_cache.lookup(db, user_id, "Travel") == lost
+    assert category_cache.name(lost, db) == "Travel"
+    db.rollback()
+    assert category_cache.name(lost) is None
+    assert category_cache.lookup(db, user_id, "Travel") is None
+    
+    kept = category_cache.get_or_create(db, user_id, "Travel")
+    assert category_cache.name(kept) is None
+    db.commit()
+    assert category_cache.name(kept) == "Travel"
+    
+    category_cache.clear()
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        category_cache.warm(db, user_id)
+        category_cache.warm(db, user_id)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert len(statements) == 1
+    db.close()
+    print("✓ Category cache rollback test passed")
+
+# ==================== ANOMALY TESTS ====================
+
+def test_running_stats_match_batch_recomputation(client, auth_token):
+    """Test incremental statistics equal a full rescan after creates, updates and deletes"""
+    import random
+    import numpy as np
+    import spending_stats
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    rng = random.Random(7)
+    
+    ids = []
+    for i in range(60):
+        category = rng.choice(["Food", "Bills", "Fun"])
+        response = client.post("/expenses", json={"description": f"E{i}", "amount": round(rng.uniform(1, 300), 2), "category": category}, headers=headers)
+        ids.append(response.json()["id"])
+    for expense_id in rng.sample(ids, 15):
+        client.put(f"/expenses/{expense_id}", json={"amount": round(rng.uniform(1, 300), 2), "category": rng.choice(["Food", "Bills"])}, headers=headers)
+    for expense_id in rng.sample(ids, 10):
+        client.delete(f"/expenses/{expense_id}", headers=headers)
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    stored = spending_stats.load_stats(db, user_id)
+    batch = spending_stats.recompute(db, user_id)
+    assert stored.keys() == batch.keys()
+    for key, stats in stored.items():
+        amounts = [e.amount for e in db.query(Expense).filter(Expense.owner_id == user_id, Expense.category_id == key[1])]
+        assert stats.count == batch[key].count == len(amounts)
+        assert stats.mean == pytest.approx(np.mean(amounts))
+        assert spending_stats.variance(stats) == pytest.approx(np.var(amounts, ddof=1))
+        assert stats.sketch == batch[key].sketch
+        median = spending_stats.quantile(stats, 0.5)
+        assert median == pytest.approx(np.quantile(amounts, 0.5, method="lower"), rel=0.02)
+    db.close()
+    print("✓ Running stats test passed")
+
+def test_first_expenses_in_category_race(client, auth_token, monkeypatch):
+    """Test a stats row created by a concurrent first expense is updated, not inserted twice"""
+    import spending_stats
+    client.get("/expenses", headers={"Authorization": f"Bearer {auth_token}"})
+    other = TestingSessionLocal()
+    user_id = other.query(User).first().id
+    category_id = category_cache.get_or_create(other, user_id, "Food")
+    spending_stats.update_stats(other, added=[(user_id, category_id, 10.0)])
+    other.commit()
+    other.close()
+    
+    # This request's lookup ran before the other request committed its row
+    lock_stats = spending_stats._lock_stats
+    calls = []
+    def stale_lock_stats(db, keys):
+        calls.append(keys)
+        return {} if len(calls) == 1 else lock_stats(db, keys)
+    monkeypatch.setattr(spending_stats, "_lock_stats", stale_lock_stats)
+    
+    db = TestingSessionLocal()
+    stats = spending_stats.update_stats(db, added=[(user_id, category_id, 20.0)])
+    db.commit()
+    assert len(calls) == 2
+    assert stats[(user_id, category_id)].count == 2
+    assert stats[(user_id, category_id)].mean == pytest.approx(15.0)
+    db.close()
+    print("✓ Concurrent first expense stats test passed")
+
+def test_anomalies_flag_unusually_large_expenses(client, auth_token):
+    """Test anomaly scores on responses and the anomalies listing"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    for amount in [40.0, 45.0, 50.0, 55.0, 60.0, 48.0, 52.0]:
+        client.post("/expenses", json={"description": "Groceries", "amount": amount, "category": "Groceries"}, headers=headers)
+    
+    normal = client.post("/expenses", json={"description": "Normal", "amount": 50.0, "category": "Groceries"}, headers=headers).json()
+    huge = client.post("/expenses", json={"description": "Huge", "amount": 400.0, "category": "Groceries"}, headers=headers).json()
+    assert abs(normal["anomaly_score"]) < 1
+    assert huge["anomaly_score"] > 2
+    
+    listed = {e["description"]: e for e in client.get("/expenses", headers=headers).json()}
+    assert listed["Huge"]["anomaly_score"] > 2
+    assert abs(listed["Normal"]["anomaly_score"]) < 1
+    
+    for amount in [45.0, 50.0, 55.0] * 5:
+        client.post("/expenses", json={"description": "Groceries", "amount": amount, "category": "Groceries"}, headers=headers)
+    anomalies = client.get("/expenses/anomalies", headers=headers).json()
+    assert [e["description"] for e in anomalies] == ["Huge"]
+    assert anomalies[0]["anomaly_score"] > 3
+    assert 45.0 <= anomalies[0]["category_median"] <= 55.0
+    print("✓ Anomaly detection test passed")
+
+# ==================== PROFILING TESTS ====================
+
+@pytest.fixture
+def admin_headers(monkeypatch):
+    import auth
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "admin-secret")
+    return {"X-Admin-Token": "admin-secret"}
+
+def test_profiling_requires_admin(client, admin_headers):
+    """Test profiling endpoints reject missing or wrong admin tokens"""
+    assert client.post("/admin/profiles", json={}).status_code == 403
+    assert client.get("/admin/profiles", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/admin/profiles", headers=admin_headers).status_code == 200
+    print("✓ Profiling admin guard test passed")
+
+def test_profile_route_for_n_requests(client, auth_token, admin_headers, monkeypatch):
+    """Test a route profile captures exactly N requests with stacks and SQL timings"""
+    import profiling
+    import threading
+    from sqlalchemy.engine import Engine
+    monkeypatch.setattr(profiling.profiler, "interval", 0.001)
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    db = TestingSessionLocal()
+    user_id = db.query(User).first().id
+    food_id = category_cache.get_or_create(db, user_id, "Food")
+    db.execute(Expense.__table__.insert(), [
+        {"description": f"E{i}", "amount": 1.0, "category_id": food_id, "owner_id": user_id, "version": 1}
+        for i in range(5000)
+    ])
+    db.commit()
+    db.close()
+    
+    profile = client.post("/admin/profiles", json={"route": "/expenses/export", "requests": 2}, headers=admin_headers).json()
+    assert profile["done"] is False
+    assert event.contains(Engine, "before_cursor_execute", profiling._before_cursor_execute)
+    
+    # Application code on a thread that isn't serving the request stays out of the profile
+    stop = threading.Event()
+    def unrelated_work():
+        while not stop.is_set():
+            sum(range(1000))
+    bystander = threading.Thread(target=unrelated_work)
+    bystander.start()
+    try:
+        client.get("/expenses/summary", headers=headers)
+        for _ in range(3):
+            client.get("/expenses/export?format=csv", headers=headers)
+    finally:
+        stop.set()
+        bystander.join()
+    
+    result = client.get(f"/admin/profiles/{profile['id']}", headers=admin_headers).json()
+    assert result["done"] is True
+    assert result["completed"] == 2
+    assert [r["path"] for r in result["request_log"]] == ["/expenses/export", "/expenses/export"]
+    assert all(r["status"] == 200 for r in result["request_log"])
+    assert result["sql_count"] > 0
+    assert any("FROM expenses" in s["statement"] for s in result["slowest_sql"])
+    assert result["samples"] > 0
+    
+    collapsed = client.get(f"/admin/profiles/{profile['id']}?format=collapsed", headers=admin_headers).text
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.splitlines())
+    assert "exporters.py" in collapsed
+    assert "unrelated_work" not in collapsed
+    speedscope = client.get(f"/admin/profiles/{profile['id']}?format=speedscope", headers=admin_headers).json()
+    assert speedscope["profiles"][0]["type"] == "sampled"
+    frame_count = len(speedscope["shared"]["frames"])
+    assert all(0 <= index < frame_count for sample in speedscope["profiles"][0]["samples"] for index in sample)
+    
+    # Nothing stays hooked once the profile is used up
+    assert profiling.profiler.armed is False
+    assert not event.contains(Engine, "before_cursor_execute", profiling._before_cursor_execute)
+    client.delete(f"/admin/profiles/{profile['id']}", headers=admin_headers)
+    print("✓ Route profiling test passed")
+
+def test_profile_skips_pooled_thread_after_request():
+    """Test a worker thread stops being sampled once it moves on to another request"""
+    import sys
+    import threading
+    import time
+    import profiling
+    profiler = profiling.Profiler(interval_ms=1)
+    profile = profiler.start(route="/expenses")
+    session = profiler._claim("/expenses", None)
+    assert session is profile
+    
+    stop, deadline = threading.Event(), time.monotonic() + 0.2
+    def serve_profiled_request():
+        session.track_thread(threading.get_ident(), sys._getframe())
+        while time.monotonic() < deadline:
+            sum(range(1000))
+    def serve_other_request():
+        while not stop.is_set():
+            sum(range(1000))
+    def pooled_worker():
+        serve_profiled_request()
+        serve_other_request()
+    worker = threading.Thread(target=pooled_worker)
+    worker.start()
+    time.sleep(0.4)
+    stop.set()
+    worker.join()
+    session.finish("GET", "/expenses", 200, 0.4)
+    profiler._release(session)
+    profiler.stop(profile.id)
+    
+    collapsed = session.collapsed()
+    assert "serve_profiled_request" in collapsed
+    assert "serve_other_request" not in collapsed
+    print("✓ Pooled thread profiling test passed")
+
+def test_profile_filters_by_user(client, auth_token, admin_headers):
+    """Test a user profile ignores other users' requests"""
+    client.post("/register", json={"email": "other@example.com", "password": "otherpassword", "full_name": "Other"})
+    other_token = client.post(
+        "/login", data={"username": "other@example.com", "password": "otherpassword"}
+    ).json()["access_token"]
+    db = TestingSessionLocal()
+    other_id = db.query(User).filter(User.email == "other@example.com").first().id
+    db.close()
+    
+    profile = client.post("/admin/profiles", json={"user_id": other_id}, headers=admin_headers).json()
+    client.get("/expenses/summary", headers={"Authorization": f"Bearer {auth_token}"})
+    assert client.get(f"/admin/profiles/{profile['id']}", headers=admin_headers).json()["completed"] == 0
+    client.get("/expenses/summary", headers={"Authorization": f"Bearer {other_token}"})
+    result = client.get(f"/admin/profiles/{profile['id']}", headers=admin_headers).json()
+    assert result["completed"] == 1 and result["request_log"][0]["path"] == "/expenses/summary"
+    client.delete(f"/admin/profiles/{profile['id']}", headers=admin_headers)
+    print("✓ User profiling test passed")
+
+# ==================== REVOCATION TESTS ====================
+
+def test_logout_revokes_only_that_token(client, test_user_data, registered_user):
+    """Test logout invalidates the token it was called with"""
+    login = {"username": test_user_data["email"], "password": test_user_data["password"]}
+    first = client.post("/login", data=login).json()["access_token"]
+    second = client.post("/login", data=login).json()["access_token"]
+    
+    assert client.post("/logout", headers={"Authorization": f"Bearer {first}"}).status_code == 200
+    assert client.get("/expenses", headers={"Authorization": f"Bearer {first}"}).status_code == 401
+    assert client.get("/expenses", headers={"Authorization": f"Bearer {second}"}).status_code == 200
+    print("✓ Logout test passed")
+
+def test_password_change_revokes_existing_tokens(client, test_user_data, auth_token):
+    """Test changing the password invalidates tokens issued before it"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    response = client.put("/users/change-password", json={
+        "current_password": test_user_data["password"], "new_password": "newpassword123"
+    }, headers=headers)
+    assert response.status_code == 200
+    assert client.get("/expenses", headers=headers).status_code == 401
+    
+    new_token = client.post("/login", data={"username": test_user_data["email"], "password": "newpassword123"}).json()["access_token"]
+    assert client.get("/expenses", headers={"Authorization": f"Bearer {new_token}"}).status_code == 200
+    print("✓ Credential change revocation test passed")
+
+def test_revocation_filter_skips_lookup_and_syncs(client, auth_token):
+    """Test unrevoked tokens cost no query and other workers pick up revocations on sync"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    with StatementRecorder() as recorder:
+        client.get("/expenses/summary", headers=headers)
+    assert not any("REVOKED_TOKENS" in statement for statement in recorder.statements)
+    
+    # A second worker only learns about this logout on its next sync
+    other_worker = revocation.RevocationList(TestingSessionLocal, sync_seconds=3600)
+    other_worker.sync()
+    client.post("/logout", headers=headers)
+    from auth import decode_token
+    payload = decode_token(auth_token, Exception("invalid token"))
+    db = TestingSessionLocal()
+    assert other_worker.is_revoked(db, payload, auth_token) is False
+    other_worker.sync()
+    assert other_worker.is_revoked(db, payload, auth_token) is True
+    db.close()
+    
+    bloom = revocation.BloomFilter(bits=4096)
+    keys = [f"jti:{i}" for i in range(200)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert sum(f"jti:other{i}" in bloom for i in range(1000)) < 50
+    print("✓ Revocation filter test passed")
+
+def test_revocation_refresh_is_single_flight(client, auth_token):
+    """Test one request refreshes a stale filter while the others keep using the current one"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from auth import decode_token
+    payload = decode_token(auth_token, Exception("invalid token"))
+    revocations = revocation.RevocationList(TestingSessionLocal, sync_seconds=0.01)
+    revocations.sync()
+    
+    syncs = []
+    release = threading.Event()
+    sync = revocations.sync
+    def slow_sync():
+        syncs.append(threading.get_ident())
+        release.wait(5)
+        sync()
+    revocations.sync = slow_sync
+    time.sleep(0.02)
+    
+    def check():
+        db = TestingSessionLocal()
+        try:
+            return revocations.is_revoked(db, payload, auth_token)
+        finally:
+            db.close()
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        first = pool.submit(check)
+        while not syncs:
+            time.sleep(0.001)
+        # The refresh is still running, yet the other requests are answered
+        assert [future.result(timeout=5) for future in [pool.submit(check) for _ in range(20)]] == [False] * 20
+        release.set()
+        assert first.result(timeout=5) is False
+    assert len(syncs) == 1
+    print("✓ Single-flight revocation refresh test passed")
+
+# ==================== SUGGESTION TESTS ====================
+
+def test_suggest_ranks_by_frequency(client, auth_token):
+    """Test suggestions are prefix matches ranked by use, with likely category and amount"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    for description, amount, category in [
+        ("Starbucks", 4.5, "Coffee"), ("Starbucks", 4.5, "Coffee"), ("starbucks", 5.0, "Coffee"),
+        ("Stop & Shop", 60.0, "Groceries"), ("Shell", 40.0, "Transport"),
+    ]:
+        client.post("/expenses", json={"description": description, "amount": amount, "category": category}, headers=headers)
+    
+    suggestions = client.get("/expenses/suggest?prefix=st", headers=headers).json()
+    assert [s["description"] for s in suggestions] == ["Starbucks", "Stop & Shop"]
+    assert suggestions[0] == {"description": "Starbucks", "count": 3, "category": "Coffee", "amount": 4.5}
+    
+    # Served from memory once built; new writes extend the loaded index
+    with StatementRecorder() as recorder:
+        client.get("/expenses/suggest?prefix=S", headers=headers)
+    assert not any("GROUP BY" in statement for statement in recorder.statements)
+    client.post("/expenses", json={"description": "Stop & Shop", "amount": 55.0, "category": "Groceries"}, headers=headers)
+    client.post("/expenses", json={"description": "Stop & Shop", "amount": 55.0, "category": "Groceries"}, headers=headers)
+    suggestions = client.get("/expenses/suggest?prefix=sto&limit=1", headers=headers).json()
+    assert suggestions == [{"description": "Stop & Shop", "count": 3, "category": "Groceries", "amount": 55.0}]
+    
+    expense_id = client.get("/expenses", headers=headers).json()[-1]["id"]
+    client.delete(f"/expenses/{expense_id}", headers=headers)
+    assert client.get("/expenses/suggest?prefix=starb", headers=headers).json()[0]["count"] == 2
+    assert client.get("/expenses/suggest?prefix=zzz", headers=headers).json() == []
+    print("✓ Suggestion test passed")
+
+def test_suggestion_cache_evicts_least_recently_used():
+    """Test indexes are evicted LRU under the memory budget"""
+    from suggestions import SuggestionCache, UserIndex
+    
+    cache = SuggestionCache(memory_bytes=1)
+    for user_id in (1, 2, 3):
+        index = UserIndex()
+        index.add(f"Shop {user_id}", None, 1.0)
+        cache._store(user_id, index)
+        assert list(cache._indexes) == [user_id]
+    
+    cache = SuggestionCache(memory_bytes=3000)
+    sizes = {}
+    for user_id in (1, 2, 3):
+        index = UserIndex()
+        index.add(f"Shop {user_id}", None, 1.0)
+        cache._store(user_id, index)
+        sizes[user_id] = index.size
+    assert cache.size == sum(sizes.values())
+    cache._get(None, 1)
+    cache.record(2, "Shop 2b", None, 2.0)
+    cache.record(2, "Shop 2c", None, 2.0)
+    assert list(cache._indexes) == [1, 2]
+    assert cache.size == sum(index.size for index in cache._indexes.values())
+    cache.invalidate(1)
+    assert cache.size == cache._indexes[2].size
+    
+    cache = SuggestionCache(memory_bytes=10 ** 6)
+    index = UserIndex()
+    for i in range(100):
+        index.add(f"Item {i:03d}", None, float(i), count=i)
+    cache._store(1, index)
+    assert [s["description"] for s in cache.suggest(None, 1, "item 09", 3)] == ["Item 099", "Item 098", "Item 097"]
+    print("✓ Suggestion eviction test passed")
+
+# ==================== DIGEST TESTS ====================
+
+def _seed_digest_users(count):
+    db = TestingSessionLocal()
+    users = [User(email=f"digest{i}@example.com", hashed_password="x", full_name=f"User {i}") for i in range(count)]
+    users.append(User(email="inactive@example.com", hashed_password="x", is_active=False))
+    db.add_all(users)
+    db.commit()
+    for i, user in enumerate(users):
+        food = category_cache.get_or_create(db, user.id, "Food")
+        rent = category_cache.get_or_create(db, user.id, "Rent")
+        general = category_cache.get_or_create(db, user.id, "General")
+        if i % 3 == 2:
+            continue  # no activity, no digest
+        db.add_all([
+            Expense(description="Lunch", amount=10.0 + i, category_id=food, date=datetime(2025, 6, 3), owner_id=user.id),
+            Expense(description="Dinner", amount=20.0, category_id=food, date=datetime(2025, 6, 25), owner_id=user.id),
+            Expense(description="Rent", amount=500.0, category_id=rent, date=datetime(2025, 6, 28), owner_id=user.id),
+            Expense(description="July", amount=99.0, category_id=food, date=datetime(2025, 7, 2), owner_id=user.id),
+            Budget(month=6, year=2025, amount=100.0, category_id=food, owner_id=user.id),
+            Budget(month=6, year=2025, amount=1000.0, category_id=general, owner_id=user.id),
+        ])
+    db.commit()
+    db.close()
+
+def test_monthly_digest_is_set_based(test_db):
+    """Test digests match per-user summaries with a fixed number of queries per chunk"""
+    import digests
+    from email_service import EmailQueue, LocalSink
+    _seed_digest_users(6)
+    
+    sink = LocalSink(directory="")
+    outbox = EmailQueue(sink, senders=2)
+    with StatementRecorder() as recorder:
+        queued = digests.run_digests("monthly", date(2025, 7, 10), outbox=outbox, primary=engine, chunk_size=2, workers=2)
+    outbox.close()
+    
+    assert queued == 4 and outbox.sent == 4
+    assert sorted(message["to"] for message in sink.messages) == [
+        "digest0@example.com", "digest1@example.com", "digest3@example.com", "digest4@example.com"
+    ]
+    # 3 users per chunk of 2 plus the empty final chunk; no per-user queries
+    assert len(recorder.statements) == 4 * 1 + 3 * 2
+    
+    db = TestingSessionLocal()
+    user = db.query(User).filter(User.email == "digest1@example.com").first()
+    with engine.connect() as conn:
+        digest = digests.collect_chunk(conn, [user], datetime(2025, 6, 1), datetime(2025, 7, 1))[0]
+    assert digest["total"] == 531.0 and digest["count"] == 3
+    assert digest["categories"] == {"Food": 31.0, "Rent": 500.0}
+    assert {b["category"]: b["spent"] for b in digest["budgets"]} == {"Food": 31.0, "General": 531.0}
+    db.close()
+    
+    html = next(m["html"] for m in sink.messages if m["to"] == "digest1@example.com")
+    assert "$531.00" in html and "exceeded" not in html
+    assert "Jun 01 - Jun 30, 2025" in sink.messages[0]["subject"]
+    print("✓ Monthly digest test passed")
+
+def test_weekly_digest_budget_month_to_date(test_db):
+    """Test weekly digests report budgets against month-to-date spending"""
+    import digests
+    from email_service import EmailQueue, LocalSink
+    _seed_digest_users(1)
+    
+    sink = LocalSink(directory="")
+    outbox = EmailQueue(sink, senders=1)
+    assert digests.run_digests("weekly", date(2025, 7, 2), outbox=outbox, primary=engine, workers=0) == 1
+    outbox.close()
+    
+    assert digests.digest_period("weekly", date(2025, 7, 2)) == (date(2025, 6, 23), date(2025, 6, 30))
+    html = sink.messages[0]["html"]
+    assert "$520.00" in html
+    assert "Food: $30.00 of $100.00" in html
+    print("✓ Weekly digest test passed")
+
+# ==================== RECEIPT TESTS ====================
+
+@pytest.fixture
+def blob_store(tmp_path, monkeypatch):
+    import receipts
+    from blobstore import LocalBlobStore
+    store = LocalBlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(receipts, "blob_store", store)
+    return store
+
+def _receipt_png():
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new("RGB", (800, 600), (200, 30, 30)).save(output, "PNG")
+    return output.getvalue()
+
+def test_receipt_upload_dedup_and_range_download(client, auth_token, blob_store, monkeypatch):
+    """Test receipts are stored once per content and served with byte ranges"""
+    import hashlib
+    import receipts
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    scheduled = []
+    monkeypatch.setattr(receipts, "schedule_thumbnail", lambda store, key: scheduled.append(key))
+    first = client.post("/expenses", json={"description": "Taxi", "amount": 30.0}, headers=headers).json()["id"]
+    second = client.post("/expenses", json={"description": "Taxi", "amount": 30.0}, headers=headers).json()["id"]
+    body = bytes(range(256)) * 1000
+    
+    for expense_id in (first, second):
+        response = client.put(
+            f"/expenses/{expense_id}/receipt", content=body,
+            headers={**headers, "Content-Type": "application/pdf"}
+        )
+        assert response.status_code == 200
+        assert response.json()["blob_key"] == hashlib.sha256(body).hexdigest()
+        assert response.json()["size"] == len(body)
+    assert len(list(blob_store.list_objects())) == 1
+    assert scheduled == []  # PDFs get no thumbnail
+    assert os.listdir(blob_store.spool_dir) == []
+    
+    response = client.get(f"/expenses/{first}/receipt", headers=headers)
+    assert response.status_code == 200 and response.content == body
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.headers["accept-ranges"] == "bytes"
+    
+    response = client.get(f"/expenses/{first}/receipt", headers={**headers, "Range": "bytes=1000-1099"})
+    assert response.status_code == 206
+    assert response.content == body[1000:1100]
+    assert response.headers["content-range"] == f"bytes 1000-1099/{len(body)}"
+    response = client.get(f"/expenses/{first}/receipt", headers={**headers, "Range": "bytes=-10"})
+    assert response.content == body[-10:]
+    response = client.get(f"/expenses/{first}/receipt", headers={**headers, "Range": f"bytes={len(body)}-"})
+    assert response.status_code == 416
+    etag = client.get(f"/expenses/{first}/receipt", headers=headers).headers["etag"]
+    assert client.get(f"/expenses/{first}/receipt", headers={**headers, "If-None-Match": etag}).status_code == 304
+    
+    # Blobs outlive their receipts until garbage collection finds them unreferenced
+    client.delete(f"/expenses/{first}", headers=headers)
+    assert client.get(f"/expenses/{first}/receipt", headers=headers).status_code == 404
+    assert client.delete(f"/expenses/{second}/receipt", headers=headers).status_code == 200
+    assert len(list(blob_store.list_objects())) == 1
+    assert receipts.collect_garbage(blob_store, set(), grace_hours=1) == 0
+    assert receipts.collect_garbage(blob_store, set(), grace_hours=-1) == 1
+    assert list(blob_store.list_objects()) == []
+    print("✓ Receipt upload test passed")
+
+def test_receipt_gc_spares_blob_deduplicated_during_collection(blob_store):
+    """Test a dedup hit on an old blob keeps garbage collection from deleting it"""
+    import time
+    import receipts
+    from blobstore import BlobWriter
+    writer = BlobWriter(blob_store)
+    writer.write(b"receipt")
+    key, _ = writer.commit()
+    day_ago = time.time() - 86400
+    os.utime(blob_store.local_path(key), (day_ago, day_ago))
+    
+    # GC lists the old, unreferenced blob, then the same receipt is uploaded again
+    listed = list(blob_store.list_objects())
+    writer = BlobWriter(blob_store)
+    writer.write(b"receipt")
+    assert writer.commit()[0] == key
+    assert os.path.getmtime(blob_store.local_path(key)) > day_ago
+    
+    class ListedBefore:
+        def __getattr__(self, name):
+            return getattr(blob_store, name)
+        def list_objects(self):
+            return iter(listed)
+    assert receipts.collect_garbage(ListedBefore(), set(), grace_hours=1) == 0
+    assert blob_store.head_object(key) is not None
+    print("✓ Receipt GC dedup race test passed")
+
+def test_receipt_upload_limits(client, auth_token, blob_store, monkeypatch):
+    """Test receipt type, size and ownership checks"""
+    import receipts
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    expense_id = client.post("/expenses", json={"description": "Taxi", "amount": 30.0}, headers=headers).json()["id"]
+    
+    response = client.put(f"/expenses/{expense_id}/receipt", content=b"hello", headers={**headers, "Content-Type": "text/plain"})
+    assert response.status_code == 415
+    assert client.put("/expenses/9999/receipt", content=b"%PDF", headers={**headers, "Content-Type": "application/pdf"}).status_code == 404
+    
+    monkeypatch.setattr(receipts, "RECEIPT_MAX_BYTES", 100)
+    response = client.put(f"/expenses/{expense_id}/receipt", content=b"x" * 101, headers={**headers, "Content-Type": "application/pdf"})
+    assert response.status_code == 413
+    
+    # Without a Content-Length the limit is enforced while streaming
+    def chunks():
+        for _ in range(10):
+            yield b"x" * 20
+    response = client.put(f"/expenses/{expense_id}/receipt", content=chunks(), headers={**headers, "Content-Type": "application/pdf"})
+    assert response.status_code == 413
+    assert list(blob_store.list_objects()) == [] and os.listdir(blob_store.spool_dir) == []
+    assert client.get(f"/expenses/{expense_id}/receipt", headers=headers).status_code == 404
+    print("✓ Receipt limits test passed")
+
+def test_receipt_thumbnail_rendered_in_pool(client, auth_token, blob_store):
+    """Test image receipts get a JPEG thumbnail from the process pool"""
+    from PIL import Image
+    import receipts
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    expense_id = client.post("/expenses", json={"description": "Dinner", "amount": 80.0}, headers=headers).json()["id"]
+    
+    response = client.put(f"/expenses/{expense_id}/receipt", content=_receipt_png(), headers={**headers, "Content-Type": "image/png"})
+    blob_key = response.json()["blob_key"]
+    receipts.schedule_thumbnail(blob_store, blob_key).result(timeout=60)
+    
+    response = client.get(f"/expenses/{expense_id}/receipt/thumbnail", headers=headers)
+    assert response.status_code == 200 and response.headers["content-type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(response.content)).size == (256, 192)
+    print("✓ Receipt thumbnail test passed")
+
+# ==================== SPARSE FIELDSET TESTS ====================
+
+def test_list_sparse_fields_prune_columns(client, auth_token):
+    """Test fields= limits both the selected columns and the response shape"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    _create_export_expenses(client, auth_token)
+    full = client.get("/expenses", headers=headers).json()
+    
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(" ".join(statement.split()).upper())
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.get("/expenses?fields=amount,date", headers=headers)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    
+    assert response.status_code == 200
+    assert response.json() == [{"amount": e["amount"], "date": e["date"]} for e in full]
+    listing = next(statement for statement in statements if "FROM EXPENSES" in statement)
+    assert "EXPENSES.DESCRIPTION" not in listing and "EXPENSES.CATEGORY_ID" not in listing
+    assert not any("CATEGORY_STATS" in statement or "FROM CATEGORIES" in statement for statement in statements)
+    
+    # Computed fields pull in what they need, and output follows schema order
+    response = client.get("/expenses?fields=anomaly_score,category&category=Food", headers=headers).json()
+    assert response == [{"category": "Food", "anomaly_score": None}]
+    
+    response = client.get("/expenses?fields=amount,colour", headers=headers)
+    assert response.status_code == 400
+    assert "colour" in response.json()["detail"]
+    assert client.get("/expenses?fields=,", headers=headers).status_code == 400
+    print("✓ Sparse list fields test passed")
+
+def test_export_and_sync_sparse_fields(client, auth_token):
+    """Test fields= on exports and sync, where sync always keeps the id"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    _create_export_expenses(client, auth_token)
+    
+    csv_text = client.get("/expenses/export?format=csv&fields=category,amount", headers=headers).text
+    assert csv_text.splitlines()[0] == "amount,category"
+    assert "Bus pass" not in csv_text and "45.0,Transport" in csv_text
+    parquet = pq.read_table(io.BytesIO(
+        client.get("/expenses/export?format=parquet&fields=date,amount", headers=headers).content
+    ))
+    assert parquet.column_names == ["amount", "date"] and parquet.num_rows == 3
+    assert client.get("/expenses/export?fields=anomaly_score", headers=headers).status_code == 400
+    
+    snapshot = client.get("/sync?fields=amount", headers=headers).json()
+    assert {tuple(e) for e in snapshot["expenses"]} == {("amount", "id")}
+    expense_id = snapshot["expenses"][0]["id"]
+    client.put(f"/expenses/{expense_id}", json={"amount": 99.0}, headers=headers)
+    changes = client.get(f"/sync?since={snapshot['token']}&fields=amount,version", headers=headers).json()
+    assert changes["expenses"] == [{"id": expense_id, "amount": 99.0, "version": 2}]
+    print("✓ Sparse export and sync fields test passed")
+
+# ==================== RATE LIMIT TESTS ====================
+
+def test_token_bucket_bursts_and_refills():
+    """Test buckets allow a burst, then refill at capacity/period per key"""
+    from ratelimit import MemoryStore, Rate, RateLimiter
+    now = [1000.0]
+    limiter = RateLimiter(MemoryStore(shards=4), rules={"verify": {"ip": Rate(3, 30), "email": Rate(5, 900)}},
+                          enabled=True, clock=lambda: now[0])
+    
+    assert [limiter.check("verify", ip="1.1.1.1", email="a@x.com") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.check("verify", ip="1.1.1.1", email="a@x.com") == pytest.approx(10.0)
+    now[0] += 10
+    assert limiter.check("verify", ip="1.1.1.1", email="a@x.com") == 0.0
+    
+    # The email bucket holds across addresses; the blocked IP attempt above did not touch it
+    assert limiter.check("verify", ip="2.2.2.2", email="a@x.com") == 0.0
+    assert limiter.check("verify", ip="3.3.3.3", email="a@x.com") > 0
+    assert limiter.check("verify", ip="3.3.3.3", email="b@x.com") == 0.0
+    print("✓ Token bucket test passed")
+
+def test_login_rate_limited_before_db(client, test_user_data, registered_user, monkeypatch):
+    """Test rejected logins return 429 without touching the database"""
+    from ratelimit import Rate
+    monkeypatch.setitem(rate_limiter.rules, "login", {"ip": Rate(5, 60), "email": Rate(2, 60)})
+    wrong = {"username": test_user_data["email"], "password": "wrongpassword"}
+    
+    assert [client.post("/login", data=wrong).status_code for _ in range(2)] == [401, 401]
+    with StatementRecorder() as recorder:
+        response = client.post("/login", data={**wrong, "username": test_user_data["email"].upper()})
+    assert response.status_code == 429
+    assert 0 < int(response.headers["retry-after"]) <= 30
+    assert recorder.statements == []
+    
+    # Other accounts from the same address still work until the IP bucket runs dry
+    assert client.post("/login", data={"username": "other@example.com", "password": "x"}).status_code == 401
+    assert client.post("/login", data={"username": "third@example.com", "password": "x"}).status_code == 401
+    assert client.post("/login", data={"username": "fourth@example.com", "password": "x"}).status_code == 429
+    print("✓ Login rate limit test passed")
+
+def test_password_reset_rate_limited(client, registered_user, test_user_data, monkeypatch):
+    """Test reset requests and key guesses are throttled per email"""
+    from ratelimit import Rate
+    monkeypatch.setitem(rate_limiter.rules, "reset_verify", {"email": Rate(3, 900)})
+    monkeypatch.setattr("main.send_password_reset_email", lambda email, key: None)
+    
+    statuses = [client.post("/password-reset/request", json={"email": test_user_data["email"]}).status_code for _ in range(4)]
+    assert statuses == [200, 200, 200, 429]
+    guess = {"email": test_user_data["email"], "reset_key": "AAAAAA", "new_password": "newpassword123"}
+    statuses = [client.post("/password-reset/verify", json=guess).status_code for _ in range(4)]
+    assert statuses == [400, 400, 400, 429]
+    print("✓ Password reset rate limit test passed")
+
+# ==================== PASSWORD RESET CLEANUP TESTS ====================
+
+def test_new_reset_key_supersedes_older(client, registered_user, test_user_data, monkeypatch):
+    """Test issuing a key retires older ones and using a key expires it"""
+    from models import PasswordReset
+    keys = []
+    monkeypatch.setattr("main.send_password_reset_email", lambda email, key: keys.append(key))
+    for _ in range(2):
+        client.post("/password-reset/request", json={"email": test_user_data["email"]})
+    
+    verify = {"email": test_user_data["email"], "new_password": "newpassword123"}
+    assert client.post("/password-reset/verify", json={**verify, "reset_key": keys[0]}).status_code == 400
+    assert client.post("/password-reset/verify", json={**verify, "reset_key": keys[1]}).status_code == 200
+    
+    db = TestingSessionLocal()
+    rows = db.query(PasswordReset).all()
+    assert len(rows) == 2 and all(row.is_used for row in rows)
+    assert all(row.expires_at <= datetime.utcnow() for row in rows)
+    db.close()
+    print("✓ Reset key supersession test passed")
+
+def test_purge_expired_resets_in_batches(test_db, monkeypatch):
+    """Test expired and used keys are deleted in batches and outstanding ones kept"""
+    from datetime import timedelta
+    from models import PasswordReset
+    now = datetime.utcnow()
+    db = TestingSessionLocal()
+    db.add_all(
+        [PasswordReset(email=f"old{i}@example.com", reset_key=f"OLD{i:03d}", expires_at=now - timedelta(days=i + 1)) for i in range(5)] +
+        [PasswordReset(email="used@example.com", reset_key=f"USED{i:02d}", is_used=True, expires_at=now - timedelta(minutes=1)) for i in range(3)] +
+        [PasswordReset(email="live@example.com", reset_key=f"LIVE{i:02d}", expires_at=now + timedelta(hours=1)) for i in range(2)]
+    )
+    db.commit()
+    
+    with StatementRecorder() as recorder:
+        assert password_resets.purge_expired(engine, now, batch_size=3) == 8
+    # Three full batches (3 + 3 + 2), each a SELECT of ids and a DELETE
+    assert recorder.statements.count("DELETE FROM PASSWORD_RESETS") == 3
+    assert sorted(row.reset_key for row in db.query(PasswordReset)) == ["LIVE00", "LIVE01"]
+    db.close()
+    
+    monkeypatch.setattr(password_resets.reset_purger, "interval_seconds", 3600)
+    monkeypatch.setattr(password_resets.reset_purger, "_last_run", -3600.0)
+    password_resets.reset_purger.maybe_purge().join()
+    assert password_resets.reset_purger.maybe_purge() is None  # not again within the interval
+    print("✓ Reset purge test passed")
+
+# ==================== IDEMPOTENCY TESTS ====================
+
+def test_idempotent_expense_retry_replays_response(client, auth_token):
+    """Test a retried POST /expenses returns the first response without touching expenses"""
+    headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": "retry-1"}
+    expense = {"description": "Taxi", "amount": 18.5, "category": "Transport"}
+    first = client.post("/expenses", json=expense, headers=headers)
+    assert first.status_code == 200 and "Idempotent-Replayed" not in first.headers
+    
+    with StatementRecorder() as recorder:
+        retry = client.post("/expenses", json=expense, headers=headers)
+    assert retry.status_code == 200 and retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert not any("EXPENSES" in statement for statement in recorder.statements)
+    
+    # A worker without the key cached finds the stored response in the database
+    idempotency_store.clear()
+    tag_index.clear()
+    with StatementRecorder() as recorder:
+        retry = client.post("/expenses", json=expense, headers=headers)
+    assert retry.json() == first.json() and retry.headers["Idempotent-Replayed"] == "true"
+    assert not any("EXPENSES" in statement for statement in recorder.statements)
+    
+    auth = {"Authorization": f"Bearer {auth_token}"}
+    assert len(client.get("/expenses", headers=auth).json()) == 1
+    assert client.post("/expenses", json=expense, headers=auth).json()["id"] != first.json()["id"]
+    print("✓ Idempotent expense replay test passed")
+
+def test_idempotency_key_conflicts(client, auth_token):
+    """Test a reused key with another payload is a 422, and keys are per user"""
+    headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": "budget-1"}
+    budget = {"month": 3, "year": 2024, "amount": 400.0}
+    first = client.post("/budgets", json=budget, headers=headers)
+    assert client.post("/budgets", json=budget, headers=headers).json() == first.json()
+    assert client.post("/budgets", json={**budget, "amount": 500.0}, headers=headers).status_code == 422
+    assert client.post("/expenses", json={"description": "X", "amount": 1.0}, headers=headers).status_code == 422
+    assert len(client.get("/budgets", headers=headers).json()) == 1
+    
+    client.post("/register", json={"email": "other@example.com", "password": "otherpassword", "full_name": "Other"})
+    other_token = client.post(
+        "/login", data={"username": "other@example.com", "password": "otherpassword"}
+    ).json()["access_token"]
+    other = client.post("/budgets", json=budget, headers={**headers, "Authorization": f"Bearer {other_token}"})
+    assert other.status_code == 200 and other.json()["id"] != first.json()["id"]
+    
+    long_key = {**headers, "Idempotency-Key": "k" * 256}
+    assert client.post("/budgets", json=budget, headers=long_key).status_code == 400
+    print("✓ Idempotency key conflict test passed")
+
+def test_idempotency_key_in_flight_and_expired(client, auth_token):
+    """Test a retry during the first request is a 409 and an expired key starts over"""
+    from datetime import timedelta
+    from models import IdempotencyKey
+    headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": "slow-1"}
+    expense = {"description": "Lunch", "amount": 12.0}
+    db = TestingSessionLocal()
+    user_id = db.query(User).one().id
+    assert idempotency_store.begin(db, user_id, "slow-1", "expenses", ExpenseCreate(**expense).model_dump(mode="json")) is None
+    response = client.post("/expenses", json=expense, headers=headers)
+    assert response.status_code == 409 and response.headers["Retry-After"] == "1"
+    
+    idempotency_store.abort(db, user_id, "slow-1")
+    first = client.post("/expenses", json=expense, headers=headers).json()
+    
+    idempotency_store.clear()
+    db.query(IdempotencyKey).update({"expires_at": datetime.utcnow() - timedelta(seconds=1)})
+    db.commit()
+    db.close()
+    second = client.post("/expenses", json=expense, headers=headers)
+    assert "Idempotent-Replayed" not in second.headers and second.json()["id"] != first["id"]
+    print("✓ Idempotency in-flight and expiry test passed")
+
+def test_idempotency_lease_lets_retry_take_over(client, auth_token):
+    """Test a claim left by a request that died is taken over after its lease, without duplicates"""
+    from datetime import timedelta
+    from crud import create_expense
+    from idempotency import Replay
+    from models import IdempotencyKey
+    headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": "crashed-1"}
+    expense = {"description": "Dinner", "amount": 30.0}
+    payload = ExpenseCreate(**expense).model_dump(mode="json")
+    db = TestingSessionLocal()
+    user_id = db.query(User).one().id
+    
+    # The first request claimed the key and never wrote anything
+    assert idempotency_store.begin(db, user_id, "crashed-1", "expenses", payload) is None
+    assert client.post("/expenses", json=expense, headers=headers).status_code == 409
+    db.query(IdempotencyKey).update({"claimed_at": datetime.utcnow() - timedelta(seconds=idempotency_store.lease_seconds + 1)})
+    db.commit()
+    retry = client.post("/expenses", json=expense, headers=headers)
+    assert retry.status_code == 200 and "Idempotent-Replayed" not in retry.headers
+    
+    # Had it only been slow, its write is rolled back and it replays the retry's response
+    with pytest.raises(Replay) as replay:
+        create_expense(db, ExpenseCreate(**expense), user_id, "crashed-1")
+    db.rollback()
+    assert json.loads(replay.value.response.body) == retry.json()
+    assert db.query(Expense).count() == 1
+    
+    # The response commits with the expense, so a rolled-back write leaves nothing to replay
+    db.close()
+    auth = {"Authorization": f"Bearer {auth_token}"}
+    assert client.post("/expenses", json=expense, headers={**auth, "Idempotency-Key": "crashed-2"}).status_code == 200
+    db = TestingSessionLocal()
+    row = db.get(IdempotencyKey, (user_id, "crashed-2"))
+    assert row.status_code == 200 and row.response["id"] == max(e.id for e in db.query(Expense))
+    db.close()
+    print("✓ Idempotency lease test passed")
+
+def test_idempotency_claim_retries_after_vanished_conflict(client, auth_token, monkeypatch):
+    """Test a claim that conflicts with a row removed again before it is read is simply retried"""
+    from models import IdempotencyKey
+    db = TestingSessionLocal()
+    user_id = db.query(User).one().id
+    other = TestingSessionLocal()
+    
+    def conflicting_claim(session):
+        # Another worker claims the key just before this commit and aborts right after
+        monkeypatch.setattr(idempotency_store, "_maybe_purge", lambda session: None)
+        other.add(IdempotencyKey(owner_id=user_id, key="gone-1", scope="expenses", fingerprint="x",
+                                 expires_at=datetime.utcnow()))
+        other.commit()
+        event.listen(session, "after_rollback", lambda session: idempotency_store.abort(other, user_id, "gone-1"), once=True)
+    monkeypatch.setattr(idempotency_store, "_maybe_purge", conflicting_claim)
+    
+    payload = ExpenseCreate(description="Tea", amount=3.0).model_dump(mode="json")
+    assert idempotency_store.begin(db, user_id, "gone-1", "expenses", payload) is None
+    assert db.get(IdempotencyKey, (user_id, "gone-1")).status_code is None
+    db.close()
+    other.close()
+    print("✓ Idempotency vanished conflict test passed")
+
+# ==================== SERVER TESTS ====================
+
+def test_server_preloads_app_and_resets_pools_after_fork():
+    """Test the production server preloads, recycles workers and drops inherited connections"""
+    import server
+    cfg = server.Server().cfg
+    assert cfg.preload_app and cfg.workers >= 1
+    assert cfg.max_requests > 0 and cfg.max_requests_jitter > 0
+    assert cfg.worker_class is server.DrainingUvicornWorker
+    
+    with database.engine.connect():
+        pass
+    inherited = database.engine.pool
+    assert inherited.checkedin() >= 1
+    cfg.post_fork(None, None)
+    assert database.engine.pool is not inherited and database.engine.pool.checkedin() == 0
+    print("✓ Server config test passed")
+
+def test_server_falls_back_to_one_worker_without_shared_limits(client, admin_headers, monkeypatch):
+    """Test several workers need the shared rate limit store, and profiling needs one worker"""
+    import logging
+    from types import SimpleNamespace
+    import ratelimit
+    import server
+    from profiling import profiler
+    monkeypatch.setattr(profiler, "workers", 1)
+    log = logging.getLogger("test.server")
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_BACKEND", "memory")
+    assert server.shared_state_workers(1, log) == 1
+    assert server.shared_state_workers(4, log) == 1
+    
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", False)
+    assert server.shared_state_workers(4, log) == 4
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_BACKEND", "redis")
+    cfg = server.Server(workers=4).cfg
+    assert cfg.on_starting is server.on_starting and cfg.worker_exit is server.worker_exit
+    arbiter = SimpleNamespace(cfg=cfg, log=log, num_workers=cfg.workers)
+    cfg.on_starting(arbiter)
+    assert arbiter.num_workers == cfg.workers == profiler.workers == 4
+    
+    response = client.post("/admin/profiles", json={"route": "/expenses"}, headers=admin_headers)
+    assert response.status_code == 409
+    assert "WEB_CONCURRENCY=1" in response.json()["detail"]
+    print("✓ Server worker safety test passed")
+
+# ==================== REPORT JOB TESTS ====================
+
+@pytest.fixture
+def report_store(tmp_path, monkeypatch):
+    from blobstore import LocalBlobStore
+    store = LocalBlobStore(str(tmp_path / "reports"))
+    monkeypatch.setattr(reports, "report_store", store)
+    monkeypatch.setattr(reports.report_runner, "store", store)
+    return store
+
+def _wait_for_report(client, headers, job_id, timeout=60):
+    import time
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/reports/jobs/{job_id}", headers=headers).json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.2)
+    raise AssertionError("report job did not finish")
+
+def test_report_job_renders_in_background(client, auth_token, report_store):
+    """Test a queued report is rendered off the request path and downloadable"""
+    import openpyxl
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    year = datetime.utcnow().year
+    for description, amount, category in [("Rent", 900.0, "Housing"), ("Lunch", 12.5, "Food"), ("Dinner", 30.0, "Food")]:
+        client.post("/expenses", json={"description": description, "amount": amount, "category": category}, headers=headers)
+    client.post("/budgets", json={"month": datetime.utcnow().month, "year": year, "amount": 40.0, "category": "Food"}, headers=headers)
+    
+    response = client.post("/reports/jobs", json={"format": "xlsx", "year": year}, headers=headers)
+    assert response.status_code == 202 and response.json()["status"] in ("queued", "running")
+    job = _wait_for_report(client, headers, response.json()["id"])
+    assert job["status"] == "done" and job["download_url"] == f"/reports/jobs/{job['id']}/download"
+    
+    download = client.get(job["download_url"], headers=headers)
+    assert download.status_code == 200 and download.headers["content-type"].startswith("application/vnd.openxmlformats")
+    assert f"expenses-{year}.xlsx" in download.headers["content-disposition"]
+    sheet = openpyxl.load_workbook(io.BytesIO(download.content))["Spending"]
+    rows = list(sheet.values)
+    assert rows[1] == ("Period", "Housing", "Food", "Total")
+    assert rows[-1] == ("Total", 900.0, 42.5, 942.5)
+    budgets = list(openpyxl.load_workbook(io.BytesIO(download.content))["Budgets"].values)
+    assert budgets[1][1:4] == ("Food", 40.0, 42.5)
+    
+    month = client.post("/reports/jobs", json={"format": "pdf", "year": year, "month": datetime.utcnow().month}, headers=headers).json()
+    month = _wait_for_report(client, headers, month["id"])
+    assert client.get(month["download_url"], headers=headers).content.startswith(b"%PDF")
+    
+    client.post("/register", json={"email": "other@example.com", "password": "otherpassword", "full_name": "Other"})
+    other_token = client.post("/login", data={"username": "other@example.com", "password": "otherpassword"}).json()["access_token"]
+    assert client.get(job["download_url"], headers={"Authorization": f"Bearer {other_token}"}).status_code == 404
+    print("✓ Background report job test passed")
+
+def test_report_jobs_deduplicated_and_bounded(client, auth_token, report_store, monkeypatch):
+    """Test identical requests share a job until the data changes, and active jobs are capped"""
+    submitted = []
+    monkeypatch.setattr(reports.report_runner, "submit", submitted.append)
+    monkeypatch.setattr(reports, "REPORT_MAX_ACTIVE", 2)
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    request = {"format": "csv", "year": 2024}
+    
+    first = client.post("/reports/jobs", json=request, headers=headers).json()
+    assert client.post("/reports/jobs", json=request, headers=headers).json()["id"] == first["id"]
+    assert client.get(f"/reports/jobs/{first['id']}/download", headers=headers).status_code == 409
+    
+    # A write makes the queued report stale
+    client.post("/expenses", json={"description": "New", "amount": 1.0}, headers=headers)
+    second = client.post("/reports/jobs", json=request, headers=headers).json()
+    assert second["id"] != first["id"] and submitted == [first["id"], second["id"]]
+    
+    response = client.post("/reports/jobs", json={**request, "format": "pdf"}, headers=headers)
+    assert response.status_code == 429 and "Retry-After" in response.headers
+    assert client.post("/reports/jobs", json={**request, "month": 13}, headers=headers).status_code == 422
+    print("✓ Report job deduplication test passed")
+
+def test_racing_report_requests_share_one_job(client, auth_token, report_store):
+    """Test identical requests that both miss the lookup still end up with a single active job"""
+    from datetime import timedelta
+    from models import ReportJob
+    db = TestingSessionLocal()
+    user_id = db.query(User).one().id
+    params = {"format": "csv", "year": 2024, "month": None}
+    
+    first, created = reports.report_runner.create(db, user_id, params, "same")
+    assert created
+    second, created = reports.report_runner.create(db, user_id, params, "same")
+    assert not created and second.id == first.id
+    
+    # A job lost with its worker doesn't block a new one
+    db.query(ReportJob).update({"created_at": datetime.utcnow() - timedelta(days=1)})
+    db.commit()
+    third, created = reports.report_runner.create(db, user_id, params, "same")
+    assert created and third.id != first.id
+    db.refresh(first)
+    assert first.status == "failed"
+    db.close()
+    
+    # Duplicates left in an existing table are failed before the index is built
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_report_jobs_active")
+    db = TestingSessionLocal()
+    db.add(ReportJob(owner_id=user_id, params=params, params_hash="same"))
+    db.commit()
+    reports.ensure_indexes(engine)
+    assert db.query(ReportJob).filter(ReportJob.status == "queued").count() == 1
+    db.close()
+    print("✓ Report job race test passed")
+
+def test_expired_reports_are_purged(client, auth_token, report_store):
+    """Test finished reports disappear after their TTL and lost jobs are dropped"""
+    from datetime import timedelta
+    from models import ReportJob
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    job = client.post("/reports/jobs", json={"format": "csv", "year": 2024}, headers=headers).json()
+    job = _wait_for_report(client, headers, job["id"])
+    assert client.get(job["download_url"], headers=headers).text.startswith("period,total")
+    
+    db = TestingSessionLocal()
+    db.query(ReportJob).update({"expires_at": datetime.utcnow() - timedelta(seconds=1)})
+    db.add(ReportJob(owner_id=db.query(User).one().id, params={"format": "csv", "year": 2023}, params_hash="lost",
+                     status="running", created_at=datetime.utcnow() - timedelta(days=1)))
+    db.commit()
+    db.close()
+    assert client.get(job["download_url"], headers=headers).status_code == 410
+    
+    assert reports.report_runner.purge() == 2
+    assert list(report_store.list_objects()) == []
+    assert client.get(f"/reports/jobs/{job['id']}", headers=headers).status_code == 404
+    print("✓ Report purge test passed")
+
+# ==================== TAG TESTS ====================
+
+def test_tag_filters(client, auth_token):
+    """Test AND and OR tag filters on listings and summaries"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    for description, amount, category, tags in [
+        ("Flight", 300.0, "Travel", ["trip", "reimbursable"]),
+        ("Hotel", 200.0, "Travel", ["trip", " reimbursable ", "trip"]),
+        ("Dinner", 50.0, "Food", ["trip"]),
+        ("Software", 20.0, "Work", ["reimbursable", "client-x"]),
+        ("Groceries", 80.0, "Food", []),
+    ]:
+        response = client.post("/expenses", json={"description": description, "amount": amount,
+                                                  "category": category, "tags": tags}, headers=headers)
+        assert response.status_code == 200
+    assert response.json()["tags"] == []
+    
+    def descriptions(query):
+        return sorted(e["description"] for e in client.get(f"/expenses?{query}", headers=headers).json())
+    
+    assert descriptions("tags=trip,reimbursable") == ["Flight", "Hotel"]
+    assert descriptions("any_tags=trip,client-x") == ["Dinner", "Flight", "Hotel", "Software"]
+    assert descriptions("tags=reimbursable&any_tags=client-x,unknown") == ["Software"]
+    assert descriptions("tags=trip&category=Food") == ["Dinner"]
+    assert descriptions("tags=unknown") == []
+    
+    hotel = client.get("/expenses?tags=trip&fields=description,tags", headers=headers).json()
+    assert {"description": "Hotel", "tags": ["reimbursable", "trip"]} in hotel
+    
+    summary = client.get("/expenses/summary?tags=reimbursable", headers=headers).json()
+    assert summary["total_expenses"] == 520.0 and summary["total_count"] == 3
+    assert summary["category_breakdown"] == {"Travel": 500.0, "Work": 20.0}
+    
+    assert client.get("/tags", headers=headers).json() == [
+        {"name": "reimbursable", "count": 3}, {"name": "trip", "count": 3}, {"name": "client-x", "count": 1}
+    ]
+    
+    too_many = {"description": "X", "amount": 1.0, "tags": [f"t{i}" for i in range(21)]}
+    assert client.post("/expenses", json=too_many, headers=headers).status_code == 422
+    print("✓ Tag filter test passed")
+
+def test_tag_index_follows_writes(client, auth_token, monkeypatch):
+    """Test the in-memory index catches up with updates, deletes and writes it did not see"""
+    import tags
+    from sqlalchemy import func
+    from crud import log_change
+    from models import ChangeLog, ExpenseTag, Tag
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    first = client.post("/expenses", json={"description": "A", "amount": 1.0, "tags": ["x"]}, headers=headers).json()
+    second = client.post("/expenses", json={"description": "B", "amount": 2.0, "tags": ["x", "y"]}, headers=headers).json()
+    
+    def matching(query):
+        return sorted(e["id"] for e in client.get(f"/expenses?{query}", headers=headers).json())
+    
+    assert matching("tags=x") == [first["id"], second["id"]]
+    
+    response = client.put(f"/expenses/{first['id']}", json={"tags": ["y", "z"]}, headers=headers)
+    assert response.json()["tags"] == ["y", "z"] and response.json()["version"] == 2
+    assert client.put(f"/expenses/{second['id']}", json={"amount": 3.0}, headers=headers).json()["tags"] == ["x", "y"]
+    assert matching("tags=x") == [second["id"]]
+    assert matching("tags=y,z") == [first["id"]]
+    
+    client.delete(f"/expenses/{second['id']}", headers=headers)
+    assert matching("any_tags=x,y") == [first["id"]]
+    
+    # Another process tags the expense; its change log row is what the index follows,
+    # by sequence number even when its id comes from an older id block
+    db = TestingSessionLocal()
+    user_id = db.query(User).one().id
+    tags.tag_expenses(db, [(user_id, first["id"], ["w"])])
+    log_change(db, user_id, "expense", first["id"], "upsert")
+    db.query(ChangeLog).filter(ChangeLog.seq == db.query(func.max(ChangeLog.seq)).scalar_subquery()).update(
+        {ChangeLog.id: -1}, synchronize_session=False
+    )
+    db.commit()
+    assert matching("tags=w") == [first["id"]]
+    assert client.get(f"/expenses/{first['id']}", headers=headers).json()["tags"] == ["w", "y", "z"]
+    
+    # Past the catch-up limit the index is rebuilt rather than patched
+    monkeypatch.setattr(tags, "TAG_INDEX_CATCH_UP", 0)
+    db.query(ExpenseTag).filter(ExpenseTag.tag_id == db.query(Tag.id).filter(Tag.name == "z").scalar_subquery()).delete(
+        synchronize_session=False
+    )
+    log_change(db, user_id, "expense", first["id"], "upsert")
+    db.commit()
+    db.close()
+    assert matching("tags=z") == []
+    assert {tag["name"] for tag in client.get("/tags", headers=headers).json()} == {"w", "y"}
+    print("✓ Tag index catch-up test passed")
+
+# ==================== SPLIT EXPENSE TESTS ====================
+
+def _login_as(client, email):
+    client.post("/register", json={"email": email, "password": "splitpassword", "full_name": email.split("@")[0]})
+    token = client.post("/login", data={"username": email, "password": "splitpassword"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+def test_split_expenses_and_settle_up(client, auth_token):
+    """Test splits keep the pairwise ledger current and the settle-up plan clears it"""
+    alice = {"Authorization": f"Bearer {auth_token}"}
+    bob = _login_as(client, "bob@example.com")
+    carol = _login_as(client, "carol@example.com")
+    group = client.post("/groups", json={"name": "Trip", "member_emails": ["bob@example.com", "carol@example.com"]},
+                        headers=alice).json()
+    a, b, c = [member["id"] for member in group["members"]]
+    url = f"/groups/{group['id']}"
+    
+    dinner = client.post(f"{url}/expenses", json={"description": "Dinner", "amount": 90.0}, headers=alice).json()
+    assert {share["user_id"]: share["amount"] for share in dinner["shares"]} == {a: 30.0, b: 30.0, c: 30.0}
+    response = client.post(f"{url}/expenses", json={
+        "description": "Taxi", "amount": 60.0, "shares": [{"user_id": a, "amount": 20.0}, {"user_id": c, "amount": 40.0}]
+    }, headers=bob)
+    assert response.status_code == 200 and response.json()["paid_by"] == b
+    # Odd cents go to the lowest ids, and the shares always add up
+    snack = client.post(f"{url}/expenses", json={"description": "Snack", "amount": 0.10, "paid_by": c,
+                                                  "split_between": [a, b, c]}, headers=carol).json()
+    assert [share["amount"] for share in snack["shares"]] == [0.04, 0.03, 0.03]
+    
+    balances = client.get(f"{url}/balances", headers=bob).json()
+    assert {m["user_id"]: m["balance"] for m in balances["members"]} == {a: 39.96, b: 29.97, c: -69.93}
+    assert {(d["from_user"], d["to_user"]): d["amount"] for d in balances["debts"]} == {
+        (b, a): 10.0, (c, a): 29.96, (c, b): 39.97
+    }
+    plan = client.get(f"{url}/settle-up", headers=carol).json()
+    assert len(plan) == 2 and all(payment["from_user"] == c for payment in plan)
+    
+    for payment in plan:
+        client.post(f"{url}/settlements", json={"to_user": payment["to_user"], "amount": payment["amount"]}, headers=carol)
+    assert client.get(f"{url}/settle-up", headers=alice).json() == []
+    assert all(m["balance"] == 0 for m in client.get(f"{url}/balances", headers=alice).json()["members"])
+    
+    # Deleting takes the shares back out; only the payer or recorder may
+    assert client.delete(f"{url}/expenses/{dinner['id']}", headers=bob).status_code == 404
+    assert client.delete(f"{url}/expenses/{dinner['id']}", headers=alice).status_code == 200
+    assert {m["user_id"]: m["balance"] for m in client.get(f"{url}/balances", headers=alice).json()["members"]} == {
+        a: -60.0, b: 30.0, c: 30.0
+    }
+    
+    bad = {"description": "Bad", "amount": 10.0, "shares": [{"user_id": a, "amount": 4.0}]}
+    assert client.post(f"{url}/expenses", json=bad, headers=alice).status_code == 400
+    outsider = _login_as(client, "dave@example.com")
+    assert client.get(f"{url}/balances", headers=outsider).status_code == 404
+    assert client.post(f"{url}/expenses", json={"description": "X", "amount": 1.0}, headers=outsider).status_code == 404
+    assert [g["name"] for g in client.get("/groups", headers=carol).json()] == ["Trip"]
+    print("✓ Split expense test passed")
+
+def test_ledger_check_and_settle_up_plan(client, auth_token):
+    """Test the consistency checker finds and repairs drift, and settle-up needs at most n - 1 payments"""
+    import random
+    import splits
+    from models import GroupBalance
+    alice = {"Authorization": f"Bearer {auth_token}"}
+    _login_as(client, "bob@example.com")
+    group = client.post("/groups", json={"name": "Home", "member_emails": ["bob@example.com"]}, headers=alice).json()
+    client.post(f"/groups/{group['id']}/expenses", json={"description": "Rent", "amount": 1000.0}, headers=alice)
+    
+    db = TestingSessionLocal()
+    assert splits.check_ledger(db) == []
+    db.query(GroupBalance).update({"amount_cents": GroupBalance.amount_cents + 1})
+    db.commit()
+    (group_id, low, high, stored, expected), = splits.check_ledger(db, repair=True)
+    assert group_id == group["id"] and stored - expected == 1 and abs(expected) == 50000
+    assert splits.check_ledger(db) == []
+    db.close()
+    
+    rng = random.Random(7)
+    debts = [(rng.randrange(12), rng.randrange(12), rng.randrange(1, 10000)) for _ in range(200)]
+    net = splits.net_balances([(debtor, creditor, cents) for debtor, creditor, cents in debts if debtor != creditor])
+    plan = splits.settle_up(net)
+    assert len(plan) <= len([cents for cents in net.values() if cents]) - 1
+    remaining = dict(net)
+    for debtor, creditor, cents in plan:
+        remaining[debtor] += cents
+        remaining[creditor] -= cents
+    assert not any(remaining.values())
+    print("✓ Ledger check and settle-up plan test passed")
+
+# ==================== BUDGET ALERT TESTS ====================
+
+def test_budget_alerts_fire_once_per_crossing(client, auth_token):
+    """Test thresholds alert when spending crosses them on write, and again only after dropping back"""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    now = datetime.now()
+    budget = client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 100.0, "category": "Food"},
+                         headers=headers).json()
+    assert budget["alert_thresholds"] == [80.0, 100.0]
+    client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 400.0, "alert_thresholds": [50]},
+                headers=headers)
+    
+    def add(amount, category="Food"):
+        return client.post("/expenses", json={"description": "E", "amount": amount, "category": category},
+                           headers=headers).json()
+    
+    def alerts():
+        return [(n["data"]["budget_id"], n["data"]["threshold"]) for n in client.get("/notifications", headers=headers).json()]
+    
+    add(50.0)
+    add(500.0, "Transport")
+    assert alerts() == [(budget["id"] + 1, 50.0)]
+    lunch = add(35.0)
+    add(10.0)
+    assert alerts()[0] == (budget["id"], 80.0) and len(alerts()) == 2
+    add(10.0)
+    assert alerts()[0] == (budget["id"], 100.0) and len(alerts()) == 3
+    
+    # Back below both thresholds, then one write over both fires each once more
+    client.delete(f"/expenses/{lunch['id']}", headers=headers)
+    client.put(f"/expenses/{lunch['id'] - 1}", json={"amount": 1.0}, headers=headers)  # the Transport one
+    assert len(alerts()) == 3
+    add(40.0)
+    assert alerts()[:2] == [(budget["id"], 100.0), (budget["id"], 80.0)]
+    notification = client.get("/notifications", headers=headers).json()[0]
+    assert notification["kind"] == "budget_threshold" and "Food" in notification["message"]
+    assert notification["data"]["spent"] == 110.0
+    
+    assert client.post(f"/notifications/{notification['id']}/read", headers=headers).status_code == 200
+    assert client.post(f"/notifications/{notification['id']}/read", headers=headers).status_code == 404
+    assert len(client.get("/notifications?unread_only=true", headers=headers).json()) == 4
+    assert client.post("/notifications/read", headers=headers).json() == {"marked": 4}
+    assert client.get("/notifications?unread_only=true", headers=headers).json() == []
+    print("✓ Budget alert crossing test passed")
+
+def test_budget_trackers_follow_budget_changes_and_deliver(client, auth_token):
+    """Test trackers are rebuilt when a budget changes and alerts are emailed once"""
+    import budget_alerts
+    from email_service import EmailQueue, LocalSink
+    from models import BudgetTracker
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    now = datetime.now()
+    for amount in (30.0, 45.0):
+        client.post("/expenses", json={"description": "E", "amount": amount, "category": "Bills"}, headers=headers)
+    
+    # A budget set after the spending alerts straight away for what it has already passed
+    budget = client.post("/budgets", json={"month": now.month, "year": now.year, "amount": 90.0, "category": "Bills"},
+                         headers=headers).json()
+    assert [n["data"]["threshold"] for n in client.get("/notifications", headers=headers).json()] == [80.0]
+    
+    # Raising the amount re-arms 80%; lowering it again crosses it without a new expense
+    update = {"month": now.month, "year": now.year, "amount": 200.0, "category": "Bills"}
+    assert client.put(f"/budgets/{budget['id']}", json=update, headers=headers).json()["alert_thresholds"] == [80.0, 100.0]
+    client.put(f"/budgets/{budget['id']}", json={**update, "amount": 75.0, "alert_thresholds": [100]}, headers=headers)
+    assert [n["data"]["threshold"] for n in client.get("/notifications", headers=headers).json()] == [100.0, 80.0]
+    assert client.get("/budgets", headers=headers).json()[0]["alert_thresholds"] == [100.0]
+    
+    db = TestingSessionLocal()
+    assert db.query(BudgetTracker).one().spent == 75.0
+    db.close()
+    
+    sink = LocalSink(directory="")
+    outbox = EmailQueue(sink, senders=1)
+    assert budget_alerts.deliver(outbox, primary=engine) == 2
+    assert budget_alerts.deliver(outbox, primary=engine) == 0
+    outbox.close()
+    assert [message["to"] for message in sink.messages] == ["test@example.com"] * 2
+    assert "Bills" in sink.messages[0]["html"]
+    print("✓ Budget tracker and delivery test passed")
+
 # ==================== RUN ALL TESTS ====================
 
 if __name__ == "__main__":
@@ -16,26 +16,22 @@ const Dashboard = () => {
 
   const fetchDashboardData = async () => {
     try {
-      const [summaryRes, expensesRes] = await Promise.all([
-        axios.get('/expenses/summary'),
-        axios.get('/expenses?limit=5')
-      ]);
-      
-      console.log('Summary response:', summaryRes.data);
-      console.log('Expenses response:', expensesRes.data);
+      // Summary, recent expenses and budget status arrive in one response
+      const response = await axios.get('/dashboard?limit=5');
+      const { summary: summaryData, recent_expenses: recent } = response.data || {};
       
       // Validate responses before setting state
-      if (summaryRes.data && typeof summaryRes.data === 'object' && !Array.isArray(summaryRes.data.detail)) {
-        setSummary(summaryRes.data);
+      if (summaryData && typeof summaryData === 'object') {
+        setSummary(summaryData);
       } else {
-        console.error('Invalid summary response:', summaryRes.data);
+        console.error('Invalid summary response:', response.data);
         setSummary({ total_expenses: 0, total_count: 0, category_breakdown: {} });
       }
       
-      if (Array.isArray(expensesRes.data)) {
-        setRecentExpenses(expensesRes.data);
+      if (Array.isArray(recent)) {
+        setRecentExpenses(recent);
       } else {
-        console.error('Invalid expenses response:', expensesRes.data);
+        console.error('Invalid expenses response:', response.data);
         setRecentExpenses([]);
       }
     } catch (error) {
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import toast from 'react-hot-toast';
 import { useCurrency } from '../contexts/CurrencyContext';
@@ -22,14 +22,40 @@ const Expenses = () => {
     category: 'Other'
   });
 
+  const [suggestions, setSuggestions] = useState([]);
+
+  // Unfiltered list kept current through /sync, so a refresh only downloads what changed
+  const synced = useRef({ token: null, expenses: new Map() });
+
   const categories = ['Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Healthcare', 'Other'];
 
   useEffect(() => {
     fetchExpenses();
   }, [filters]);
 
+  const syncExpenses = async () => {
+    const { expenses: byId } = synced.current;
+    let token = synced.current.token;
+    let data;
+    do {
+      const response = await axios.get('/sync', { params: token ? { since: token } : {} });
+      data = response.data;
+      if (data.full) byId.clear();
+      data.expenses.forEach(expense => byId.set(expense.id, expense));
+      data.deleted_expenses.forEach(id => byId.delete(id));
+      token = data.token;
+    } while (data.has_more);
+    synced.current.token = token;
+    // Newest first, like /expenses
+    return [...byId.values()].sort((a, b) => b.date.localeCompare(a.date) || b.id - a.id);
+  };
+
   const fetchExpenses = async () => {
     try {
+      if (!filters.category && !filters.month) {
+        setExpenses(await syncExpenses());
+        return;
+      }
       const params = new URLSearchParams();
       if (filters.category) params.append('category', filters.category);
       if (filters.month) params.append('month', filters.month);
@@ -37,6 +63,8 @@ const Expenses = () => {
       const response = await axios.get(`/expenses?${params}`);
       setExpenses(response.data);
     } catch (error) {
+      // Start over from a full snapshot next time
+      synced.current.token = null;
       toast.error('Failed to fetch expenses');
     } finally {
       setLoading(false);
@@ -64,6 +92,31 @@ const Expenses = () => {
     }
   };
 
+  const handleDescriptionChange = async (description) => {
+    const match = suggestions.find(s => s.description === description);
+    if (match && !editingExpense) {
+      // Picked from the list: fill in the usual category and amount
+      setFormData(prev => ({
+        ...prev,
+        description,
+        category: match.category || prev.category,
+        amount: prev.amount || (match.amount != null ? String(match.amount) : '')
+      }));
+      return;
+    }
+    setFormData(prev => ({ ...prev, description }));
+    if (!description.trim()) {
+      setSuggestions([]);
+      return;
+    }
+    try {
+      const response = await axios.get(`/expenses/suggest?prefix=${encodeURIComponent(description)}`);
+      setSuggestions(response.data);
+    } catch (error) {
+      setSuggestions([]);
+    }
+  };
+
   const handleEdit = (expense) => {
     setEditingExpense(expense);
     setFormData({
@@ -269,11 +322,18 @@ const Expenses = () => {
                 <input
                   type="text"
                   value={formData.description}
-                  onChange={(e) => setFormData({ ...formData, description: e.target.value })}
+                  onChange={(e) => handleDescriptionChange(e.target.value)}
                   className="form-input"
                   placeholder="Enter expense description"
+                  list="description-suggestions"
+                  autoComplete="off"
                   required
                 />
+                <datalist id="description-suggestions">
+                  {suggestions.map(s => (
+                    <option key={s.description} value={s.description} />
+                  ))}
+                </datalist>
               </div>
               
               <div className="form-group">